@@ -25,46 +25,69 @@ SOFTWARE.
 
 """
 
+import matplotlib
+# The terminal version only writes files: the plots are rendered with Agg, so it
+# needs neither Tk nor a display (also in the worker processes, which import this module)
+matplotlib.use('Agg')
 import functions as func
-import pandas as pd
 import numpy as np
 import tpfplotter
+import datasource
+import ticcat
+import report
+import results
+import profiling
+import traceback
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-args = func.get_arguments()
-TIC_list = np.array([args.tic])
-TESS_sector_list = np.array([args.sector])
 
-period_data = pd.DataFrame(columns=['TIC','TESS_sector','Period','error','FAP'])
-# LC download and draw loop:
-for i in range(len(TIC_list)):
-    # The lightcurve file will be stored in a cache. 
-    tic = int(TIC_list[i])
-    TESS_sector = int(TESS_sector_list[i])
+def diagnose(tic,TESS_sector,SAP=False,FGratio=None,engine=None,engine_kwargs={},fold_bins=None,decimate=False,
+             summary=False,bootstrap=None,bootstrap_workers=1):
+    # Run the whole chain for a single target and return its row for the period data file.
+    # With summary, no files are written: the row holds the page of the target for the
+    # report (figures rendered to arrays) under 'summary'.
+    # TESS_sector 'all' stitches every sector; the periodogram engine then defaults to fft
+    stitched = func.is_stitched(TESS_sector)
+    if engine is None:
+        engine = 'fft' if stitched else 'gls'
     print('Working on TIC {0}, sector {1}'.format(tic,TESS_sector))
     # Get light curve
-    if args.SAP:
-        lc = func.get_lc(tic,TESS_sector,SAP=True)
-    else:
-        lc = func.get_lc(tic,TESS_sector,SAP=False)
+    lc = func.get_lc(tic,TESS_sector,SAP=SAP,decimate=decimate,savefig=not summary)
     # Get periodogram
-    periodogram, Pbeg, Pend = func.get_periodogram(lc)
-    p_fig, best_period, period_error, fap = func.plot_periodogram(periodogram,
-                                                                  tic,TESS_sector,Pbeg=Pbeg,Pend=Pend,savefig=True)
-    data = {'TIC':int(tic), 'TESS_sector':int(TESS_sector), 'Period':best_period,'error':period_error,'FAP':fap}
-    period_data = period_data.append(data,ignore_index=True)
+    periodogram, Pbeg, Pend = func.get_periodogram(lc,engine=engine,**engine_kwargs)
+    # bootstrap: number of realizations of the empirical FAP, None for the analytic one
+    fap_model = func.bootstrap_fap(periodogram,nmax=bootstrap,workers=bootstrap_workers) if bootstrap else None
+    p_fig, best_period, period_error, fap = func.plot_periodogram(periodogram,tic,TESS_sector,Pbeg=Pbeg,Pend=Pend,
+                                                                  savefig=not summary,fap_model=fap_model)
+    data = {'TIC':int(tic), 'TESS_sector':func.parse_sector(TESS_sector), 'Period':best_period,'error':period_error,'FAP':fap}
     # Fold lightcurve               
-    func.fold_lc(lc,best_period,tic,TESS_sector,savefig=True)
+    if fold_bins:
+        fold_fig = func.fold_lc(lc,best_period,tic,TESS_sector,savefig=not summary,binned=True,nbins=fold_bins)
+    else:
+        fold_fig = func.fold_lc(lc,best_period,tic,TESS_sector,savefig=not summary)
     # Get TPF using Lillo's script
     print('Working on TPF')
-    SAVE = '--SAVEGAIA' if args.FGratio else ''
-    tpf_fig, tpf_data = tpfplotter.tpfplotter(str(tic),sector=str(TESS_sector), SAVEGAIA=True,savefig=True,fontcolor='black')
+    # (stitched sectors: the TPF of the first sector, saved under the name summary_pdf expects)
+    tpf_sector = None if stitched else str(TESS_sector)
+    tpf_fig, tpf_data = tpfplotter.tpfplotter(str(tic),sector=tpf_sector, SAVEGAIA=True,
+                                              savefig=not (summary or stitched),fontcolor='black')
+    if stitched and not summary:
+        tpf_fig.savefig('TIC_{0}_S_{1}_tpf.png'.format(tic,TESS_sector))
     #os.system('python3 tpfplotter_py3.py {0} --sector {1} --maglim 6 {2}'.format(tic,TESS_sector,SAVE))
     # Create summary pdf file
-    if args.FGratio:
-        GFrat, Gmag, Gid, Nin = func.get_poll(tpf_data)
-        func.summary_pdf(tic,TESS_sector,best_period,period_error,fap,GFrat)
+    GFrat = func.get_poll(tpf_data)[0] if FGratio else None
+    data['FG_ratio'] = GFrat
+    if summary:
+        with profiling.stage('plot_lc'):
+            lc_fig = func.lc_figure(lc,decimate)
+        images = {'tpf':tpf_fig,'lc':lc_fig,'periodogram':p_fig,'lcfolded':fold_fig}
+        with profiling.stage('render'):
+            images = {name:report.render(fig) for name, fig in images.items()}
+        data['summary'] = {'tic':tic,'sector':TESS_sector,'images':images,
+                           'title':func.summary_title(tic,TESS_sector,best_period,period_error,fap,GFrat)}
     else:
-        func.summary_pdf(tic,TESS_sector,best_period,period_error,fap)
+        func.summary_pdf(tic,TESS_sector,best_period,period_error,fap,GFrat)
         
     # If you want to automatically remove the plots, uncomment the following lines:
     #import os
@@ -72,5 +95,132 @@ for i in range(len(TIC_list)):
     #os.remove('TIC_{0}_S_{1}_periodogram.png'.format(tic,TESS_sector))
     #os.remove('TIC_{0}_S_{1}_lcfolded.png'.format(tic,TESS_sector))
     #os.remove('TIC_{0}_S_{1}_tpf.png'.format(tic,TESS_sector))
-                          
-period_data.to_csv('Period_data_file.csv')
+    return data
+
+def run_target(tic,TESS_sector,SAP=False,FGratio=None,engine=None,engine_kwargs={},fold_bins=None,decimate=False,
+               summary=False,bootstrap=None,bootstrap_workers=1):
+    # Worker entry point: a failing target is reported back instead of stopping the run.
+    # With --profile, the stages of the target are written to the profile file as one record
+    try:
+        with profiling.target(tic=int(tic),sector=str(TESS_sector)):
+            return diagnose(tic,TESS_sector,SAP=SAP,FGratio=FGratio,engine=engine,engine_kwargs=engine_kwargs,
+                            fold_bins=fold_bins,decimate=decimate,summary=summary,bootstrap=bootstrap,
+                            bootstrap_workers=bootstrap_workers), None
+    except Exception:
+        return None, traceback.format_exc()
+
+def init_worker(archive=None,profile=None,profile_stage=None):
+    # Select the data source and start profiling in this process (also used for the worker processes)
+    if archive is not None:
+        datasource.use_archive(archive)
+    if profile is not None:
+        profiling.enable(profile,cprofile_stage=profile_stage)
+
+def main():
+    import pandas as pd
+    args = func.get_arguments()
+    if args.targets is not None:
+        TIC_list, TESS_sector_list = func.read_targets(args.targets)
+    else:
+        TIC_list = np.array([args.tic])
+        TESS_sector_list = np.array([args.sector])
+    targets = [(int(TIC_list[i]),func.parse_sector(TESS_sector_list[i])) for i in range(len(TIC_list))]
+    if args.profile is not None:
+        # A new profile for this run
+        open(args.profile,'w').close()
+        if args.profile_stage is not None:
+            for f in profiling.cprofile_files(args.profile,args.profile_stage):
+                os.remove(f)
+    init_worker(args.archive,args.profile,args.profile_stage)
+
+    if len(targets) > 1:
+        # Resolve the coordinates and Gaia data of all targets in one request. They are
+        # saved to the local TIC table, which the workers read instead of querying MAST
+        try:
+            with profiling.stage('tic_resolve'):
+                ticcat.get_resolver().resolve_many(TIC_list)
+        except Exception as e:
+            print('Could not resolve the targets in bulk ({0}), they will be resolved one by one'.format(e))
+
+    engine_kwargs = {'search':args.search} if args.engine in ('numpy','fft') else {}
+    failures = []
+    # With --report the pages are added to the report by its writer thread as the targets finish
+    summary = report.open_report(args.report) if args.report else None
+    # Every target is committed to the results store as it finishes. Targets done before with
+    # the same parameters and input files, whose plots and pdf are still there, are skipped
+    # (not with --report, which writes a new report; its targets leave no files, so the
+    # report mode is part of the key and they are not skipped by a later run without it)
+    store = results.ResultsStore(args.results)
+    params = {'SAP':args.SAP,'FGratio':args.FGratio,'engine':args.engine,'engine_kwargs':dict(engine_kwargs),
+              'fold_bins':args.fold_bins,'decimate':args.decimate,'bootstrap':args.bootstrap,
+              'report':summary is not None}
+    source = datasource.get_source()
+    with profiling.stage('fingerprint'):
+        keys = {(tic,TESS_sector):results.run_key(dict(params,tic=tic,sector=TESS_sector),source.fingerprint(tic,TESS_sector))
+                for tic, TESS_sector in targets}
+    todo = targets
+    if not args.rerun and summary is None:
+        todo = [target for target in targets if not store.done(target[0],target[1],keys[target])]
+        if len(todo) < len(targets):
+            print('Skipping {0} targets already done (use --rerun to process them again)'.format(len(targets)-len(todo)))
+    def add_row(data):
+        page = data.pop('summary',None)
+        if page is not None:
+            summary.add(**page)
+        target = (data['TIC'],data['TESS_sector'])
+        artifacts = [] if page is not None else func.summary_files(*target)
+        store.put(data,keys[target],artifacts)
+    # LC download and draw loop. The lightcurve files will be stored in a cache. 
+    if args.workers == 1 or len(todo) <= 1:
+        for tic, TESS_sector in todo:
+            data, error = run_target(tic,TESS_sector,SAP=args.SAP,FGratio=args.FGratio,engine=args.engine,
+                                     engine_kwargs=engine_kwargs,fold_bins=args.fold_bins,
+                                     decimate=args.decimate,summary=summary is not None,
+                                     bootstrap=args.bootstrap,bootstrap_workers=args.workers)
+            if error is None:
+                add_row(data)
+            else:
+                print(error)
+                failures.append({'TIC':tic,'TESS_sector':TESS_sector,'error':error})
+    else:
+        # Each worker pays the lightkurve/astroquery import cost once and is then reused.
+        # The workers already use all cores, so the numpy periodogram runs single threaded
+        # and the bootstrap FAP within the worker
+        if args.engine in ('numpy','fft'):
+            engine_kwargs['threads'] = 1
+        with ProcessPoolExecutor(max_workers=args.workers,initializer=init_worker,
+                                 initargs=(args.archive,args.profile,args.profile_stage)) as pool:
+            jobs = {pool.submit(run_target,tic,TESS_sector,args.SAP,args.FGratio,args.engine,engine_kwargs,
+                                args.fold_bins,args.decimate,summary is not None,args.bootstrap):(tic,TESS_sector) 
+                    for tic, TESS_sector in todo}
+            for n, job in enumerate(as_completed(jobs)):
+                tic, TESS_sector = jobs[job]
+                data, error = job.result()
+                if error is None:
+                    add_row(data)
+                else:
+                    failures.append({'TIC':tic,'TESS_sector':TESS_sector,'error':error})
+                print('[{0}/{1}] TIC {2} sector {3} {4}'.format(n+1,len(todo),tic,TESS_sector,
+                                                                 'done' if error is None else 'FAILED'))
+
+    if summary is not None:
+        with profiling.stage('report'):
+            summary.close()
+        parts = '' if len(summary.files) < 2 else ' ({0} parts: {1}...)'.format(len(summary.files),', '.join(summary.files[:2]))
+        print('Summary of {0} targets written to {1}{2}'.format(summary.npages,args.report,parts))
+
+    period_data = pd.DataFrame(store.rows(targets),columns=results.COLUMNS)
+    period_data.to_csv('Period_data_file.csv')
+    store.close()
+    if failures:
+        print('{0} of {1} targets failed, see Failed_targets.csv'.format(len(failures),len(targets)))
+        pd.DataFrame(failures,columns=['TIC','TESS_sector','error']).to_csv('Failed_targets.csv',index=False)
+    if args.profile is not None:
+        profiling.close(driver='cli')
+        print(profiling.summary(profiling.read(args.profile)))
+        if args.profile_stage is not None:
+            print(profiling.cprofile_summary(args.profile,args.profile_stage))
+
+
+if __name__ == '__main__':
+    main()
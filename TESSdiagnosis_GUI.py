@@ -25,8 +25,20 @@ SOFTWARE.
 
 import PySimpleGUI as sg
 import functions as fn
+import tkfigures
 import tpfplotter
 import warnings
+import threading
+import time
+import prefetch
+import profiling
+import os
+
+# With TESSDIAG_PROFILE=file.jsonl, each job and prefetch is profiled (see profiling.py)
+# and the summary is printed when the window is closed
+PROFILE = os.environ.get('TESSDIAG_PROFILE')
+if PROFILE:
+    profiling.enable(PROFILE,cprofile_stage=os.environ.get('TESSDIAG_PROFILE_STAGE'))
 
 # ----------------------------- Window setup ---------------------------------#
 
@@ -54,9 +66,14 @@ BPAD_RIGHT = ((10,20), (10, 20))
 BPAD_RIGHT_INSIDE = (0, 10)
 
 # Top Block setup
-top_block = [[sg.Text('TIC id',justification='l',font='Any 15'), sg.Input(key='-TICID-',size=20),
-              sg.Text('TESS sector',font='Any 15'), sg.Input(key='-SECTOR-',size=10), 
-              sg.Button('Download LC',key='-DownloadLC-'),sg.Button('Exit',key='-EXIT-')]]
+top_block = [[sg.Text('TIC id',justification='l',font='Any 15'), sg.Input(key='-TICID-',size=20,enable_events=True),
+              sg.Text('TESS sector',font='Any 15'), sg.Input(key='-SECTOR-',size=10,enable_events=True), 
+              sg.Button('Download LC',key='-DownloadLC-'),sg.Button('Exit',key='-EXIT-'),
+              sg.Input(key='-TARGETS-',visible=False,enable_events=True),
+              sg.FileBrowse('Target list',target='-TARGETS-',file_types=(('CSV','*.csv'),('All files','*.*'))),
+              sg.Button('Next target',key='-NEXT-'),sg.Checkbox('Preload next',default=True,key='-PRELOAD-'),
+              sg.ProgressBar(100,orientation='h',size=(15,15),key='-PROGRESS-'),
+              sg.Text('Ready',key='-STATUS-',size=60,font='Any 12'),sg.Button('Cancel',key='-CANCEL-')]]
 
 # Target Pixel File block setup
 TPF_block = [[sg.Text('Target Pixel File', justification='c', font='Any 20')],
@@ -74,9 +91,9 @@ TPF_info = [[sg.T('Results',font='Any 15')],
 
 
 # Light Curve block setup
-LC_SAP_tab = [[sg.Text('SAP Light Curve', font='Any 20', justification='c')],
+LC_SAP_tab = [[sg.Text('SAP Light Curve', font='Any 20', justification='c'),sg.Canvas(key='CONTROLS_SAP')],
             [sg.Canvas(key='-SAP_LIGHTCURVE-')],]
-LC_PDCSAP_tab = [[sg.Text('PDCSAP Light Curve', font='Any 20', justification='c')],
+LC_PDCSAP_tab = [[sg.Text('PDCSAP Light Curve', font='Any 20', justification='c'),sg.Canvas(key='CONTROLS_PDC')],
             [sg.Canvas(key='-PDC_LIGHTCURVE-')],]
 
 # Periodogram block setup
@@ -150,51 +167,167 @@ for key in selectable_text:
 
 # Set some defaults 
 
-lc_file = None
+lcs = None
 periodogram = None
+best_period = periods = None
+lc = None
+TIC = None
+sec = None
+
+# ---------------------------- Background jobs ------------------------------ #
+
+# Downloads, periodograms and TPF/Gaia queries run in worker threads, which post
+# their result back to the event loop as a '-JOB_DONE-' event, so the window
+# keeps responding while MAST or Vizier are slow. Plots are always made here, in
+# the main thread. Each job gets a sequence number per kind: a result is only
+# used if no newer job of its kind was started, and no cancel was requested,
+# since it was submitted (e.g. the user already moved on to another TIC).
+
+job_labels = {'lc':'Downloading light curve', 'periodogram':'Computing periodogram',
+              'tpf':'Getting TPF and Gaia sources'}
+job_seq = {kind:0 for kind in job_labels}
+running = {}        # kind -> (sequence number, context of the job)
+
+def run_job(kind, seq, func, args):
+    # Worker thread: never touches the window except through write_event_value
+    try:
+        with profiling.target(job=kind):
+            result, error = func(*args), None
+    except (Exception, SystemExit) as e:
+        result, error = None, e
+    window.write_event_value('-JOB_DONE-', (kind, seq, result, error))
+
+def start_job(kind, func, *args, **context):
+    job_seq[kind] += 1
+    running[kind] = (job_seq[kind], context)
+    threading.Thread(target=run_job, args=(kind, job_seq[kind], func, args), daemon=True).start()
+    update_status()
+
+def cancel_jobs(kinds=None):
+    # Running threads cannot be stopped, but their results will be ignored
+    for kind in list(running) if kinds is None else kinds:
+        if kind in running:
+            del running[kind]
+            job_seq[kind] += 1
+    update_status()
+
+def update_status():
+    if running:
+        window['-STATUS-'].update(' | '.join(job_labels[kind]+'...' for kind in running))
+    else:
+        window['-STATUS-'].update('Ready')
+        window['-PROGRESS-'].update(0)
+
+progress = 0
+
+# The light curves, TPF and Gaia sources of the typed target (and of the next one
+# of a target list) are fetched in the background as soon as the inputs are
+# valid, so the buttons above mostly plot data that is already in memory
+
+prefetcher = prefetch.Prefetcher()
+PREFETCH_DELAY = 0.5        # s without typing before the target is prefetched
+pending_prefetch = None     # (TIC, sector, time of the last edit)
+targets = None              # target list: [(TIC, sector), ...]
+target_index = -1
+
+def typed_target(values):
+    # (TIC, sector) of the inputs, None if they are not valid (sector 'all': every sector, stitched)
+    try:
+        return int(values['-TICID-']), fn.parse_sector(values['-SECTOR-'])
+    except ValueError:
+        return None
+
+def prefetch_targets(tic, sector, preload_next):
+    # Prefetch a target (and the next one of the list), dropping other prefetches
+    keep = [(tic, sector)]
+    if preload_next and targets is not None and target_index+1 < len(targets):
+        keep.append(targets[target_index+1])
+    prefetcher.cancel(keep=keep)
+    for target in keep:
+        prefetcher.prefetch(*target)
+
+def get_tpf(tic, sector, gid=None, gmag=None):
+    # Prefetched TPF data, with the Gaia id and magnitude of the target given by the user
+    fetched = prefetcher.get('tpf', tic, sector)
+    if gid is not None:
+        fetched = dict(fetched, gaia_id=gid, mag=float(gmag))
+    return fetched
 
 # ------------------------------ Event loop --------------------------------- #
 
 while True:             
-    event, values = window.read()
+    # While jobs are running, wake up regularly to animate the progress bar
+    event, values = window.read(timeout=100 if running or pending_prefetch else None)
     if event == sg.WIN_CLOSED or event == '-EXIT-':
         break
-    if event == '-DownloadLC-':
+    if pending_prefetch is not None and time.time()-pending_prefetch[2] > PREFETCH_DELAY:
+        prefetch_targets(pending_prefetch[0], pending_prefetch[1], values['-PRELOAD-'])
+        pending_prefetch = None
+    if event == sg.TIMEOUT_KEY:
+        progress = (progress+5) % 105
+        window['-PROGRESS-'].update(progress)
+    elif event == '-CANCEL-':
+        cancel_jobs()
+        prefetcher.cancel(waiting=True)
+        pending_prefetch = None
+    elif event in ('-TICID-','-SECTOR-'):
+        # Wait until the user stops typing before prefetching
+        target = typed_target(values)
+        pending_prefetch = target+(time.time(),) if target is not None else None
+    elif event == '-TARGETS-':
+        try:
+            TIC_list, sector_list = fn.read_targets(values['-TARGETS-'])
+            targets = [(int(TIC_list[i]),fn.parse_sector(sector_list[i])) for i in range(len(TIC_list))]
+            target_index = -1
+            if targets and values['-PRELOAD-']:
+                prefetcher.prefetch(*targets[0])
+        except Exception:
+            warnings.warn('Could not read the target list',Warning)
+            sg.Popup('Could not read the target list',title='Warning',keep_on_top=True)
+    elif event == '-NEXT-':
+        if targets is not None and target_index+1 < len(targets):
+            target_index += 1
+            window['-TICID-'].update(targets[target_index][0])
+            window['-SECTOR-'].update(targets[target_index][1])
+            prefetch_targets(targets[target_index][0], targets[target_index][1], values['-PRELOAD-'])
+            pending_prefetch = None
+            window.write_event_value('-DownloadLC-', None)
+        else:
+            sg.Popup('No more targets in the list',title='Warning',keep_on_top=True)
+    elif event == '-DownloadLC-':
         # Download light curve when user clicks on "Download LC" button
         try:
             # Check if values are correct
-            TIC = int(values['-TICID-'])
-            sec = values['-SECTOR-']
-            if sec == '':
-                warnings.warn('Sector not specified. If multiple files are found, only' 
-                      +'the first one will be downloaded',Warning)
-                sg.Popup('Sector not specified. If multiple files are found, only' 
-                      +'the first one will be downloaded',title='Warning',keep_on_top=True)
-            else:
-                sec = int(sec)
-            lc_file = fn.download_lc(TIC,sec)
-            if lc_file is None:
-                # Warn if no light curve is found
-                warnings.warn('Light curve for TIC {0} sector {1} not found'.format(TIC,sec),Warning)
-                sg.Popup('Light curve for TIC {0} sector {1} not found'.format(TIC,sec), 
-                         title='Warning',keep_on_top=True)
-            else:
-                fig_lc_pdc = fn.plot_lc(lc_file,'PDCSAP')
-                fig_canvas_pdc = fn.draw_figure(window['-PDC_LIGHTCURVE-'].TKCanvas, fig_lc_pdc)
-                fig_lc_sap = fn.plot_lc(lc_file,'SAP')
-                fig_canvas_sap = fn.draw_figure(window['-SAP_LIGHTCURVE-'].TKCanvas, fig_lc_sap)
+            TIC_new = int(values['-TICID-'])
+            sec_new = values['-SECTOR-']
+            if sec_new != '':
+                sec_new = fn.parse_sector(sec_new)
         except:
             # Warn if invalid argument for TIC and/or sector
-            warnings.warn('Write valid TIC and sector (both must be integers)',Warning)
-            sg.Popup('TIC and Sector must be integer values',
+            warnings.warn('Write valid TIC and sector (integers, or all for every sector stitched)',Warning)
+            sg.Popup('TIC must be an integer value, and Sector an integer value or all',
                      keep_on_top=True,title='Warning')
+        else:
+            if sec_new == '':
+                warnings.warn('Sector not specified. If multiple files are found, only ' 
+                      +'the first one will be downloaded (write all to stitch every sector)',Warning)
+                sg.Popup('Sector not specified. If multiple files are found, only ' 
+                      +'the first one will be downloaded (write all to stitch every sector)',title='Warning',keep_on_top=True)
+            # Results still pending for another target are not wanted any more
+            cancel_jobs([kind for kind in ('periodogram','tpf')
+                         if kind in running and str(running[kind][1]['TIC']) != str(TIC_new)])
+            if sec_new != '':
+                prefetch_targets(TIC_new, sec_new, values['-PRELOAD-'])
+                pending_prefetch = None
+            # Light curves already prefetched are taken from memory, those seen before from the local cache
+            start_job('lc', prefetcher.get, 'lc', TIC_new, sec_new, TIC=TIC_new, sec=sec_new)
     elif event == '-GET_PERIODOGRAM-':
         # Calculate periodogram when user clicks on "Get periodogram" button
-        if lc_file is not None:
+        if lcs is not None:
             if values['-SAP_periodogram-']:
-                lc = lc_file.SAP_FLUX.remove_nans()
+                lc_periodogram = lcs['SAP']
             elif values['-PDC_periodogram-']:
-                lc = lc_file.PDCSAP_FLUX.remove_nans()
+                lc_periodogram = lcs['PDCSAP']
             # Error if non numerical values are inserted
             params = (values['-OUTLIERS-'],values['-PBEG-'],values['-PEND-'],values['-NPEAKS-'])
             try:
@@ -203,38 +336,15 @@ while True:
                 Pbeg = params[1]
                 Pend = params[2]
                 Npeaks = int(params[3])
-                # Calculate periodogram with inserted parameters
-                periodogram, Pbeg, Pend = fn.get_periodogram(lc,sigma=sig,
-                                                                      Pbeg=Pbeg,Pend=Pend)
-    
-                window['-PBEG-'].update(Pbeg)
-                window['-PEND-'].update(Pend)
-                # Plot periodogram
-                fig_period,best_period,period_error,fap = fn.plot_periodogram(periodogram,
-                                                                  TIC,sec,Pbeg=Pbeg,Pend=Pend,N=Npeaks)
-                DPI = fig_period.get_dpi()
-                fig_period.set_size_inches(360*1.5 / float(DPI), 360 / float(DPI))
-                fn.draw_figure_w_toolbar(window['-PERIODOGRAM-'].TKCanvas, fig_period, window['CONTROLS_Periodogram'].TKCanvas)
-                #fig_canvas_per = fn.draw_figure(window['-PERIODOGRAM-'].TKCanvas, fig_period)
-                periods, heights = fn.periodogram_peaks(periodogram,N_peaks=3)
-                # Print periodogram information
-                window['-BESTPERIOD-'].update('P={0} d'.format(round(best_period,4)))
-                if round(fap,4) > 0:
-                    window['-FAP-'].update('FAP={0}'.format(round(fap,4)))
-                else:
-                    window['-FAP-'].update('FAP<10^{-4}')
-                window['-2P-'].update('2P={0} d'.format(round(2*best_period,4)))
-                window['-P/2-'].update('P/2={0} d'.format(round(best_period/2,4)))
-                
-                i = 0 
-                while i <= len(periods)-1 and i < 4:
-                    window['-P_{0}-'.format(i+2)].update('P_{1}={0} d'.format(round(periods[i],4),i+2))
-                    i += 1
             except:
                 warnings.warn('Use numerical values for parameters',Warning)
                 sg.Popup('Use numerical values for parameters',title='Warning',
                          keep_on_top=True )
-
+            else:
+                # Calculate periodogram with inserted parameters (stitched sectors: fft engine)
+                start_job('periodogram', fn.get_periodogram, lc_periodogram, sig, Pbeg, Pend,
+                          'fft' if fn.is_stitched(sec) else 'gls',
+                          lc=lc_periodogram, Npeaks=Npeaks, TIC=TIC)
         else:
             warnings.warn('No light curve was downloaded.',Warning)
             sg.Popup('No light curve was downloaded.',title='Warning',keep_on_top=True)
@@ -242,30 +352,22 @@ while True:
     elif event in Fold_events:
         # Fase fold light curve with obtained periods
         if periodogram is not None:
-            fig_P1 = fn.fold_lc(lc, best_period)
-            fig_canvas_P1 = fn.draw_figure(window['-LCFOLDED_P1-'].TKCanvas, fig_P1)
-            fig_2P1 = fn.fold_lc(lc, 2*best_period)
-            fig_canvas_2P1 = fn.draw_figure(window['-LCFOLDED_2P1-'].TKCanvas, fig_2P1)
-            fig_P12 = fn.fold_lc(lc, best_period/2)
-            fig_canvas_P12 = fn.draw_figure(window['-LCFOLDED_P12-'].TKCanvas, fig_P12)
-            
-            figs_P = []
-            fig_canvas_Ps = []
-            i = 0
-            while i <= len(periods)-1 and i < 4:
-                figs_P.append(fn.fold_lc(lc,periods[i]))
-                i += 1
-            for i in range(len(figs_P)):
-                fig_canvas_Pn = fn.draw_figure(window['-LCFOLDED_P{0}-'.format(i+2)].TKCanvas, figs_P[i])
-                fig_canvas_Ps.append(fig_canvas_Pn)
+            # All tabs are folded together: P, 2P, P/2 and the next peaks P2-P4
+            fold_periods = [best_period, 2*best_period, best_period/2] + list(periods[:3])
+            fold_keys = ['-LCFOLDED_P1-','-LCFOLDED_2P1-','-LCFOLDED_P12-'] + \
+                        ['-LCFOLDED_P{0}-'.format(i+2) for i in range(len(periods[:3]))]
+            # The figures already in the tabs are updated in place
+            figs_fold = fn.fold_many(lc, fold_periods,
+                                     figs=[tkfigures.panel_for(window[key].TKCanvas).fig for key in fold_keys])
+            fig_canvas_folds = [tkfigures.draw_figure(window[key].TKCanvas, fig) for key, fig in zip(fold_keys, figs_fold)]
         else:
             warnings.warn('Create a periodogram first',Warning)
             sg.Popup('Create a periodogram first',title='Warning',keep_on_top=True)
     elif event == '-FOLD_CUSTOM-':
         try:
             custom_period = float(values['-CUSTOM_P-'])
-            fig_Pcustom = fn.fold_lc(lc, custom_period)
-            fig_canvas_Pc = fn.draw_figure(window['-LCFOLDED_Pc-'].TKCanvas, fig_Pcustom)
+            fig_Pcustom = fn.fold_lc(lc, custom_period, fig=tkfigures.panel_for(window['-LCFOLDED_Pc-'].TKCanvas).fig)
+            fig_canvas_Pc = tkfigures.draw_figure(window['-LCFOLDED_Pc-'].TKCanvas, fig_Pcustom)
         except:
             warnings.warn('The custom period must be numerical',Warning)
             sg.Popup('The custom period must be numerical',title='Warning',
@@ -279,30 +381,100 @@ while True:
             values['-MLIM-'] = ''
             values['-GMAG-'] = ''
         try:
-            TIC = values['-TICID-']
-            sec = values['-SECTOR-']
+            TIC_tpf = int(values['-TICID-'])
+            sec_tpf = values['-SECTOR-']
             # Get values
             info_tpf = [values['-GID-'],values['-MLIM-'],values['-GMAG-']]
             tpf_params = [int(p) if p != '' else None for p in info_tpf]
             if tpf_params[1] == None:
                 tpf_params[1] = 5
-            fig_tpf, data_tpf = tpfplotter.tpfplotter(str(TIC),sector=str(sec),
-                                                      gid=tpf_params[0],gmag=tpf_params[2],maglim=tpf_params[1],SAVEGAIA=True)
-            fig_canvas_tpf = fn.draw_figure(window['-TPF-'].TKCanvas,fig_tpf)
-            FG_frac, Gmag, Gid, Nin = fn.get_poll(data_tpf)
-            window['-GFRAC-'].update('FG_frac = {0}'.format(round(FG_frac,4)))
-            window['-Nin-'].update('N_in = {0}'.format(Nin))
-            window['-GMAG-'].update(Gmag)
-            window['-GID-'].update(Gid)
-            window['-MLIM-'].update(tpf_params[1])
         except:
             warnings.warn('TPF not found.',Warning)
             sg.Popup('TPF not found',title='Warning',keep_on_top=True)
+        else:
+            # TPF, coordinates and Gaia sources are fetched in the background (or were
+            # already prefetched), the plot is made here
+            start_job('tpf', get_tpf, TIC_tpf, sec_tpf, tpf_params[0], tpf_params[2],
+                      maglim=tpf_params[1], TIC=TIC_tpf)
+
+    elif event == '-JOB_DONE-':
+        kind, seq, result, error = values[event]
+        if kind not in running or running[kind][0] != seq:
+            # Stale: cancelled or superseded by a newer job
+            continue
+        context = running.pop(kind)[1]
+        update_status()
+        if kind == 'lc':
+            if error is not None:
+                warnings.warn('Light curve download failed: {0}'.format(error),Warning)
+                sg.Popup('Light curve download failed: {0}'.format(error),title='Warning',keep_on_top=True)
+            elif result is None:
+                # Warn if no light curve is found
+                warnings.warn('Light curve for TIC {0} sector {1} not found'.format(context['TIC'],context['sec']),Warning)
+                sg.Popup('Light curve for TIC {0} sector {1} not found'.format(context['TIC'],context['sec']), 
+                         title='Warning',keep_on_top=True)
+            else:
+                lcs, TIC, sec = result, context['TIC'], context['sec']
+                # Drawn as min/max envelopes, recomputed when zooming with the toolbar.
+                # The figures of the previous target are updated in place.
+                fig_lc_pdc = fn.plot_lc(lcs['PDCSAP'],decimate=True,
+                                        fig=tkfigures.panel_for(window['-PDC_LIGHTCURVE-'].TKCanvas).fig)
+                tkfigures.draw_figure_w_toolbar(window['-PDC_LIGHTCURVE-'].TKCanvas, fig_lc_pdc, window['CONTROLS_PDC'].TKCanvas)
+                fig_lc_sap = fn.plot_lc(lcs['SAP'],decimate=True,
+                                        fig=tkfigures.panel_for(window['-SAP_LIGHTCURVE-'].TKCanvas).fig)
+                tkfigures.draw_figure_w_toolbar(window['-SAP_LIGHTCURVE-'].TKCanvas, fig_lc_sap, window['CONTROLS_SAP'].TKCanvas)
+        elif kind == 'periodogram':
+            if error is not None:
+                warnings.warn('Periodogram failed: {0}'.format(error),Warning)
+                sg.Popup('Periodogram failed: {0}'.format(error),title='Warning',
+                         keep_on_top=True )
+                continue
+            new_periodogram, Pbeg, Pend = result
+            window['-PBEG-'].update(Pbeg)
+            window['-PEND-'].update(Pend)
+            # Plot periodogram
+            fig_period,new_best_period,period_error,fap = fn.plot_periodogram(new_periodogram,
+                                                              TIC,sec,Pbeg=Pbeg,Pend=Pend,N=context['Npeaks'],
+                                                              fig=tkfigures.panel_for(window['-PERIODOGRAM-'].TKCanvas).fig)
+            DPI = fig_period.get_dpi()
+            fig_period.set_size_inches(360*1.5 / float(DPI), 360 / float(DPI))
+            tkfigures.draw_figure_w_toolbar(window['-PERIODOGRAM-'].TKCanvas, fig_period, window['CONTROLS_Periodogram'].TKCanvas)
+            #fig_canvas_per = tkfigures.draw_figure(window['-PERIODOGRAM-'].TKCanvas, fig_period)
+            new_periods, heights = fn.periodogram_peaks(new_periodogram,N_peaks=3)
+            # Set together once the plot and peaks are done, so Fold never uses a
+            # periodogram without its periods (or those of the previous one)
+            periodogram, best_period, periods, lc = new_periodogram, new_best_period, new_periods, context['lc']
+            # Print periodogram information
+            window['-BESTPERIOD-'].update('P={0} d'.format(round(best_period,4)))
+            if round(fap,4) > 0:
+                window['-FAP-'].update('FAP={0}'.format(round(fap,4)))
+            else:
+                window['-FAP-'].update('FAP<10^{-4}')
+            window['-2P-'].update('2P={0} d'.format(round(2*best_period,4)))
+            window['-P/2-'].update('P/2={0} d'.format(round(best_period/2,4)))
+            
+            i = 0 
+            while i <= len(periods)-1 and i < 4:
+                window['-P_{0}-'.format(i+2)].update('P_{1}={0} d'.format(round(periods[i],4),i+2))
+                i += 1
+        elif kind == 'tpf':
+            try:
+                if error is not None:
+                    raise error
+                fig_tpf, data_tpf = tpfplotter.plot_tpf(result,maglim=context['maglim'],SAVEGAIA=True)
+                fig_canvas_tpf = tkfigures.draw_figure(window['-TPF-'].TKCanvas,fig_tpf)
+                FG_frac, Gmag, Gid, Nin = fn.get_poll(data_tpf)
+                window['-GFRAC-'].update('FG_frac = {0}'.format(round(FG_frac,4)))
+                window['-Nin-'].update('N_in = {0}'.format(Nin))
+                window['-GMAG-'].update(Gmag)
+                window['-GID-'].update(Gid)
+                window['-MLIM-'].update(context['maglim'])
+            except (Exception, SystemExit):
+                warnings.warn('TPF not found.',Warning)
+                sg.Popup('TPF not found',title='Warning',keep_on_top=True)
 window.close()
+if PROFILE:
+    profiling.close(driver='gui')
+    print(profiling.summary(profiling.read(PROFILE)))
 
 # --------------------------- End of event loop ------------------------------#
-
-
-
-
-
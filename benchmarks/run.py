@@ -0,0 +1,304 @@
+"""
+Offline benchmarks of the pipeline on synthetic data (see synthetic.py).
+
+Times get_periodogram (each engine), periodogram_peaks, plot_periodogram,
+fold_lc, tpfplotter.tpfplotter and summary_pdf on light curves from one
+sector at 2 min cadence up to three stitched sectors at 20 s cadence, and
+on TPFs in Gaia fields of several crowdings. The tesscut cases time the FFI
+cut outs of targets without a TPF (cut from a synthetic FFI cube) through the
+cut out cache: a miss, a hit, and a neighbouring target served from the
+larger cut out fetched for the first one. No remote service is used.
+The import cases time the import of the terminal version and its modules in
+a new interpreter and check that it does not load the heavy or GUI-only
+modules (HEAVY_MODULES), which are only imported by the stages that use them.
+
+Each case runs in a new process, so that its peak memory (RSS) is its own.
+After one untimed run (imports, font cache...) the case is repeated and the
+best and median wall times are kept, together with the time of each stage
+of the pipeline (profiling.py) and the peak RSS.
+
+    python benchmarks/run.py                            # run everything, print a table
+    python benchmarks/run.py --save baseline.json       # record a baseline
+    python benchmarks/run.py --compare baseline.json    # exit status 1 on regressions
+    python benchmarks/run.py --cases periodogram --sizes 1x120s
+
+A case regresses when its best time is more than --tolerance (relative)
+slower than in the baseline, or its peak RSS grew by as much (and by more than
+a small absolute margin, to ignore noise), or an import case loads a heavy
+module it did not load before. Baselines are only comparable on the same
+machine.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import synthetic
+
+DATA_DIR = os.path.join(tempfile.gettempdir(), 'tessdiag-benchmark-data')
+# The direct periodogram engines are only run on light curves up to this size
+DIRECT_MAX = 25000
+ENGINES = ('gls', 'numpy', 'fft')
+FETCH_SIZE = 40         # pixels, cut outs fetched by the tesscut/neighbour case
+MIN_DELTA = 0.02        # s, slower runs within this margin are not regressions
+MIN_MEMORY = 10.        # MB, idem for the memory
+IMPORT_MODULES = ('TESSdiagnosis', 'functions', 'tpfplotter')
+# Modules the terminal version must not load when it starts
+HEAVY_MODULES = ('lightkurve', 'astroquery', 'astropy.coordinates', 'bokeh', 'gls', 'pandas', 'tkinter',
+                 'matplotlib.backends.backend_tkagg')
+
+
+def case_list(targets, sizes=None, crowding=None, engines=ENGINES):
+    """(name, kind, target, engine) of every case on the given data."""
+    cases = [('import/{0}'.format(module), 'import', module, None) for module in IMPORT_MODULES]
+    for size, (tic, sectors) in sorted(targets['lc'].items()):
+        if sizes is not None and size not in sizes:
+            continue
+        nsectors, cadence = synthetic.SIZES[size]
+        points = nsectors * synthetic.SECTOR_DAYS * 86400 / cadence
+        for engine in engines:
+            if engine == 'fft' or points <= DIRECT_MAX:
+                cases.append(('get_periodogram/{0}/{1}'.format(engine, size), 'periodogram', size, engine))
+        for kind in ('periodogram_peaks', 'plot_periodogram', 'fold_lc', 'fold_lc_binned'):
+            cases.append(('{0}/{1}'.format(kind, size), kind, size, None))
+    for level in sorted(targets['field'], key=lambda level: synthetic.CROWDING.get(level, 0)):
+        if crowding is None or level in crowding:
+            cases.append(('tpfplotter/{0}'.format(level), 'tpfplotter', level, None))
+    if crowding is None or 'medium' in crowding:
+        cases.append(('summary_pdf', 'summary_pdf', 'medium', None))
+    if targets.get('ffi'):
+        for target in ('miss', 'hit', 'neighbour'):
+            cases.append(('tesscut/{0}'.format(target), 'tesscut', target, None))
+        cases.append(('tpfplotter/ffi', 'tpfplotter', 'ffi', None))
+    return cases
+
+
+def _light_curve(targets, size):
+    import functions as fn
+    tic, sectors = targets['lc'][size]
+    if len(sectors) > 1:
+        return tic, 'all', fn.load_stitched_lc(tic)
+    return tic, sectors[0], fn.load_lc(tic, sectors[0])
+
+
+def _best_period(periodogram):
+    import numpy as np
+    return 1 / periodogram.freq[np.argmax(periodogram.power)]
+
+
+def prepare(kind, target, engine, targets):
+    # Everything a case needs but does not time; returns the function to time
+    import functions as fn
+    import tpfplotter
+    if kind == 'tesscut':
+        import datasource
+        import cutoutcache
+        (first, sector), (neighbour, _) = targets['ffi'][:2]
+        source = datasource.get_source()
+        # The neighbour is served from the cut out of FETCH_SIZE pixels fetched for the first target
+        cache = cutoutcache.set_cache(os.path.abspath('cutouts'), fetch_size=FETCH_SIZE if target == 'neighbour' else 0)
+        cache.clear()
+        if target == 'miss':
+            def miss():
+                cache.clear()
+                return source.tesscut('TIC {0}'.format(first), sector=sector)
+            return miss
+        source.tesscut('TIC {0}'.format(first), sector=sector)
+        tic = neighbour if target == 'neighbour' else first
+        return lambda: source.tesscut('TIC {0}'.format(tic), sector=sector)
+    if kind == 'tpfplotter' or kind == 'summary_pdf':
+        tic, sector = targets['ffi'][0] if target == 'ffi' else targets['field'][target]
+        tic, sector = str(tic), str(sector)
+        if kind == 'tpfplotter':
+            return lambda: tpfplotter.tpfplotter(tic, sector=sector, SAVEGAIA=True, savefig=True, fontcolor='black')
+        # The four plots summary_pdf puts together
+        lc = fn.get_lc(tic, sector)
+        periodogram, Pbeg, Pend = fn.get_periodogram(lc, engine='fft')
+        fig, period, error, fap = fn.plot_periodogram(periodogram, tic, sector, Pbeg=Pbeg, Pend=Pend, savefig=True)
+        fn.fold_lc(lc, period, tic, sector, savefig=True)
+        tpfplotter.tpfplotter(tic, sector=sector, SAVEGAIA=True, savefig=True, fontcolor='black')
+        return lambda: fn.summary_pdf(tic, sector, period, error, fap)
+    tic, sector, lc = _light_curve(targets, target)
+    if kind == 'periodogram':
+        return lambda: fn.get_periodogram(lc, engine=engine)
+    periodogram, Pbeg, Pend = fn.get_periodogram(lc, engine='fft')
+    if kind == 'periodogram_peaks':
+        return lambda: fn.periodogram_peaks(periodogram, N_peaks=3)
+    if kind == 'plot_periodogram':
+        return lambda: fn.plot_periodogram(periodogram, tic, sector, Pbeg=Pbeg, Pend=Pend, savefig=True)
+    period = _best_period(periodogram)
+    if kind == 'fold_lc':
+        return lambda: fn.fold_lc(lc, period, tic, sector, savefig=True)
+    if kind == 'fold_lc_binned':
+        return lambda: fn.fold_lc(lc, period, tic, sector, savefig=True, binned=True)
+    raise ValueError('Unknown benchmark: {0}'.format(kind))
+
+
+def time_import(module):
+    # Import time of module in a new interpreter, and the HEAVY_MODULES it loaded
+    code = ('import sys, time, json\n'
+            't = time.perf_counter()\n'
+            'import {0}\n'
+            't = time.perf_counter() - t\n'
+            'print(json.dumps([t, [m for m in {1!r} if m in sys.modules]]))').format(module, HEAVY_MODULES)
+    path = [ROOT] + [p for p in os.environ.get('PYTHONPATH', '').split(os.pathsep) if p]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path))
+    out = subprocess.run([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE, check=True,
+                         universal_newlines=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def run_case(case, data_dir, work_dir, repeat=3, warmup=1):
+    """Run one case (in a worker process) and return its timings."""
+    import warnings
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import numpy as np
+    import profiling
+    warnings.simplefilter('ignore')
+    name, kind, target, engine = case
+    if kind == 'import':
+        # The first import also fills the OS file cache and writes the .pyc files
+        runs = [time_import(target) for i in range(warmup + repeat)][warmup:]
+        times = [t for t, heavy in runs]
+        return {'kind': kind, 'target': target, 'engine': None, 'times': times, 'best': min(times),
+                'median': float(np.median(times)), 'stages': {}, 'remote_calls': 0,
+                'peak_rss_mb': None, 'heavy_modules': runs[-1][1]}
+    targets = synthetic.make_data(data_dir)
+    synthetic.use_data(data_dir)
+    os.chdir(work_dir)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        func = prepare(kind, target, engine, targets)
+        for i in range(warmup):
+            func()
+            plt.close('all')
+        profiling.enable()
+        times, stages, calls = [], {}, 0
+        for i in range(repeat):
+            with profiling.target(case=name) as record:
+                start = time.perf_counter()
+                func()
+                times.append(time.perf_counter() - start)
+            plt.close('all')
+            calls += record.record['calls']
+            for stage, values in record.record['stages'].items():
+                stages[stage] = stages.get(stage, 0) + values['wall'] / repeat
+    return {'kind': kind, 'target': target, 'engine': engine, 'times': times, 'best': min(times),
+            'median': float(np.median(times)), 'stages': stages, 'remote_calls': calls,
+            'peak_rss_mb': profiling.peak_rss()}
+
+
+def machine():
+    import numpy as np
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'cpus': os.cpu_count(), 'processor': platform.processor()}
+
+
+def compare(results, baseline, tolerance):
+    """Lines of the comparison table and the names of the cases that regressed."""
+    lines = ['{0:<34s} {1:>9s} {2:>9s} {3:>7s} {4:>9s} {5:>9s}'.format(
+        'case', 'best [s]', 'base [s]', 'ratio', 'RSS [MB]', 'base [MB]')]
+    regressions = []
+    for name, result in results.items():
+        base = baseline['cases'].get(name)
+        if base is None:
+            lines.append('{0:<34s} {1:9.3f} {2:>9s}'.format(name, result['best'], 'new'))
+            continue
+        ratio = result['best'] / base['best']
+        slower = result['best'] > base['best'] * (1 + tolerance) and result['best'] - base['best'] > MIN_DELTA
+        mem, base_mem = result.get('peak_rss_mb'), base.get('peak_rss_mb')
+        bigger = (mem is not None and base_mem is not None and mem > base_mem * (1 + tolerance) and
+                  mem - base_mem > MIN_MEMORY)
+        imports = sorted(set(result.get('heavy_modules', [])) - set(base.get('heavy_modules', [])))
+        if slower or bigger or imports:
+            regressions.append(name)
+        lines.append('{0:<34s} {1:9.3f} {2:9.3f} {3:7.2f} {4:>9s} {5:>9s}{6}'.format(
+            name, result['best'], base['best'], ratio, _mb(mem), _mb(base_mem),
+            '  SLOWER' * slower + '  MEMORY' * bigger + ''.join('  IMPORTS ' + m for m in imports)))
+    return lines, regressions
+
+
+def _mb(value):
+    return '-' if value is None else '{0:.1f}'.format(value)
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Offline benchmarks on synthetic data')
+    parser.add_argument('--data', help='Directory of the synthetic data (written if missing)', default=DATA_DIR)
+    parser.add_argument('--cases', help='Only the cases whose name contains one of these strings', nargs='+')
+    parser.add_argument('--sizes', help='Light curve sizes', nargs='+', choices=sorted(synthetic.SIZES))
+    parser.add_argument('--crowding', help='TPF field crowdings', nargs='+', choices=sorted(synthetic.CROWDING))
+    parser.add_argument('--engines', help='Periodogram engines', nargs='+', choices=ENGINES, default=ENGINES)
+    parser.add_argument('--repeat', help='Timed runs of each case', type=int, default=3)
+    parser.add_argument('--warmup', help='Untimed runs of each case before the timed ones', type=int, default=1)
+    parser.add_argument('--save', help='Write the results to this JSON file (a baseline)')
+    parser.add_argument('--compare', help='Baseline JSON file to compare the results with')
+    parser.add_argument('--tolerance', help='Relative slowdown (or memory growth) counted as a regression',
+                        type=float, default=0.25)
+    parser.add_argument('--list', help='List the cases and exit', action='store_true')
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    return args
+
+
+def main():
+    args = get_arguments()
+    print('Synthetic data in {0}'.format(args.data))
+    targets = synthetic.make_data(args.data)
+    cases = case_list(targets, args.sizes, args.crowding, args.engines)
+    if args.cases:
+        cases = [case for case in cases if any(pattern in case[0] for pattern in args.cases)]
+    if args.list:
+        for case in cases:
+            print(case[0])
+        return
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as work_dir:
+        for case in cases:
+            # One process per case, so that the peak memory is that of the case
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                result = pool.submit(run_case, case, args.data, work_dir, args.repeat, args.warmup).result()
+            results[case[0]] = result
+            stages = ', '.join('{0} {1:.3f}'.format(stage, wall) for stage, wall in
+                               sorted(result['stages'].items(), key=lambda item: -item[1])[:4])
+            print('{0:<34s} best {1:8.3f} s  median {2:8.3f} s  RSS {3:>7s} MB  ({4})'.format(
+                case[0], result['best'], result['median'], _mb(result['peak_rss_mb']), stages))
+            if result['remote_calls']:
+                print('    warning: {0} remote calls'.format(result['remote_calls']))
+            if result.get('heavy_modules'):
+                print('    warning: imports {0}'.format(', '.join(result['heavy_modules'])))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'machine': machine(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'repeat': args.repeat, 'cases': results}, f, indent=1)
+        print('Results saved to {0}'.format(args.save))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('machine', {}).get('platform') != machine()['platform']:
+            print('warning: the baseline was recorded on another machine')
+        lines, regressions = compare(results, baseline, args.tolerance)
+        print('\n'.join(lines))
+        if regressions:
+            print('{0} regressions: {1}'.format(len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+        print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
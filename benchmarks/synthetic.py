@@ -0,0 +1,435 @@
+"""
+Synthetic TESS data for the benchmarks, and the local stand-ins serving it.
+
+make_data writes to a directory:
+
+- light curve files of spotted stars (SPOC names and columns) of one or
+  several consecutive sectors, at 2 min or 20 s cadence, with the TESS gaps:
+  the mid-sector downlink and flagged cadences at the momentum dumps;
+- target pixel files of stars in Gaia fields of several crowdings, with their
+  light curve;
+- an FFI cube (in the layout of the astrocut cubes TESScut cuts from) of a
+  field with a few targets that have no TPF;
+- a Gaia store (gaiacat) with the sources of those fields and a TIC table
+  (ticcat) with all the targets.
+
+use_data then points datasource, gaiacat, ticcat, lccache and cutoutcache to
+them, so the whole pipeline runs without MAST or Vizier: FFICubeSource reads
+the mirror and stands in for TESScut, cutting the FFI cut outs from the cube. Everything is drawn from a seed,
+so the same data is written on every machine.
+"""
+
+import os
+import json
+
+import numpy as np
+
+import datasource
+import profiling
+
+SECTOR_DAYS = 27.4
+ORBIT_GAP = 1.0             # days of downlink in the middle of a sector
+DUMP_EVERY = 3.125          # days between momentum dumps
+FIRST_SECTOR_START = 1325.3     # BTJD
+PIX_SCALE = 21.0            # arcsec / pixel
+
+# name: (sectors, cadence in s)
+SIZES = {'1x120s': (1, 120), '1x20s': (1, 20), '3x120s': (3, 120), '3x20s': (3, 20)}
+# Gaia sources within the TPF query radius (see tpfplotter.query_tpf_field)
+CROWDING = {'sparse': 10, 'medium': 100, 'dense': 1000}
+TPF_SHAPE = (11, 11)
+
+# FFI cube: (rows, columns) and cadence in s, and the pixels (row, column) of its
+# targets. The first three are neighbours (a cut out of 40 pixels around the
+# first one contains the others), the last one is further away.
+FFI_SHAPE = (64, 64)
+FFI_CADENCE = 1800
+FFI_TARGETS = [(20, 20), (20, 30), (30, 20), (46, 46)]
+FFI_WCS_KEYS = ('CTYPE1', 'CTYPE2', 'CRPIX1', 'CRPIX2', 'CRVAL1', 'CRVAL2', 'CDELT1', 'CDELT2',
+                'PC1_1', 'PC1_2', 'PC2_1', 'PC2_2')
+
+TIC_BASE = 900000000        # TICs of the synthetic targets: TIC_BASE + index
+GAIA_BASE = 5000000000000000000
+FORMAT = 2                  # version of the files written by make_data
+
+
+def sector_times(sector, cadence):
+    """
+    Times (BTJD) of the cadences of a sector and their QUALITY flags: the
+    downlink gap is left out, momentum dumps are flagged (32).
+    """
+    start = FIRST_SECTOR_START + (sector - 1) * SECTOR_DAYS
+    time = np.arange(start, start + SECTOR_DAYS, cadence / 86400.)
+    middle = start + SECTOR_DAYS / 2
+    time = time[np.abs(time - middle) > ORBIT_GAP / 2]
+    quality = np.zeros(len(time), dtype=np.int32)
+    dumps = np.arange(start + DUMP_EVERY, start + SECTOR_DAYS, DUMP_EVERY)
+    near = np.abs(time[:, None] - dumps[None, :]).min(axis=1) < 10 / 1440.
+    quality[near] = 32
+    return time, quality
+
+
+def spotted_star(time, rng, period=None, n_spots=3, cadence=120):
+    """
+    Relative flux of a rotating spotted star: spots with slightly different
+    periods (differential rotation) and growing and decaying areas, plus
+    granulation (red) noise, white noise and a few flares.
+    """
+    if period is None:
+        period = rng.uniform(0.5, 12)
+    flux = np.ones(len(time))
+    t0 = time[0]
+    span = time[-1] - t0
+    for k in range(n_spots):
+        p = period * (1 + rng.uniform(-0.02, 0.02))
+        phase = rng.uniform(0, 2 * np.pi)
+        latitude = np.cos(rng.uniform(0, np.pi / 3))
+        depth = rng.uniform(0.002, 0.01)
+        peak, life = t0 + rng.uniform(0, span), rng.uniform(10, 40)
+        area = depth * np.exp(-((time - peak) / life) ** 2)
+        # Projected area of the spot, hidden behind the limb half of the time
+        flux -= area * latitude * np.clip(np.cos(2 * np.pi * (time - t0) / p + phase), 0, None)
+    # Granulation: AR(1) noise with a correlation time of ~1 h
+    alpha = np.exp(-cadence / 3600.)
+    from scipy.signal import lfilter
+    steps = rng.normal(0, 1e-4 * np.sqrt(1 - alpha ** 2), len(time))
+    flux += lfilter([1.], [1., -alpha], steps)
+    flux += rng.normal(0, 3e-4 * np.sqrt(120. / cadence), len(time))
+    for start in t0 + rng.uniform(0, span, rng.integers(0, 4)):
+        after = time >= start
+        flux[after] += rng.uniform(0.002, 0.02) * np.exp(-(time[after] - start) / rng.uniform(0.01, 0.05))
+    return flux, period
+
+
+def write_lc(path, tic, sector, time, flux, quality, level=10000., cadence=120):
+    # SPOC light curve file with the columns functions.extract_lc reads
+    from astropy.io import fits
+    n = len(time)
+    pdcsap = flux * level
+    pdcsap[quality > 0] = np.nan
+    error = np.full(n, level * 3e-4 * np.sqrt(120. / cadence))
+    primary = fits.PrimaryHDU()
+    primary.header.update({'TELESCOP': 'TESS', 'CREATOR': 'lightcurve', 'ORIGIN': 'NASA/Ames',
+                           'TICID': tic, 'SECTOR': sector, 'OBJECT': 'TIC {0}'.format(tic)})
+    columns = [fits.Column('TIME', 'D', array=time),
+               fits.Column('SAP_FLUX', 'E', array=pdcsap * 1.05),
+               fits.Column('SAP_FLUX_ERR', 'E', array=error),
+               fits.Column('PDCSAP_FLUX', 'E', array=pdcsap),
+               fits.Column('PDCSAP_FLUX_ERR', 'E', array=error),
+               fits.Column('QUALITY', 'J', array=quality)]
+    table = fits.BinTableHDU.from_columns(columns)
+    table.header.update({'EXTNAME': 'LIGHTCURVE', 'TIMEUNIT': 'd', 'BJDREFI': 2457000, 'BJDREFF': 0.,
+                         'TIMESYS': 'TDB'})
+    fits.HDUList([primary, table]).writeto(path, overwrite=True)
+
+
+def gaia_field(ra, dec, n_sources, target_gaia, target_mag, rng):
+    """
+    Gaia sources (dict of the gaiacat.COLUMNS) within the TPF query radius of
+    (ra, dec): the target at the centre and n_sources field stars, fainter
+    ones more numerous.
+    """
+    radius = np.max(TPF_SHAPE) * PIX_SCALE / 3600.
+    r = radius * np.sqrt(rng.uniform(0, 1, n_sources))
+    theta = rng.uniform(0, 2 * np.pi, n_sources)
+    gmag = target_mag + 8 - 2.5 * np.log10(rng.uniform(1e-4, 1, n_sources))
+    gmag = np.minimum(gmag, 21.)
+    gmag[:max(1, n_sources // 50)] = target_mag + rng.uniform(-1, 4, max(1, n_sources // 50))
+    return {'RA_ICRS': np.r_[ra, ra + r * np.cos(theta) / np.cos(np.deg2rad(dec))],
+            'DE_ICRS': np.r_[dec, dec + r * np.sin(theta)],
+            'Source': np.r_[target_gaia, target_gaia + 10**6 * np.arange(1, n_sources + 1)],
+            'Plx': np.r_[5., rng.uniform(0.1, 3, n_sources)],
+            'pmRA': np.r_[10., rng.normal(0, 5, n_sources)],
+            'pmDE': np.r_[-10., rng.normal(0, 5, n_sources)],
+            'Gmag': np.r_[target_mag, gmag]}
+
+
+def write_tpf(path, tic, sector, time, quality, flux, field, level=10000.):
+    """
+    Target pixel file of the star at the centre of the field: each Gaia source
+    is a Gaussian PSF scaled by its G magnitude, the target varies as flux.
+    """
+    from lightkurve.targetpixelfile import TargetPixelFileFactory
+    rows, cols = TPF_SHAPE
+    ra, dec = field['RA_ICRS'][0], field['DE_ICRS'][0]
+    scale = PIX_SCALE / 3600.
+    x = (cols - 1) / 2. - (field['RA_ICRS'] - ra) * np.cos(np.deg2rad(dec)) / scale
+    y = (rows - 1) / 2. + (field['DE_ICRS'] - dec) / scale
+    yy, xx = np.mgrid[:rows, :cols]
+    weights = level * 10 ** (-0.4 * (field['Gmag'] - field['Gmag'][0]))
+    psfs = np.exp(-((xx[None] - x[:, None, None]) ** 2 + (yy[None] - y[:, None, None]) ** 2) / (2 * 0.8 ** 2))
+    psfs /= 2 * np.pi * 0.8 ** 2
+    target, others = psfs[0] * weights[0], (psfs[1:] * weights[1:, None, None]).sum(axis=0)
+    factory = TargetPixelFileFactory(n_cadences=len(time), n_rows=rows, n_cols=cols, target_id=tic)
+    rng = np.random.default_rng(tic)
+    noise = np.sqrt(target + others + 100.)
+    flux = np.where(np.isfinite(flux), flux, 1.)
+    factory.flux = (target[None] * flux[:, None, None] + others[None] + 100. +
+                    rng.normal(0, 1, (len(time),) + TPF_SHAPE) * noise[None]).astype(np.float32)
+    factory.flux_err = np.broadcast_to(noise, factory.flux.shape).astype(np.float32)
+    factory.flux_bkg = np.full(factory.flux.shape, 100., dtype=np.float32)
+    factory.flux_bkg_err = np.full(factory.flux.shape, 10., dtype=np.float32)
+    factory.raw_cnts = factory.flux.astype(np.int32)
+    factory.cosmic_rays = np.zeros(factory.flux.shape, dtype=np.float32)
+    factory.time = time
+    factory.cadenceno = np.arange(len(time))
+    factory.quality = quality
+    wcs = {'1CTYP5': 'RA---TAN', '2CTYP5': 'DEC--TAN', '1CRPX5': cols / 2. + 0.5, '2CRPX5': rows / 2. + 0.5,
+           '1CRVL5': ra, '2CRVL5': dec, '1CDLT5': -scale, '2CDLT5': scale,
+           '11PC5': 1., '12PC5': 0., '21PC5': 0., '22PC5': 1., '1CRV5P': 500, '2CRV5P': 700}
+    tpf = factory.get_tpf(hdu0_keywords={'TELESCOP': 'TESS', 'INSTRUME': 'TESS Photometer',
+                                         'OBJECT': 'TIC {0}'.format(tic), 'TICID': tic, 'SECTOR': sector,
+                                         'CAMERA': 1, 'CCD': 2, 'RA_OBJ': ra, 'DEC_OBJ': dec,
+                                         'CREATOR': 'TargetPixelExporterPipelineModule',
+                                         'ORIGIN': 'NASA/Ames', 'MISSION': 'TESS'}, ext_info=wcs)
+    hdul = tpf.hdu
+    hdul[1].header.update({'EXTNAME': 'PIXELS', 'BJDREFI': 2457000, 'BJDREFF': 0., 'TIMESYS': 'TDB'})
+    hdul[1].header.update(wcs)
+    hdul[2].header.update({'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN', 'CRPIX1': cols / 2. + 0.5,
+                           'CRPIX2': rows / 2. + 0.5, 'CRVAL1': ra, 'CRVAL2': dec, 'CDELT1': -scale,
+                           'CDELT2': scale, 'PC1_1': 1., 'PC1_2': 0., 'PC2_1': 0., 'PC2_2': 1.})
+    # Pipeline aperture: the pixels within 2 of the centre (bits 1 and 2)
+    mask = np.ones(TPF_SHAPE, dtype=np.int32)
+    mask[(xx - cols // 2) ** 2 + (yy - rows // 2) ** 2 <= 4] = 3
+    hdul[2].data = mask
+    hdul.writeto(path, overwrite=True)
+
+
+def ffi_wcs(ra, dec):
+    # WCS keywords of an FFI centred on (ra, dec)
+    rows, cols = FFI_SHAPE
+    scale = PIX_SCALE / 3600.
+    return {'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN', 'CRPIX1': cols / 2. + 0.5, 'CRPIX2': rows / 2. + 0.5,
+            'CRVAL1': ra, 'CRVAL2': dec, 'CDELT1': -scale, 'CDELT2': scale,
+            'PC1_1': 1., 'PC1_2': 0., 'PC2_1': 0., 'PC2_2': 1.}
+
+
+def write_ffi_cube(path, sector, time, quality, wcs, sources, variables, level=10000.):
+    """
+    FFI cube in the astrocut layout: the images in an array of (rows, columns,
+    cadences, [flux, error]) and, in a table, the TSTART, TSTOP and DQUALITY
+    of each image and its WCS keywords. Each Gaia source (dict of columns) is
+    a Gaussian PSF scaled by its G magnitude; variables maps the index of a
+    source to its relative flux.
+    """
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    rows, cols = FFI_SHAPE
+    x, y = WCS(fits.Header(wcs)).all_world2pix(sources['RA_ICRS'], sources['DE_ICRS'], 0)
+    yy, xx = np.mgrid[:rows, :cols]
+    weights = level * 10 ** (-0.4 * (sources['Gmag'] - np.min(sources['Gmag'])))
+    image = np.full(FFI_SHAPE, 100.)
+    for i in range(len(x)):
+        image += weights[i] * np.exp(-((xx - x[i]) ** 2 + (yy - y[i]) ** 2) / (2 * 0.8 ** 2)) / (2 * np.pi * 0.8 ** 2)
+    noise = np.sqrt(image)
+    cube = np.empty(FFI_SHAPE + (len(time), 2), dtype=np.float32)
+    rng = np.random.default_rng(sector)
+    flux = image[:, :, None] + rng.normal(0, 1, FFI_SHAPE + (len(time),)) * noise[:, :, None]
+    for i, relative in variables.items():
+        psf = np.exp(-((xx - x[i]) ** 2 + (yy - y[i]) ** 2) / (2 * 0.8 ** 2)) / (2 * np.pi * 0.8 ** 2)
+        flux += (weights[i] * psf)[:, :, None] * (np.where(np.isfinite(relative), relative, 1.) - 1)[None, None, :]
+    cube[..., 0] = flux
+    cube[..., 1] = noise[:, :, None]
+    primary = fits.PrimaryHDU()
+    primary.header.update({'TELESCOP': 'TESS', 'ORIGIN': 'STScI/MAST', 'SECTOR': sector, 'CAMERA': 1, 'CCD': 2})
+    half = FFI_CADENCE / 86400. / 2
+    columns = [fits.Column('TSTART', 'D', array=time - half), fits.Column('TSTOP', 'D', array=time + half),
+               fits.Column('DQUALITY', 'J', array=quality)]
+    for key in FFI_WCS_KEYS:
+        value = wcs[key]
+        columns.append(fits.Column(key, '8A' if isinstance(value, str) else 'D', array=[value] * len(time)))
+    fits.HDUList([primary, fits.ImageHDU(cube), fits.BinTableHDU.from_columns(columns)]).writeto(path, overwrite=True)
+
+
+def cut_cube(cube_path, ra, dec, cutout_size, path):
+    """
+    TESScut cut out (TPF) of cutout_size (rows, columns) pixels around (ra,
+    dec) from an FFI cube of write_ffi_cube, with the WCS of its middle image,
+    as astrocut does. Raises ValueError if the cut out does not fit in the FFI.
+    """
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    from lightkurve.targetpixelfile import TargetPixelFileFactory
+    import cutoutcache
+    rows, cols = (cutout_size, cutout_size) if np.isscalar(cutout_size) else cutout_size
+    with fits.open(cube_path) as cube:
+        info = cube[2].data
+        header = cube[0].header
+        middle = len(info) // 2
+        wcs = {key: (str(info[key][middle]) if key.startswith('CTYPE') else float(info[key][middle]))
+               for key in FFI_WCS_KEYS}
+        row, column = cutoutcache.footprint(WCS(fits.Header(wcs)), ra, dec, (rows, cols))
+        if row < 0 or column < 0 or row + rows > FFI_SHAPE[0] or column + cols > FFI_SHAPE[1]:
+            raise ValueError('The cut out does not fit in the FFI')
+        pixels = np.array(cube[1].data[row:row + rows, column:column + cols]).transpose(2, 0, 1, 3)
+        time = (info['TSTART'] + info['TSTOP']) / 2.
+        quality = np.array(info['DQUALITY'])
+        sector, camera, ccd = header['SECTOR'], header['CAMERA'], header['CCD']
+    factory = TargetPixelFileFactory(n_cadences=len(time), n_rows=rows, n_cols=cols)
+    factory.flux = pixels[..., 0]
+    factory.flux_err = pixels[..., 1]
+    factory.flux_bkg = np.zeros(factory.flux.shape, dtype=np.float32)
+    factory.flux_bkg_err = np.zeros(factory.flux.shape, dtype=np.float32)
+    factory.raw_cnts = np.zeros(factory.flux.shape, dtype=np.int32)
+    factory.cosmic_rays = np.zeros(factory.flux.shape, dtype=np.float32)
+    factory.time = time
+    factory.cadenceno = np.arange(len(time))
+    factory.quality = quality
+    tpf = factory.get_tpf(hdu0_keywords={'TELESCOP': 'TESS', 'INSTRUME': 'TESS Photometer', 'CREATOR': 'astrocut',
+                                         'SECTOR': sector, 'CAMERA': camera, 'CCD': ccd, 'RA_OBJ': ra, 'DEC_OBJ': dec})
+    hdul = tpf.hdu
+    hdul[0].header['ORIGIN'] = 'STScI/MAST'
+    hdul[1].header.update({'EXTNAME': 'PIXELS', 'BJDREFI': 2457000, 'BJDREFF': 0., 'TIMESYS': 'TDB'})
+    # CCD column and row of the first pixel (1-based), for each pixel column of the table
+    for n in range(4, 10):
+        hdul[1].header.update({'1CRV{0}P'.format(n): column + 1, '2CRV{0}P'.format(n): row + 1})
+    wcs.update({'CRPIX1': wcs['CRPIX1'] - column, 'CRPIX2': wcs['CRPIX2'] - row, 'WCSNAMEP': 'PHYSICAL',
+                'CTYPE1P': 'RAWX', 'CTYPE2P': 'RAWY', 'CRPIX1P': 1, 'CRPIX2P': 1,
+                'CRVAL1P': column + 1, 'CRVAL2P': row + 1, 'CDELT1P': 1., 'CDELT2P': 1.})
+    hdul[2].header.update(wcs)
+    hdul[2].data = np.ones((rows, cols), dtype=np.int32)
+    hdul.writeto(path, overwrite=True)
+
+
+def spoc_name(kind, tic, sector):
+    return 'tess2020000000000-s{0:04d}-{1:016d}-0000-s_{2}.fits'.format(sector, tic, kind)
+
+
+def make_data(path, sizes=SIZES, crowding=CROWDING, seed=42):
+    """
+    Write the synthetic data to path (see the module docstring), unless the
+    data of the same sizes, crowdings and seed is already there.
+
+    Returns
+    -------
+    dict with the targets: 'lc' maps each size to (TIC, sectors), 'field' each
+    crowding to (TIC, sector), 'ffi' is the list of (TIC, sector) of the FFI
+    cube (in the order of FFI_TARGETS)
+    """
+    manifest_file = os.path.join(path, 'manifest.json')
+    config = {'format': FORMAT, 'seed': seed, 'sizes': {name: list(sizes[name]) for name in sorted(sizes)},
+              'crowding': {name: crowding[name] for name in sorted(crowding)}}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest['config'] == config:
+            return manifest['targets']
+    import pandas as pd
+    import gaiacat
+    mirror = os.path.join(path, 'mirror')
+    os.makedirs(mirror, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    targets = {'lc': {}, 'field': {}}
+    tic_rows, sources = [], []
+    index = 0
+    for name in sorted(sizes):
+        nsectors, cadence = sizes[name]
+        index += 1
+        tic = TIC_BASE + index
+        period = rng.uniform(0.5, 12)
+        for sector in range(1, nsectors + 1):
+            time, quality = sector_times(sector, cadence)
+            flux, _ = spotted_star(time, rng, period=period, cadence=cadence)
+            write_lc(os.path.join(mirror, spoc_name('lc', tic, sector)), tic, sector, time, flux, quality,
+                     cadence=cadence)
+        ra, dec = rng.uniform(0, 360), rng.uniform(-80, 80)
+        tic_rows.append({'ID': tic, 'ra': ra, 'dec': dec, 'GAIA': '', 'GAIAmag': np.nan})
+        targets['lc'][name] = (tic, list(range(1, nsectors + 1)))
+    for name in sorted(crowding):
+        index += 1
+        tic, sector = TIC_BASE + index, 1
+        # Fields far apart from each other, so their cones do not overlap
+        ra, dec = 30. * index, rng.uniform(-60, 60)
+        gaia, mag = GAIA_BASE + index, rng.uniform(9, 13)
+        field = gaia_field(ra, dec, crowding[name], gaia, mag, rng)
+        sources.append(pd.DataFrame(field))
+        time, quality = sector_times(sector, 120)
+        flux, _ = spotted_star(time, rng, cadence=120)
+        write_lc(os.path.join(mirror, spoc_name('lc', tic, sector)), tic, sector, time, flux, quality)
+        write_tpf(os.path.join(mirror, spoc_name('tp', tic, sector)), tic, sector, time, quality, flux, field)
+        tic_rows.append({'ID': tic, 'ra': ra, 'dec': dec, 'GAIA': str(gaia), 'GAIAmag': mag})
+        targets['field'][name] = (tic, sector)
+    # Targets without a TPF, in the field of an FFI cube
+    sector = 1
+    ra, dec = 300., rng.uniform(-60, 60)
+    wcs = ffi_wcs(ra, dec)
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    radecs = WCS(fits.Header(wcs)).all_pix2world([c for r, c in FFI_TARGETS], [r for r, c in FFI_TARGETS], 0)
+    time, quality = sector_times(sector, FFI_CADENCE)
+    fields, variables, start = [], {}, 0
+    targets['ffi'] = []
+    for ra, dec in zip(*radecs):
+        index += 1
+        tic, gaia, mag = TIC_BASE + index, GAIA_BASE + index, rng.uniform(9, 12)
+        field = gaia_field(ra, dec, 30, gaia, mag, rng)
+        variables[start] = spotted_star(time, rng, cadence=FFI_CADENCE)[0]
+        start += len(field['Gmag'])
+        fields.append(pd.DataFrame(field))
+        tic_rows.append({'ID': tic, 'ra': ra, 'dec': dec, 'GAIA': str(gaia), 'GAIAmag': mag})
+        targets['ffi'].append((tic, sector))
+    ffi_sources = pd.concat(fields)
+    sources.append(ffi_sources)
+    os.makedirs(os.path.join(path, 'ffi'), exist_ok=True)
+    write_ffi_cube(os.path.join(path, 'ffi', 'tess-s{0:04d}-1-2-cube.fits'.format(sector)), sector, time, quality,
+                   wcs, {name: ffi_sources[name].values for name in ffi_sources}, variables)
+    pd.DataFrame(tic_rows).to_csv(os.path.join(path, 'tic.csv'), index=False)
+    dump = os.path.join(path, 'gaia_dump.csv')
+    pd.concat(sources).to_csv(dump, index=False)
+    gaiacat.build_store([dump], os.path.join(path, 'gaia'))
+    os.remove(dump)
+    import datasource
+    datasource.build_index(mirror)
+    with open(manifest_file, 'w') as f:
+        json.dump({'config': config, 'targets': targets}, f)
+    return targets
+
+
+class FFICubeSource(datasource.LocalArchiveSource):
+    """
+    Local mirror that stands in for TESScut: the FFI cut outs are cut from the
+    FFI cubes of cube_dir (tess-sXXXX-*-cube.fits) and written to
+    download_dir, as TESScut downloads are. downloads counts the cut outs made.
+    """
+
+    def __init__(self, root, cube_dir, download_dir):
+        datasource.LocalArchiveSource.__init__(self, root)
+        self.cubes = {}
+        for name in sorted(os.listdir(cube_dir)):
+            if name.startswith('tess-s') and name.endswith('-cube.fits'):
+                self.cubes.setdefault(int(name[6:10]), os.path.join(cube_dir, name))
+        self.download_dir = download_dir
+        self.downloads = 0
+
+    def download_tesscut(self, target, sector=None, cutout_size=(12, 12)):
+        import lightkurve as lk
+        import cutoutcache
+        coords = cutoutcache.target_coordinates(target)
+        sector = min(self.cubes) if sector in (None, '', 'None') else int(sector)
+        if coords is None or sector not in self.cubes:
+            return None
+        rows, cols = (cutout_size, cutout_size) if np.isscalar(cutout_size) else cutout_size
+        os.makedirs(self.download_dir, exist_ok=True)
+        path = os.path.join(self.download_dir, 'tess-s{0:04d}_{1:.6f}_{2:.6f}_{3}x{4}_astrocut.fits'.format(
+            sector, coords[0], coords[1], cols, rows))
+        with profiling.stage('tesscut_download'):
+            cut_cube(self.cubes[sector], coords[0], coords[1], (rows, cols), path)
+        self.downloads += 1
+        return lk.read(path, targetid=target)
+
+
+def use_data(path):
+    """
+    Serve the light curves, TPFs, FFI cut outs, Gaia and TIC data of path
+    (written by make_data). Cut outs are cached in path/cutouts.
+    """
+    import gaiacat
+    import ticcat
+    import lccache
+    import cutoutcache
+    datasource.set_source(FFICubeSource(os.path.join(path, 'mirror'), os.path.join(path, 'ffi'),
+                                        os.path.join(path, 'tesscut')))
+    gaiacat.set_store(os.path.join(path, 'gaia'))
+    ticcat.set_resolver(ticcat.TICResolver(ticcat.TableTICBackend(os.path.join(path, 'tic.csv')), cache_file=None))
+    lccache.set_cache(os.path.join(path, 'lccache'))
+    cutoutcache.set_cache(os.path.join(path, 'cutouts'))
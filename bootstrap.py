@@ -0,0 +1,186 @@
+"""
+Empirical false alarm probability of the highest periodogram peak.
+
+The analytic FAP() and powerLevel() of the GLS assume white noise and
+independent frequencies, which TESS light curves with gaps and red noise do
+not satisfy. Here the fluxes are randomly permuted over the observing times
+(which destroys any periodicity but keeps the sampling and the flux
+distribution) and the highest power of each realization is computed on the
+frequency grid of the original periodogram (fastgls.Gls.max_powers). The FAP
+of a power is the fraction of realizations reaching it.
+
+The realizations use the extirpolation/FFT sums (method='fft') whatever
+engine computed the periodogram: with the direct sums, each realization costs
+as much as the periodogram itself (seconds for the ~1e5 frequencies of a 2-min
+sector), with the FFT < 0.1 s. The FFT grid is finer than that of the fft
+engine (FFT_OFAC, FFT_ORDER), so that the highest powers of the realizations,
+which are small, are within ~1e-5 of those of the direct sums.
+
+Realizations are computed in batches spread over worker processes. Batch i
+always uses the i-th child of the seed, and batches are accumulated in order,
+so the result only depends on the seed, not on the number of workers. The
+run stops early once the FAP of the highest peak is known to the requested
+precision or, for a peak that no realization reaches, once its upper limit
+(3/n at 95% confidence after n realizations) is below the smallest FAP level
+drawn in the periodogram, e.g. after 3000 realizations for the 0.1% level.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+LEVELS = (0.1, 0.01, 0.001)     # FAP levels drawn by functions.plot_periodogram
+FFT_OFAC = 10       # oversampling of the FFT grid
+FFT_ORDER = 8       # extirpolation order
+
+_gls = None
+
+
+class BootstrapFAP:
+    """
+    Highest powers of the permuted realizations, with the FAP() and
+    powerLevel() methods of the periodograms (so that plot_periodogram can
+    draw either).
+
+    Parameters
+    ----------
+    maxima : array
+        Highest power of each realization.
+    pmax : float
+        Highest power of the periodogram.
+    """
+
+    def __init__(self, maxima, pmax):
+        self.maxima = np.sort(maxima)
+        self.pmax = pmax
+        self.n = len(maxima)
+
+    def FAP(self, Pn=None):
+        """Fraction of realizations reaching Pn (default: highest peak); never below 1/(n+1)."""
+        if Pn is None:
+            Pn = self.pmax
+        k = self.n - np.searchsorted(self.maxima, Pn, side='left')
+        return (k + 1) / (self.n + 1)
+
+    def powerLevel(self, FAPlevel):
+        """
+        Power reached by a fraction FAPlevel of the realizations. Levels below
+        1/n cannot be resolved and give the highest power of all realizations.
+        """
+        return np.quantile(self.maxima, 1 - FAPlevel) if FAPlevel * self.n >= 1 else self.maxima[-1]
+
+    def error(self, Pn=None):
+        # Standard error of FAP(Pn)
+        fap = self.FAP(Pn)
+        return np.sqrt(fap * (1 - fap) / self.n)
+
+
+def uniform_grid(freq, nf=None):
+    """
+    Uniform frequency grid of a periodogram: freq itself, or, for the
+    frequencies evaluated by an adaptive search (a coarse grid and refined
+    windows of the fine one), the whole fine grid of nf frequencies
+    (fastgls.Gls.nf_full), so that the realizations are sampled as densely
+    everywhere as the highest peak is.
+    """
+    freq = np.asarray(freq, dtype=float)
+    step = np.diff(freq)
+    if len(freq) < 2 or np.allclose(step, step[0], rtol=1e-9, atol=0):
+        return freq
+    df = step.min()
+    if nf is None:
+        nf = int(round((freq[-1] - freq[0]) / df)) + 1
+    return freq[0] + df * np.arange(nf)
+
+
+def _init(dat, freq, method):
+    global _gls
+    import fastgls
+    _gls = fastgls.Gls(dat, f=freq, method=method, threads=1, fft_ofac=FFT_OFAC, fft_order=FFT_ORDER)
+
+
+def _batch(seed, size):
+    # Highest powers of size permutations of the fluxes
+    rng = np.random.default_rng(seed)
+    ys = rng.permuted(np.tile(_gls.y, (size, 1)), axis=1).T
+    return _gls.max_powers(ys)
+
+
+def bootstrap_fap(time, flux, error, freq, pmax=None, nmax=10000, nmin=1000, batch=100, precision=0.1,
+                  workers=None, seed=0, method='fft', levels=LEVELS):
+    """
+    Bootstrap FAP of a periodogram.
+
+    Parameters
+    ----------
+    time, flux, error : array
+        Light curve of the periodogram (error may be None).
+    freq : array
+        Frequency grid of the periodogram, uniform for method 'fft' (see
+        uniform_grid).
+    pmax : float, optional
+        Highest power of the periodogram (computed if not given).
+    nmax, nmin : int
+        Largest and smallest number of realizations.
+    batch : int
+        Realizations per batch (per task of a worker).
+    precision : float
+        Stop once the relative standard error of the FAP of the highest peak is
+        below precision (and nmin realizations were made). A peak no realization
+        reaches gets FAP 1/(n+1), an upper limit.
+    levels : sequence of float
+        FAP levels drawn with powerLevel(). A peak that none of n realizations
+        reaches stops the run once 3/n (the 95% upper limit of its FAP) is
+        below the smallest level, so that it is known to be below every level.
+    workers : int, optional
+        Worker processes (default: number of CPUs). 1 runs in this process.
+    seed : int
+        Seed of the permutations.
+    method : str
+        'fft' or 'direct', see fastgls.Gls. The FFT needs a uniform freq.
+
+    Returns
+    -------
+    BootstrapFAP
+    """
+    dat = (time, flux, error)
+    workers = workers or os.cpu_count() or 1
+    seeds = np.random.SeedSequence(seed).spawn(int(np.ceil(nmax / batch)))
+    sizes = [min(batch, nmax - i * batch) for i in range(len(seeds))]
+    maxima = []
+
+    def done():
+        n = sum(len(m) for m in maxima)
+        if n < nmin:
+            return False
+        k = sum(int((m >= pmax).sum()) for m in maxima)
+        if k == 0:
+            return 3. / n <= min(levels)
+        return np.sqrt((k / n) * (1 - k / n) / n) <= precision * k / n
+
+    if workers == 1 or len(seeds) == 1:
+        _init(dat, freq, method)
+        if pmax is None:
+            pmax = _gls.power.max()
+        for s, size in zip(seeds, sizes):
+            maxima.append(_batch(s, size))
+            if done():
+                break
+    else:
+        if pmax is None:
+            import fastgls
+            pmax = fastgls.Gls(dat, f=freq, method=method, fft_ofac=FFT_OFAC, fft_order=FFT_ORDER).power.max()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init, initargs=(dat, freq, method)) as pool:
+            # A few batches per worker are queued ahead; results are taken in batch order
+            jobs = [pool.submit(_batch, s, size) for s, size in zip(seeds[:2 * workers], sizes[:2 * workers])]
+            for i in range(len(seeds)):
+                maxima.append(jobs[i].result())
+                if done():
+                    for job in jobs[i + 1:]:
+                        job.cancel()
+                    break
+                if i + 2 * workers < len(seeds):
+                    j = i + 2 * workers
+                    jobs.append(pool.submit(_batch, seeds[j], sizes[j]))
+    return BootstrapFAP(np.concatenate(maxima), pmax)
@@ -0,0 +1,283 @@
+"""
+On-disk cache of TESScut FFI cut outs.
+
+Targets that are not in the CTL are plotted from a cut out of the full frame
+images, and downloading it from TESScut is one of the slowest remote
+operations. Every cut out downloaded is kept here, with its sector, camera,
+CCD, pixel footprint on the CCD and WCS in meta.json. A request is served
+from any cached cut out of the same sector that fully contains its footprint
+(the box of cutout_size pixels around the pixel of the target, as TESScut
+cuts it, located with the WCS of the cached cut out): the TPF returned is a
+read-only view of the footprint in the memory-mapped file, so nothing is
+copied, and a cut out whose footprint is the requested one is returned as it
+is.
+
+With fetch_size, misses download a larger cut out (fetch_size pixels a side),
+so that later requests for neighbouring targets of the same field are served
+from it.
+
+Requests without a sector (TESScut then returns the first sector of the
+target) are always downloaded, as the cache cannot tell which sectors exist,
+but the cut out is stored for the requests that give the sector.
+
+The cache directory defaults to ~/.tessdiagnosis-cache/tesscut and can be set
+with the TESSDIAG_CUTOUT_CACHE environment variable (size limit in MB:
+TESSDIAG_CUTOUT_CACHE_SIZE, fetch_size: TESSDIAG_CUTOUT_FETCH).
+"""
+
+import os
+import re
+import json
+import shutil
+
+import numpy as np
+
+import profiling
+from lccache import _EntryCache
+
+CACHE_DIR = os.environ.get('TESSDIAG_CUTOUT_CACHE',
+                           os.path.join(os.path.expanduser('~'), '.tessdiagnosis-cache', 'tesscut'))
+MAX_SIZE = float(os.environ.get('TESSDIAG_CUTOUT_CACHE_SIZE', 1024))
+FETCH_SIZE = int(os.environ.get('TESSDIAG_CUTOUT_FETCH', 0))
+PIX_SCALE = 21.0 / 3600.    # degrees / pixel
+
+_cache = None
+
+
+def get_cache():
+    # Cache shared by the whole process
+    global _cache
+    if _cache is None:
+        _cache = CutoutCache()
+    return _cache
+
+
+def set_cache(cache_dir=CACHE_DIR, max_size=MAX_SIZE, fetch_size=FETCH_SIZE):
+    global _cache
+    _cache = CutoutCache(cache_dir, max_size, fetch_size)
+    return _cache
+
+
+def target_coordinates(target):
+    # (ra, dec) in degrees of a TESScut target, 'ra dec' or 'TIC xxx'; None if unknown
+    target = str(target).strip()
+    match = re.match(r'^TIC\s*(\d+)$', target, re.IGNORECASE)
+    try:
+        if match:
+            import ticcat
+            record = ticcat.get_resolver().resolve(match.group(1))
+            return float(record['ra']), float(record['dec'])
+        ra, dec = target.replace(',', ' ').split()
+        return float(ra), float(dec)
+    except (ValueError, KeyError):
+        return None
+
+
+def _size(cutout_size):
+    # (rows, columns) of a TESScut cutout_size
+    if np.isscalar(cutout_size):
+        return int(cutout_size), int(cutout_size)
+    return int(cutout_size[0]), int(cutout_size[1])
+
+
+def footprint(wcs, ra, dec, cutout_size):
+    """(row, column) of the first pixel of the box TESScut cuts around (ra, dec), in the pixels of wcs"""
+    x, y = wcs.all_world2pix(ra, dec, 0)
+    rows, columns = _size(cutout_size)
+    return int(np.round(y - rows / 2.)), int(np.round(x - columns / 2.))
+
+
+def _separation(ra1, dec1, ra2, dec2):
+    # Angular distance in degrees
+    ra1, dec1, ra2, dec2 = np.deg2rad([ra1, dec1, ra2, dec2])
+    cos = np.sin(dec1) * np.sin(dec2) + np.cos(dec1) * np.cos(dec2) * np.cos(ra1 - ra2)
+    return np.rad2deg(np.arccos(np.clip(cos, -1, 1)))
+
+
+def _shift(header, row, column):
+    # Header of a cut out starting at (row, column) of the one of header: the
+    # reference pixel of the sky WCS moves, the physical (CCD) coordinates of
+    # the first pixel grow
+    header = header.copy()
+    offset = {'1': column, '2': row}
+    for key in list(header.keys()):
+        if isinstance(header[key], (str, bool)) or header[key] is None:
+            continue
+        sky = re.match(r'^([12])CRPX\d+$|^CRPIX([12])$', key)
+        ccd = re.match(r'^([12])CRV\d+P$|^CRVAL([12])P$', key)
+        if sky:
+            header[key] -= offset[sky.group(1) or sky.group(2)]
+        elif ccd:
+            header[key] += offset[ccd.group(1) or ccd.group(2)]
+    return header
+
+
+def slice_cutout(path, row, column, cutout_size, ra=None, dec=None, targetid=None):
+    """
+    TPF of the cutout_size pixels of the TESScut file path starting at (row,
+    column), centred on (ra, dec) if given. Nothing is copied: the image
+    columns (FLUX, FLUX_ERR...) and the aperture are read-only views of the
+    window of the memory-mapped file, whose pixels are only read when used.
+    """
+    import lightkurve as lk
+    from astropy.io import fits
+    rows, columns = _size(cutout_size)
+    # The views keep the memory map open once the file is closed
+    with fits.open(path, memmap=True) as hdul:
+        if (row, column) == (0, 0) and hdul[2].data.shape == (rows, columns):
+            return lk.read(path, targetid=targetid)
+        window = (slice(row, row + rows), slice(column, column + columns))
+        primary = fits.PrimaryHDU(header=hdul[0].header.copy())
+        if ra is not None:
+            primary.header.update({'RA_OBJ': ra, 'DEC_OBJ': dec})
+        # A table of the whole cut out (a view of the file), whose image columns are
+        # replaced by their windows. A window is not contiguous in the rows of the
+        # table, so it cannot be a column of a table of its own without a copy: it is
+        # set as the converted column astropy returns for data[name]
+        pixels = fits.BinTableHDU(data=hdul[1].data, header=_shift(hdul[1].header, row, column))
+        for name in hdul[1].columns.names:
+            data = hdul[1].data[name]
+            if data.ndim == 3:
+                view = data[(slice(None),) + window]
+                view.flags.writeable = False
+                pixels.data._converted[name] = view
+        aperture = hdul[2].data[window]
+        aperture.flags.writeable = False
+        aperture = fits.ImageHDU(aperture, header=_shift(hdul[2].header, row, column))
+    return lk.TessTargetPixelFile(fits.HDUList([primary, pixels, aperture]), targetid=targetid)
+
+
+class CutoutCache(_EntryCache):
+    """
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cache.
+    max_size : float
+        Size limit in MB. 0 disables the cache.
+    fetch_size : int
+        Side in pixels of the cut outs downloaded on a miss, when larger than
+        the one requested (0: the size requested).
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_size=MAX_SIZE, fetch_size=FETCH_SIZE):
+        _EntryCache.__init__(self, cache_dir, max_size)
+        self.fetch_size = int(fetch_size)
+
+    @staticmethod
+    def key(sector, camera, ccd, row, column, shape):
+        return 'S{0}_{1}-{2}_{3}_{4}_{5}x{6}'.format(int(sector), camera, ccd, row, column, shape[0], shape[1])
+
+    def _file(self, key):
+        return os.path.join(self._entry(key), 'cutout.fits')
+
+    def _meta(self, key):
+        try:
+            with open(os.path.join(self._entry(key), 'meta.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def find(self, ra, dec, sector, cutout_size):
+        """
+        (key, row, column) of the smallest cached cut out of sector containing
+        the footprint of the request, or None
+        """
+        from astropy.io import fits
+        from astropy.wcs import WCS
+        rows, columns = _size(cutout_size)
+        try:
+            with open(self.index_file) as f:
+                keys = [key for key in json.load(f) if key.startswith('S{0}_'.format(int(sector)))]
+        except (OSError, ValueError):
+            return None
+        entries = [(key, self._meta(key)) for key in keys]
+        entries = sorted([(key, meta) for key, meta in entries if meta is not None],
+                         key=lambda entry: entry[1]['shape'][0] * entry[1]['shape'][1])
+        for key, meta in entries:
+            # Cheap test first: the target within the circle around the cut out
+            if _separation(ra, dec, meta['ra'], meta['dec']) > meta['radius']:
+                continue
+            wcs = WCS(fits.Header.fromstring(meta['wcs']))
+            row, column = footprint(wcs, ra, dec, cutout_size)
+            if (0 <= row and row + rows <= meta['shape'][0] and 0 <= column and column + columns <= meta['shape'][1]
+                    and os.path.exists(self._file(key))):
+                return key, row, column
+        return None
+
+    def get(self, ra, dec, sector, cutout_size, targetid=None):
+        """TPF of the cut out of cutout_size pixels around (ra, dec) from the cache, or None"""
+        if not self.enabled or sector in (None, '', 'None'):
+            return None
+        found = self.find(ra, dec, sector, cutout_size)
+        if found is None:
+            return None
+        key, row, column = found
+        # Another process may evict the entry at any time: then it is a miss
+        if not self._touch(key):
+            return None
+        try:
+            return slice_cutout(self._file(key), row, column, cutout_size, ra, dec, targetid)
+        except FileNotFoundError:
+            return None
+
+    def put(self, path):
+        """Store the TESScut file path; returns its sector (None if it is not a TESS cut out)."""
+        if not self.enabled:
+            return None
+        from astropy.io import fits
+        from astropy.wcs import WCS
+        try:
+            with fits.open(path) as hdul:
+                header = hdul[0].header
+                sector, camera, ccd = int(header['SECTOR']), header['CAMERA'], header['CCD']
+                shape = hdul[2].data.shape
+                corner = (hdul[1].header.get('2CRV5P', 0), hdul[1].header.get('1CRV5P', 0))
+                wcs = WCS(hdul[2].header)
+        except (OSError, KeyError, IndexError, AttributeError):
+            return None
+        ra, dec = wcs.all_pix2world((shape[1] - 1) / 2., (shape[0] - 1) / 2., 0)
+        key = self.key(sector, camera, ccd, corner[0], corner[1], shape)
+        meta = {'sector': sector, 'camera': camera, 'ccd': ccd, 'row': corner[0], 'column': corner[1],
+                'shape': list(shape), 'ra': float(ra), 'dec': float(dec),
+                'radius': (np.hypot(*shape) / 2. + 1) * PIX_SCALE, 'wcs': wcs.to_header_string(relax=True)}
+        def write(directory):
+            shutil.copyfile(path, os.path.join(directory, 'cutout.fits'))
+            with open(os.path.join(directory, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+        return sector if self._commit(key, write) else None
+
+
+def tesscut(target, sector, cutout_size, download):
+    """
+    Cut out of cutout_size pixels around target ('ra dec' or 'TIC xxx') from
+    the cache, or downloaded with download(target, sector, cutout_size) (the
+    TESScut download of a source, returning a TPF read from a file, or None)
+    and then cached.
+    """
+    cache = get_cache()
+    coords = target_coordinates(target) if cache.enabled else None
+    if coords is None:
+        return download(target, sector, cutout_size)
+    ra, dec = coords
+    size = _size(cutout_size)
+    with profiling.stage('cutout_cache'):
+        tpf = cache.get(ra, dec, sector, size, targetid=target)
+    if tpf is not None:
+        return tpf
+    fetch = (max(cache.fetch_size, size[0]), max(cache.fetch_size, size[1]))
+    if fetch != size:
+        try:
+            larger = download(target, sector, fetch)
+        except Exception:       # e.g. too close to the edge of the CCD
+            larger = None
+        if larger is not None and getattr(larger, 'path', None) is not None:
+            fetched_sector = cache.put(larger.path)
+            with profiling.stage('cutout_cache'):
+                tpf = cache.get(ra, dec, fetched_sector, size, targetid=target)
+            if tpf is not None:
+                return tpf
+    tpf = download(target, sector, size)
+    if tpf is not None and getattr(tpf, 'path', None) is not None:
+        cache.put(tpf.path)
+    return tpf
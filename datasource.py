@@ -0,0 +1,236 @@
+"""
+Where light curves and target pixel files come from.
+
+MASTSource downloads the products through lightkurve, as the tool has always
+done. LocalArchiveSource reads them from a local mirror of the SPOC light
+curve (*_lc.fits) and target pixel (*_tp.fits) files, so the pipeline can run
+on machines without internet access. The mirror is scanned once and the
+(TIC, sector) -> file mapping is saved to an index file, so later lookups do
+not walk the directory tree.
+
+FFI cut outs (tesscut) go through the cut out cache (cutoutcache.py), which
+only calls the download_tesscut of the source on a miss, so a local mirror
+can still serve the cut outs already cached.
+
+The source used by functions.py and tpfplotter.py is returned by get_source().
+It is the MAST unless set_source()/use_archive() were called or the
+TESSDIAG_ARCHIVE environment variable points to a local mirror.
+
+Build or refresh the index of a mirror with:
+    python datasource.py /path/to/mirror
+"""
+
+import os
+import re
+import json
+
+import profiling
+import cutoutcache
+
+_source = None
+
+# SPOC file names, e.g. tess2019279210107-s0017-0000000267802440-0161-s_lc.fits
+SPOC_NAME = re.compile(r'-s(\d{4})-(\d{16})-\d{4}-[a-z]_(lc|tp)\.fits(\.gz)?$')
+INDEX_NAME = '.tessdiag_index.json'
+
+
+def get_source():
+    global _source
+    if _source is None:
+        archive = os.environ.get('TESSDIAG_ARCHIVE')
+        _source = LocalArchiveSource(archive) if archive else MASTSource()
+    return _source
+
+
+def set_source(source):
+    global _source
+    _source = source
+    return source
+
+
+def use_archive(root, index_file=None):
+    # Read all products from the local mirror in root
+    return set_source(LocalArchiveSource(root, index_file=index_file))
+
+
+def _sector(sector):
+    # Sector as int, None when it was not given
+    if sector in (None, '', 'None'):
+        return None
+    return int(sector)
+
+
+class MASTSource:
+    name = 'mast'
+
+    def lightcurve_file(self, tic, sector=None):
+        import lightkurve as lk
+        sector = _sector(sector)
+        with profiling.stage('mast_search'):
+            if sector is None:
+                search = lk.search_lightcurvefile('TIC {0}'.format(tic), mission='TESS')
+            else:
+                search = lk.search_lightcurvefile('TIC {0}'.format(tic), mission='TESS', sector=sector)
+        with profiling.stage('fits_download'):
+            return search.download()
+
+    def fingerprint(self, tic, sector=None):
+        # What identifies the inputs of a target (results.run_key); the MAST products
+        # are taken not to change
+        return [self.name]
+
+    def sectors(self, tic, kind='lc'):
+        # Sectors with SPOC products of a target
+        import lightkurve as lk
+        search = lk.search_lightcurve if kind == 'lc' else lk.search_targetpixelfile
+        with profiling.stage('mast_search'):
+            result = search('TIC {0}'.format(tic), mission='TESS', author='SPOC')
+        return sorted(set(int(m.split()[-1]) for m in result.mission))
+
+    def target_pixel_file(self, tic, sector=None):
+        from lightkurve import search_targetpixelfile
+        sector = _sector(sector)
+        with profiling.stage('mast_search'):
+            if sector is None:
+                search = search_targetpixelfile('TIC ' + str(tic), mission='TESS')
+            else:
+                search = search_targetpixelfile('TIC ' + str(tic), sector=sector, mission='TESS')
+        with profiling.stage('fits_download'):
+            return search.download()
+
+    def tesscut(self, target, sector=None, cutout_size=(12, 12)):
+        # target: 'TIC xxx' or 'ra dec'; served from the cut out cache when possible
+        return cutoutcache.tesscut(target, sector, cutout_size, self.download_tesscut)
+
+    def download_tesscut(self, target, sector=None, cutout_size=(12, 12)):
+        from lightkurve import search_tesscut
+        sector = _sector(sector)
+        with profiling.stage('mast_search'):
+            search = search_tesscut(target) if sector is None else search_tesscut(target, sector=sector)
+        with profiling.stage('tesscut_download'):
+            return search.download(cutout_size=cutout_size)
+
+
+class LocalArchiveSource:
+    """
+    Parameters
+    ----------
+    root : str
+        Directory containing the mirrored FITS files (any layout).
+    index_file : str, optional
+        Where the index is kept (default: root/.tessdiag_index.json).
+    rebuild : bool
+        Scan the mirror again even if an index exists.
+    """
+    name = 'local'
+
+    def __init__(self, root, index_file=None, rebuild=False):
+        self.root = os.path.abspath(root)
+        self.index_file = index_file or os.path.join(self.root, INDEX_NAME)
+        if rebuild or not os.path.exists(self.index_file):
+            self.index = build_index(self.root, self.index_file)
+        else:
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+
+    def _path(self, kind, tic, sector):
+        # File of a product, the first sector available if sector is None
+        sectors = self.index[kind].get(str(int(tic)))
+        if not sectors:
+            return None
+        sector = _sector(sector)
+        if sector is None:
+            sector = min(sectors, key=int)
+        relpath = sectors.get(str(sector))
+        if relpath is None:
+            return None
+        return os.path.join(self.root, relpath)
+
+    def sectors(self, tic, kind='lc'):
+        return sorted(int(s) for s in self.index[kind].get(str(int(tic)), {}))
+
+    def fingerprint(self, tic, sector=None):
+        # Path, size and modification time of the light curve and TPF files of a
+        # target ('all': of every sector)
+        files = []
+        for kind in ('lc', 'tp'):
+            sectors = self.sectors(tic, kind) if str(sector).lower() == 'all' else [sector]
+            for s in sectors:
+                path = self._path(kind, tic, s)
+                if path is not None and os.path.exists(path):
+                    stat = os.stat(path)
+                    files.append([os.path.relpath(path, self.root), stat.st_size, stat.st_mtime])
+        return [self.name, files]
+
+    def lightcurve_file(self, tic, sector=None):
+        import lightkurve as lk
+        path = self._path('lc', tic, sector)
+        if path is None:
+            return None
+        with profiling.stage('fits_read'):
+            return lk.read(path)
+
+    def target_pixel_file(self, tic, sector=None):
+        import lightkurve as lk
+        path = self._path('tp', tic, sector)
+        if path is None:
+            return None
+        with profiling.stage('fits_read'):
+            return lk.read(path)
+
+    def tesscut(self, target, sector=None, cutout_size=(12, 12)):
+        # Only the FFI cut outs already in the cut out cache
+        return cutoutcache.tesscut(target, sector, cutout_size, self.download_tesscut)
+
+    def download_tesscut(self, target, sector=None, cutout_size=(12, 12)):
+        # FFI cut outs are not part of a light curve/TPF mirror
+        return None
+
+
+def _classify(path):
+    # (kind, tic, sector) of a FITS file from its name, or from its headers
+    # if the name does not follow the SPOC convention
+    match = SPOC_NAME.search(os.path.basename(path))
+    if match:
+        return match.group(3), int(match.group(2)), int(match.group(1))
+    from astropy.io import fits
+    try:
+        with fits.open(path) as hdul:
+            header = hdul[0].header
+            extname = hdul[1].header.get('EXTNAME', '') if len(hdul) > 1 else ''
+            kind = {'LIGHTCURVE': 'lc', 'PIXELS': 'tp'}.get(extname)
+            if kind is None or 'TICID' not in header or 'SECTOR' not in header:
+                return None
+            return kind, int(header['TICID']), int(header['SECTOR'])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def build_index(root, index_file=None):
+    """Scan root for light curve and TPF files and save the index."""
+    root = os.path.abspath(root)
+    index = {'lc': {}, 'tp': {}}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if not (filename.endswith('.fits') or filename.endswith('.fits.gz')):
+                continue
+            path = os.path.join(dirpath, filename)
+            product = _classify(path)
+            if product is None:
+                continue
+            kind, tic, sector = product
+            index[kind].setdefault(str(tic), {})[str(sector)] = os.path.relpath(path, root)
+    index_file = index_file or os.path.join(root, INDEX_NAME)
+    tmp = index_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, index_file)
+    return index
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 2:
+        sys.exit('usage: python datasource.py /path/to/mirror')
+    index = build_index(sys.argv[1])
+    print('Indexed {0} light curve and {1} TPF targets'.format(len(index['lc']), len(index['tp'])))
@@ -0,0 +1,445 @@
+"""
+Vectorised Generalised Lomb-Scargle periodogram.
+
+Implements the same formalism as gls.Gls by M. Zechmeister
+(https://github.com/mzechmeister/GLS, Zechmeister & Kurster 2009) and exposes
+the attributes used by functions.py (freq, power, best, FAP(), powerLevel()),
+so it can be used as a drop-in replacement in get_periodogram. Instead of a
+Python loop over frequencies, the trigonometric sums are computed for blocks
+of frequencies with NumPy. The block size is chosen so that the temporary
+arrays stay within a memory budget and blocks are spread over threads. The
+full grid still takes the same direct sums as the reference, so the speed up
+comes from search='adaptive' (a tenth of the frequencies) or method='fft'.
+tests/test_fastgls.py checks the equivalence with the reference.
+
+For long (multi-sector) light curves, method='fft' computes the sums of a
+uniform frequency grid with the extirpolation and FFT scheme of Press &
+Rybicki (1989, ApJ 338, 277), in O(N + nf log nf) operations instead of
+O(N nf).
+"""
+
+import os
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class Gls:
+    """
+    Compute the GLS periodogram (ZK normalisation).
+
+    Parameters
+    ----------
+    dat : tuple
+        (time, flux[, error])
+    fbeg, fend : float, optional
+        Smallest and largest frequency.
+    Pbeg, Pend : float, optional
+        Smallest and largest period (used if fbeg/fend are not given).
+    f : array, optional
+        Frequency grid. If given, fbeg, fend and ofac are ignored.
+    ofac : int
+        Oversampling factor of the frequency grid.
+    hifac : float
+        Largest frequency in units of the average Nyquist frequency.
+    ls : bool
+        Compute the classical Lomb-Scargle periodogram (no floating mean).
+    max_memory : float
+        Budget in MB for the temporary arrays of all threads together. Small
+        blocks that stay in the CPU cache are usually the fastest.
+    single : bool
+        Accumulate the trigonometric sums in single precision. Halves the
+        memory per block at the cost of ~1e-4 relative accuracy in the power.
+    threads : int, optional
+        Number of threads (default: number of CPUs).
+    search : str
+        'full' evaluates the whole grid. 'adaptive' scans a coarse grid first
+        and refines only around the ncand highest peaks and their P/2 and 2P
+        positions. freq and power then hold only the evaluated frequencies;
+        nf_eval and nf_full give the number of evaluated and full-grid
+        frequencies.
+    ncand : int
+        Number of coarse peaks refined in the adaptive search.
+    coarse_ofac : float
+        Oversampling factor of the coarse grid of the adaptive search.
+    method : str
+        'direct' evaluates the trigonometric sums of every frequency. 'fft'
+        computes those of uniform grids by extirpolation to a regular time grid
+        and FFT (Press & Rybicki 1989); the power is then approximate, with
+        errors of ~1e-4 of the highest peak. Non uniform grids (refinement of the
+        adaptive search, user given f) are always evaluated directly.
+    fft_ofac : float
+        Oversampling of the FFT grid with respect to the number of frequencies.
+    fft_order : int
+        Number of grid points each data point is extirpolated to.
+    """
+
+    def __init__(self, dat, fbeg=None, fend=None, Pbeg=None, Pend=None, f=None, ofac=10, hifac=1,
+                 ls=False, max_memory=32, single=False, threads=None, search='full', ncand=10,
+                 coarse_ofac=1, method='direct', fft_ofac=5, fft_order=4, verbose=False):
+        self.fbeg = fbeg
+        self.fend = fend
+        self.Pbeg = Pbeg
+        self.Pend = Pend
+        self.freq = f
+        self.ofac = ofac
+        self.hifac = hifac
+        self.ls = ls
+        self.norm = 'ZK'
+        self.max_memory = max_memory
+        self.rtype = np.float32 if single else np.float64
+        self.ctype = np.complex64 if single else np.complex128
+        self.substep = 32
+        self.threads = threads or os.cpu_count() or 1
+        self.search = search
+        self.ncand = ncand
+        self.coarse_ofac = coarse_ofac
+        if method not in ('direct', 'fft'):
+            raise ValueError('Unknown method: {0}'.format(method))
+        self.method = method
+        self.fft_ofac = fft_ofac
+        self.fft_order = fft_order
+        self._assign_data(dat)
+        self._build_freq()
+        self._calc_periodogram()
+        self._peak()
+        if verbose:
+            self.info()
+
+    def _assign_data(self, dat):
+        self.t = np.asarray(dat[0], dtype=float).ravel()
+        self.y = np.asarray(dat[1], dtype=float).ravel()
+        self.e_y = None
+        if len(dat) > 2 and dat[2] is not None:
+            self.e_y = np.asarray(dat[2], dtype=float).ravel()
+        self.th = self.t - self.t.min()
+        self.tbase = self.th.max()
+        self.N = len(self.y)
+
+    def _build_freq(self):
+        self.fstep = 1 / self.tbase / self.ofac
+        self.fnyq = 0.5 / self.tbase * self.N
+        if self.freq is None:
+            if self.fbeg is None:
+                self.fbeg = self.fstep if self.Pend is None else 1 / self.Pend
+            if self.fend is None:
+                self.fend = self.fnyq * self.hifac if self.Pbeg is None else 1 / self.Pbeg
+            if self.fend <= self.fbeg:
+                raise ValueError('fend must be larger than fbeg')
+            self.freq = np.arange(self.fbeg, self.fend, self.fstep)
+        else:
+            self.freq = np.asarray(self.freq, dtype=float)
+            self.fbeg, self.fend = self.freq.min(), self.freq.max()
+        self.f = self.freq
+        self.nf = len(self.freq)
+        # Number of independent frequencies (Eq. (24) in ZK09)
+        self.M = (self.fend - self.fbeg) * self.tbase
+
+    def _chunk_size(self):
+        # Per frequency we hold exp(i*omega*t) and its square
+        row_bytes = self.N * 2 * np.dtype(self.ctype).itemsize
+        budget = self.max_memory * 2**20 / self.threads
+        return int(max(self.substep, budget // row_bytes // self.substep * self.substep))
+
+    def _weights(self):
+        if self.e_y is None:
+            w = np.ones(self.N)
+        else:
+            w = 1 / (self.e_y * self.e_y)
+        self.wsum = w.sum()
+        w /= self.wsum
+        self._Y = np.dot(w, self.y)         # Eq. (7)
+        wy = self.y - self._Y
+        self._YY = np.dot(w, wy**2)         # Eq. (10)
+        wy *= w
+        return w, wy
+
+    def _phasors(self, freq, step_phasors):
+        # exp(i*omega*t) for a block of frequencies
+        if step_phasors is None:
+            return np.exp(1j * np.multiply.outer(2 * np.pi * freq, self.th)).astype(self.ctype)
+        # On a uniform grid omega_k = omega_j + m*domega, so only every substep-th
+        # row needs trigonometric functions, the rest are complex products
+        m = self.substep
+        base = np.exp(1j * np.multiply.outer(2 * np.pi * freq[::m], self.th)).astype(self.ctype)
+        E = base[:, None, :] * step_phasors[None, :, :]
+        return E.reshape(-1, self.N)[:len(freq)]
+
+    def _trig_sums(self, freq, step_phasors):
+        # Eq. (8), (9), (11), (12), (13) and (15) for a block of frequencies
+        E = self._phasors(freq, step_phasors)
+        CS_ = E @ self._w                    # C + iS
+        Y_ = E @ self._wy                    # YC + iYS
+        E *= E                               # exp(2i*omega*t)
+        E2 = E @ self._w
+        # cos^2 = (1+cos 2x)/2 and cos*sin = sin 2x/2, with sum(w) = 1
+        return CS_.real, CS_.imag, Y_.real, Y_.imag, 0.5 * (1 + E2.real), 0.5 * E2.imag
+
+    def _fft_sums(self, h, f0, df, nf):
+        # sum_j h_j exp(2i*pi*(f0+k*df)*th_j) for k < nf: h is extirpolated to a
+        # regular grid of the phase th*df, whose inverse FFT gives the sums
+        nfft = 2**int(np.ceil(np.log2(nf * self.fft_ofac)))
+        if f0 != 0:
+            h = h * np.exp(2j * np.pi * f0 * self.th)
+        grid = extirpolate((self.th * df * nfft) % nfft, h, nfft, self.fft_order)
+        return nfft * np.fft.ifft(grid)[:nf]
+
+    @staticmethod
+    def _uniform(freq):
+        df = np.diff(freq)
+        return len(freq) > 1 and np.allclose(df, df[0], rtol=1e-9, atol=0)
+
+    def _step_phasors(self, freq):
+        # exp(i*m*domega*t) for m < substep on a uniform grid, None otherwise
+        if len(freq) > self.substep and self._uniform(freq):
+            step = 2 * np.pi * (freq[1] - freq[0])
+            return np.exp(1j * np.multiply.outer(step * np.arange(self.substep), self.th)).astype(self.ctype)
+        return None
+
+    def _sums(self, freq):
+        # Trigonometric sums for an array of frequencies, evaluated in blocks
+        nf = len(freq)
+        if self.method == 'fft' and self._uniform(freq):
+            f0, df = freq[0], (freq[-1] - freq[0]) / (nf - 1)
+            CS_ = self._fft_sums(self._w, f0, df, nf)
+            Y_ = self._fft_sums(self._wy, f0, df, nf)
+            E2 = self._fft_sums(self._w, 2 * f0, 2 * df, nf)
+            self.nf_eval += nf
+            return np.array([CS_.real, CS_.imag, Y_.real, Y_.imag, 0.5 * (1 + E2.real), 0.5 * E2.imag])
+        step_phasors = self._step_phasors(freq)
+        sums = np.zeros((6, nf))
+        chunk = self._chunk_size()
+        starts = range(0, nf, chunk)
+
+        def block(i):
+            sums[:, i:i+chunk] = self._trig_sums(freq[i:i+chunk], step_phasors)
+
+        if self.threads > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                list(pool.map(block, starts))
+        else:
+            for i in starts:
+                block(i)
+        self.nf_eval += nf
+        return sums
+
+    def _calc_periodogram(self):
+        w, wy = self._weights()
+        self._weight = w
+        self._w = w.astype(self.rtype)
+        self._wy = wy.astype(self.rtype)
+        self.nf_full = self.nf
+        self.nf_eval = 0
+        if self.search == 'adaptive':
+            self._adaptive_search()
+        elif self.search == 'full':
+            self._combine(*self._sums(self.freq))
+        else:
+            raise ValueError('Unknown search mode: {0}'.format(self.search))
+
+    def _adaptive_search(self):
+        # Scan a coarse grid with coarse_ofac points per resolution element 1/tbase,
+        # then evaluate the fine grid only around the ncand highest coarse peaks and
+        # their 2P (f/2) and P/2 (2f) positions
+        fine = self.freq
+        step = max(1, int(round(self.ofac / self.coarse_ofac)))
+        half = 2 * step
+        window = np.arange(-half, half + 1)
+        sel = np.arange(0, len(fine), step)
+        sums = self._sums(fine[sel])
+        p = self._power(*sums)[0]
+        is_peak = (p >= np.r_[-np.inf, p[:-1]]) & (p >= np.r_[p[1:], -np.inf])
+        peaks = np.flatnonzero(is_peak)
+        top = peaks[np.argsort(p[peaks])[::-1][:self.ncand]]
+        fc = fine[sel[top]]
+        targets = np.concatenate([fc, fc / 2, 2 * fc])
+        targets = targets[(targets >= fine[0]) & (targets <= fine[-1])]
+        centres = np.searchsorted(fine, targets)
+        todo = centres[:, None] + window[None, :]
+        # Widen the window around the best peak until its neighbours are sampled
+        for _ in range(10):
+            todo = np.setdiff1d(np.clip(todo, 0, len(fine) - 1), sel)
+            if len(todo) == 0:
+                break
+            sel = np.concatenate([sel, todo])
+            sums = np.hstack([sums, self._sums(fine[todo])])
+            order = np.argsort(sel)
+            sel, sums = sel[order], sums[:, order]
+            k = sel[self._power(*sums)[0].argmax()]
+            todo = k + window
+        self.freq = self.f = fine[sel]
+        self.nf = len(sel)
+        self._combine(*sums)
+
+    def _power(self, C, S, YC, YS, CC, CS):
+        SS = 1. - CC
+        if not self.ls:
+            CC = CC - C * C      # Eq. (13)
+            SS = SS - S * S      # Eq. (14)
+            CS = CS - C * S      # Eq. (15)
+        D = CC * SS - CS * CS    # Eq. (6)
+        a = (YC * SS - YS * CS) / D
+        b = (YS * CC - YC * CS) / D
+        # Eq. (5) in ZK09
+        p = (SS * YC * YC + CC * YS * YS - 2. * CS * YC * YS) / (self._YY * D)
+        return p, a, b
+
+    def _combine(self, C, S, YC, YS, CC, CS):
+        self._fixed = (C, S, CC, CS)        # do not depend on y
+        self.p, self._a, self._b = self._power(C, S, YC, YS, CC, CS)
+        self._off = -self._a * C - self._b * S
+        self.power = self.p
+
+    def _peak(self):
+        # Parameters of the highest peak and its frequency error from the peak curvature
+        k = self.p.argmax()
+        self.pmax = pmax = self.p[k]
+        self.rms = rms = np.sqrt(self._YY * (1. - pmax))
+        fbest = self.freq[k]
+        amp = np.sqrt(self._a[k]**2 + self._b[k]**2)
+        ph = np.arctan2(self._a[k], self._b[k]) / (2. * np.pi)
+        T0 = self.t.min() - ph / fbest
+        e_amp = np.sqrt(2. / self.N) * rms
+        e_ph = e_amp / amp / (2. * np.pi)
+        if 1 < k < self.nf - 2:
+            xh = (self.freq[k-1:k+2] - fbest)**2
+            yh = self.p[k-1:k+2] - pmax
+            aa = np.dot(yh, xh) / np.dot(xh, xh)
+            e_f = np.sqrt(-2. / self.N / aa * (1. - pmax))
+            e_P = e_f / fbest**2
+        else:
+            e_f = e_P = np.nan
+            print('WARNING: Highest peak is at the edge of the frequency range.\n'
+                  'No output of frequency error.\nIncrease frequency range to sample the peak maximum.')
+        self.best = {'f': fbest, 'e_f': e_f, 'P': 1. / fbest, 'e_P': e_P,
+                     'amp': amp, 'e_amp': e_amp, 'ph': ph, 'e_ph': e_ph,
+                     'T0': T0, 'e_T0': e_ph / fbest,
+                     'offset': self._off[k] + self._Y, 'e_offset': np.sqrt(1. / self.N) * rms}
+
+    def max_powers(self, ys):
+        """
+        Highest power of the periodograms of other fluxes at the same times, with
+        the same weights and frequencies, e.g. permutations of y for a bootstrap.
+        ys has shape (N, B); only the sums involving the fluxes are computed.
+        """
+        ys = np.asarray(ys, dtype=float)
+        w = self._weight
+        dy = ys - w @ ys
+        YY = w @ dy**2
+        wy = w[:, None] * dy
+        C, S, CC, CS = self._fixed
+        SS = 1. - CC
+        if not self.ls:
+            CC = CC - C * C
+            SS = SS - S * S
+            CS = CS - C * S
+        D = CC * SS - CS * CS
+        best = np.full(ys.shape[1], -np.inf)
+        freq, nf = self.freq, self.nf
+        if self.method == 'fft' and self._uniform(freq):
+            df = (freq[-1] - freq[0]) / (nf - 1)
+            for k in range(ys.shape[1]):
+                Y_ = self._fft_sums(wy[:, k], freq[0], df, nf)
+                p = (SS * Y_.real**2 + CC * Y_.imag**2 - 2. * CS * Y_.real * Y_.imag) / D
+                best[k] = p.max() / YY[k]
+            return best
+        step_phasors = self._step_phasors(freq)
+        wy = wy.astype(self.rtype)
+        chunk = self._chunk_size()
+        for i in range(0, nf, chunk):
+            Y_ = self._phasors(freq[i:i+chunk], step_phasors) @ wy        # (block, B): YC + iYS
+            sl = slice(i, i + chunk)
+            p = (SS[sl, None] * Y_.real**2 + CC[sl, None] * Y_.imag**2
+                 - 2. * CS[sl, None] * Y_.real * Y_.imag) / D[sl, None]
+            np.maximum(best, p.max(axis=0) / YY, out=best)
+        return best
+
+    def prob(self, Pn):
+        # Probability of a power higher than Pn from Gaussian noise
+        return (1. - Pn)**((self.N - 3.) / 2.)
+
+    def probInv(self, Prob):
+        return 1. - Prob**(2. / (self.N - 3.))
+
+    def FAP(self, Pn=None):
+        """False alarm probability of the power Pn (default: highest peak)."""
+        if Pn is None:
+            Pn = self.pmax
+        prob = self.M * self.prob(Pn)
+        if prob > 0.01:
+            return 1. - (1. - self.prob(Pn))**self.M
+        return prob
+
+    def powerLevel(self, FAPlevel):
+        """Power threshold for a given FAP level."""
+        Prob = 1. - (1. - FAPlevel)**(1. / self.M)
+        return self.probInv(Prob)
+
+    def info(self):
+        print('Generalized LS - statistical output')
+        print('-----------------------------------')
+        print('Number of input points:      %6d' % self.N)
+        print('Weighted mean of dataset:   % f' % self._Y)
+        print('Weighted rms of dataset:    % f' % np.sqrt(self._YY))
+        print('Time base:                  % f' % self.tbase)
+        print('Number of frequency points:  %6d' % self.nf)
+        print()
+        print('Maximum power p [%s]: % f' % (self.norm, self.pmax))
+        print('FAP(Pmax):            % f' % self.FAP())
+        print('Best sine period:     % f +/- % f' % (self.best['P'], self.best['e_P']))
+        print('-----------------------------------')
+
+
+def extirpolate(x, y, n, order=4):
+    """
+    Values on the grid 0..n-1 whose sums against any polynomial of degree
+    < order (locally, any smooth function) equal those of y at the positions x:
+    each point is spread over the order nearest grid points with the weights of
+    Lagrange interpolation (Press & Rybicki 1989).
+    """
+    grid = np.zeros(n, dtype=np.result_type(y, float))
+    exact = x == np.round(x)
+    np.add.at(grid, np.round(x[exact]).astype(int) % n, y[exact])
+    x, y = x[~exact], y[~exact]
+    lo = np.clip((x - order // 2).astype(int), 0, n - order)
+    numerator = y * np.prod(x - lo - np.arange(order)[:, None], axis=0)
+    denominator = math.factorial(order - 1)
+    for j in range(order):
+        if j > 0:
+            denominator *= j / (j - order)
+        index = lo + (order - 1 - j)
+        np.add.at(grid, index, numerator / (denominator * (x - index)))
+    return grid
+
+
+def compare_to_reference(t, y, e_y, rtol=1e-6, **kwargs):
+    """
+    Check that Gls reproduces gls.Gls on the given data.
+    Returns the largest relative difference of the power and of the best
+    period, period error and FAP.
+    """
+    from gls import Gls as RefGls
+    ref = RefGls((list(t), list(y), list(e_y)), **kwargs)
+    new = Gls((t, y, e_y), **kwargs)
+    diff = {'power': np.max(np.abs(new.power - ref.power)) / np.max(ref.power),
+            'P': abs(new.best['P'] - ref.best['P']) / ref.best['P'],
+            'e_P': abs(new.best['e_P'] - ref.best['e_P']) / ref.best['e_P'],
+            'FAP': abs(new.FAP() - ref.FAP()) / max(ref.FAP(), 1e-300),
+            'powerLevel': abs(new.powerLevel(0.01) - ref.powerLevel(0.01)) / ref.powerLevel(0.01)}
+    return diff, all(v <= rtol for v in diff.values())
+
+
+if __name__ == '__main__':
+    # Numerical equivalence with the reference implementation on a synthetic
+    # one-sector, 2-minute cadence rotator
+    rng = np.random.default_rng(42)
+    t = np.arange(0, 27, 2 / 60 / 24)
+    t = t[(t < 13) | (t > 14)]
+    e_y = np.full(len(t), 0.002)
+    y = 1 + 0.003 * np.sin(2 * np.pi * t / 3.1) + rng.normal(0, e_y)
+    Pbeg, Pend = 2 * (t[1] - t[0]), (t.max() - t.min()) / 2
+    diff, ok = compare_to_reference(t, y, e_y, Pbeg=Pbeg, Pend=Pend)
+    for key in diff:
+        print('{0:>10}: {1:.3e}'.format(key, diff[key]))
+    print('OK' if ok else 'MISMATCH')
@@ -1,48 +1,256 @@
-import lightkurve as lk
+# lightkurve and gls are imported by the functions that use them, so that the
+# terminal version starts quickly. The Tk figure panels of the GUI are in tkfigures.py
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.figure import figaspect
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+from matplotlib.collections import LineCollection
 import matplotlib
-from gls import Gls
+import profiling
 
 
 def get_arguments():
     import argparse
+    import os
     parser = argparse.ArgumentParser()
-    parser.add_argument('tic',help='TIC number',action='store',type=str)
-    parser.add_argument('sector',help='TESS source sector',action='store',type=str) 
+    parser.add_argument('tic',help='TIC number',action='store',type=str,nargs='?')
+    parser.add_argument('sector',help='TESS source sector, or all to stitch every available sector',action='store',type=str,nargs='?') 
+    parser.add_argument('--targets',help='CSV file with TIC and TESS_sector columns to process in batch',action='store',default=None)
+    parser.add_argument('--archive',help='Read light curves and TPFs from this local mirror instead of MAST',action='store',default=None)
+    parser.add_argument('--workers',help='Number of worker processes used in batch mode',action='store',type=int,default=os.cpu_count())
     parser.add_argument('--FGratio',help='Save Gaia sources and get main source Gflux fraction', action='store')
     parser.add_argument('--SAP',help='Use the SAP light curve instead of the PDCSAP',action='store_true',dest='SAP')
+    parser.add_argument('--engine',help='Periodogram engine: gls (reference), numpy (vectorised) or fft (extirpolation '
+                        'and FFT, for long light curves). Default: gls, fft for stitched sectors',action='store',
+                        choices=['gls','numpy','fft'],default=None)
+    parser.add_argument('--search',help='Frequency search of the numpy and fft engines: full grid or adaptive coarse-to-fine',
+                        action='store',choices=['full','adaptive'],default='full')
+    parser.add_argument('--bootstrap',help='Estimate the FAP and the FAP levels from up to this number of random '
+                        'permutations of the fluxes instead of analytically',action='store',type=int,default=None)
+    parser.add_argument('--fold-bins',help='Plot the folded LC as the median and scatter in this number of phase bins',
+                        action='store',type=int,default=None,dest='fold_bins')
+    parser.add_argument('--decimate',help='Plot the LC as its min/max envelope per pixel column instead of every cadence',
+                        action='store_true')
+    parser.add_argument('--report',help='Write the summaries of all targets to this single PDF or HTML (.html) file '
+                        'instead of PNG and PDF files per target',action='store',default=None)
+    parser.add_argument('--results',help='SQLite file where the results of every target are committed as it finishes',
+                        action='store',default='TESSdiagnosis_results.sqlite')
+    parser.add_argument('--rerun',help='Process again the targets already in the results file',action='store_true')
+    parser.add_argument('--profile',help='Record the time, remote calls and memory of every stage of each target to '
+                        'this JSON lines file and print a summary table',action='store',default=None)
+    parser.add_argument('--profile-stage',help='Also run this stage (e.g. periodogram) under cProfile',action='store',
+                        default=None,dest='profile_stage')
     parser.set_defaults(SAP=False)
 
     args = parser.parse_args()
+    if args.targets is None and (args.tic is None or args.sector is None):
+        parser.error('either give a TIC and sector or a --targets file')
+    if args.search == 'adaptive' and args.engine not in ('numpy','fft'):
+        parser.error('--search adaptive requires --engine numpy or fft')
+    if args.bootstrap is not None and args.bootstrap < 1:
+        parser.error('--bootstrap must be at least 1')
+    if args.fold_bins is not None and args.fold_bins < 1:
+        parser.error('--fold-bins must be at least 1')
+    if args.profile_stage is not None and args.profile is None:
+        parser.error('--profile-stage requires --profile')
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
     return args
 
+def read_targets(targets_file):
+    # Read (TIC, sector) pairs. Files written by TESSdiagnosis.py (TIC, TESS_sector columns)
+    # can be used directly, otherwise the first two columns are taken. The sector may be 'all'
+    import pandas as pd
+    targets = pd.read_csv(targets_file)
+    if 'TIC' in targets.columns and 'TESS_sector' in targets.columns:
+        targets = targets[['TIC','TESS_sector']]
+    else:
+        targets = pd.read_csv(targets_file,header=None,comment='#').iloc[:,:2]
+        targets = targets[pd.to_numeric(targets.iloc[:,0],errors='coerce').notna()]
+    TIC_list = targets.iloc[:,0].astype(float).astype(int).values
+    TESS_sector_list = np.array([parse_sector(s) for s in targets.iloc[:,1]],dtype=object)
+    return TIC_list, TESS_sector_list
+
+@profiling.stage('lc_download')
 def download_lc(tic,TESS_sector):
+    # The file comes from the data source in use (MAST or a local archive, see datasource.py)
+    import datasource
     print('Downloading light curve')
-    if TESS_sector == '':
-        lc_file = lk.search_lightcurvefile('TIC {0}'.format(tic),mission = 'TESS').download()
-    else:
-        lc_file = lk.search_lightcurvefile('TIC {0}'.format(tic),mission = 'TESS',sector = int(TESS_sector)).download()
+    lc_file = datasource.get_source().lightcurve_file(tic,TESS_sector)
     if lc_file is None:
         return None
     return lc_file
 
-def plot_lc(lc_file,data_type):
+def is_stitched(TESS_sector):
+    # 'all' selects every available sector of a target, stitched
+    return str(TESS_sector).lower() == 'all'
+
+def parse_sector(TESS_sector):
+    return 'all' if is_stitched(TESS_sector) else int(TESS_sector)
+
+def extract_lc(lc_file,data_type):
+    # Light curve of the chosen flux type without NaNs
     if data_type == 'PDCSAP':
-        lc = lc_file.PDCSAP_FLUX.remove_nans()
+        return lc_file.PDCSAP_FLUX.remove_nans()
     elif data_type == 'SAP':
-        lc = lc_file.SAP_FLUX.remove_nans()
+        return lc_file.SAP_FLUX.remove_nans()
+    raise ValueError('Unknown flux type: {0}'.format(data_type))
+
+def lc_file_sector(lc_file):
+    return int(lc_file.meta['SECTOR'])
+
+def lc_file_source(lc_file):
+    # Path of the FITS file a light curve was read from
+    return getattr(lc_file,'filename',None) or getattr(lc_file,'path',None)
+
+def lc_from_arrays(time,flux,flux_err,tic=None,TESS_sector=None,data_type=None):
+    import lightkurve as lk
+    from astropy.time import Time
+    import astropy.units as u
+    lc = lk.LightCurve(time=Time(np.asarray(time),format='btjd',scale='tdb'),
+                       flux=np.asarray(flux)*u.electron/u.s,flux_err=np.asarray(flux_err)*u.electron/u.s)
+    lc.meta.update({'TICID':tic,'SECTOR':TESS_sector,'FLUX_ORIGIN':data_type})
+    return lc
+
+def cached_lc(tic,TESS_sector,data_type='PDCSAP'):
+    # Cleaned light curve from the local array cache, None if it is not there
+    import lccache
+    import datasource
+    if TESS_sector in ('',None):
+        return None
+    arrays = lccache.get_cache().get(tic,TESS_sector,data_type,
+                                     fingerprint=datasource.get_source().fingerprint(tic,TESS_sector))
+    if arrays is None:
+        return None
+    return lc_from_arrays(*arrays,tic=tic,TESS_sector=int(TESS_sector),data_type=data_type)
+
+@profiling.stage('load_lc')
+def load_lc(tic,TESS_sector,data_type='PDCSAP',lc_file=None):
+    # Cleaned light curve of a target. It is read from the local array cache when possible,
+    # otherwise it is extracted from lc_file (downloaded if not given) and cached
+    import lccache
+    import datasource
+    lc = cached_lc(tic,TESS_sector,data_type)
+    if lc is not None:
+        return lc
+    if lc_file is None:
+        lc_file = download_lc(tic,TESS_sector)
+        if lc_file is None:
+            return None
+    lc = extract_lc(lc_file,data_type)
+    sector = lc_file_sector(lc_file)
+    lccache.get_cache().put(tic,sector,data_type,lc.time.value,lc.flux.value,lc.flux_err.value,
+                            source=lc_file_source(lc_file),
+                            fingerprint=datasource.get_source().fingerprint(tic,sector))
+    return lc
+
+def load_lcs(tic,TESS_sector):
+    # PDCSAP and SAP light curves of a target, downloading the file at most once
+    lcs = {data_type:cached_lc(tic,TESS_sector,data_type) for data_type in ('PDCSAP','SAP')}
+    if None in lcs.values():
+        lc_file = download_lc(tic,TESS_sector)
+        if lc_file is None:
+            return None
+        for data_type in lcs:
+            if lcs[data_type] is None:
+                lcs[data_type] = load_lc(tic,TESS_sector,data_type,lc_file=lc_file)
+    return lcs
+
+@profiling.stage('stitch')
+def load_stitched_lc(tic,data_type='PDCSAP',sectors=None):
+    # Light curve of every available sector of a target (or of the given ones), each sector
+    # normalized by its median and stitched in time order. Each sector is cached as in load_lc
+    import datasource
+    import lightkurve as lk
+    if sectors is None:
+        sectors = datasource.get_source().sectors(tic)
+    lcs = [load_lc(tic,sector,data_type) for sector in sorted(sectors)]
+    lcs = [lc for lc in lcs if lc is not None and len(lc) > 0]
+    if not lcs:
+        return None
+    print('Stitching {0} sectors'.format(len(lcs)))
+    lc = lk.LightCurveCollection(lcs).stitch()
+    lc.meta['SECTORS'] = [int(sector) for sector in sorted(sectors)]
+    return lc
+
+def envelope_segments(time,flux,xmin,xmax,npix):
+    """
+    Vertical segments from the minimum to the maximum flux of the points falling
+    in each of npix columns between xmin and xmax, as an array (n,2,2) for a
+    LineCollection. time must be sorted.
+    """
+    i0 = np.searchsorted(time,xmin,side='left')
+    i1 = np.searchsorted(time,xmax,side='right')
+    t, f = time[i0:i1], flux[i0:i1]
+    if len(t) == 0 or xmax <= xmin:
+        return np.zeros((0,2,2))
+    npix = max(int(npix),1)
+    width = (xmax-xmin)/npix
+    col = np.minimum(((t-xmin)/width).astype(int),npix-1)
+    starts = np.flatnonzero(np.r_[True,col[1:]!=col[:-1]])
+    lo = np.minimum.reduceat(f,starts)
+    hi = np.maximum.reduceat(f,starts)
+    x = xmin+(col[starts]+0.5)*width
+    return np.stack([np.column_stack([x,lo]),np.column_stack([x,hi])],axis=1)
+
+def plot_envelope(ax,time,flux,color='blue',rasterized=True):
+    """
+    Draw a light curve as its per pixel column min/max envelope. The envelope is
+    computed again for the new range when the x limits change (zoom/pan with the
+    navigation toolbar), so at most one segment per screen column is ever drawn.
+    """
+    # Squares at the columns with a single point (zero length segments)
+    lines = EnvelopeCollection(colors=color,linewidths=1.5,capstyle='projecting',rasterized=rasterized)
+    ax.add_collection(lines,autolim=False)
+    lines.set_lc_data(time,flux)
+    ax.callbacks.connect('xlim_changed',lines.update_envelope)
+    return lines
+
+class EnvelopeCollection(LineCollection):
+    # LineCollection of the min/max envelope of a light curve (see plot_envelope)
+    def __init__(self, **kwargs):
+        super(EnvelopeCollection, self).__init__([], **kwargs)
+        self.set_gid('envelope')
+
+    def set_lc_data(self, time, flux):
+        # Replace the light curve and autoscale the axes to it
+        order = np.argsort(time,kind='stable')
+        self.lc_time, self.lc_flux = np.asarray(time)[order], np.asarray(flux)[order]
+        ax = self.axes
+        ax.ignore_existing_data_limits = True
+        ax.update_datalim([[self.lc_time[0],self.lc_flux.min()],[self.lc_time[-1],self.lc_flux.max()]])
+        ax.autoscale_view()
+        self.update_envelope(ax)
+
+    def update_envelope(self, ax):
+        xmin, xmax = ax.get_xlim()
+        self.set_segments(envelope_segments(self.lc_time,self.lc_flux,xmin,xmax,ax.bbox.width))
+
+@profiling.stage('plot_lc')
+def plot_lc(lc_file,data_type=None,decimate=False,fig=None):
+    # lc_file can also be an already extracted light curve (data_type=None).
+    # fig: decimated LC figure made before by plot_lc, updated in place
+    if data_type is None:
+        lc = lc_file
+    else:
+        lc = extract_lc(lc_file,data_type)
     flux = lc.flux.value
     time = lc.time.value
+    if decimate and fig is not None:
+        envelope = [c for c in fig.axes[0].collections if isinstance(c,EnvelopeCollection)]
+        if envelope:
+            envelope[0].set_lc_data(time,flux)
+            return fig
     w, h = figaspect(1/2)
     fig = plt.figure(figsize=(w,h),dpi=75)
     ax = fig.add_subplot(111)
     ax.set_xlabel('BJD-2457000',fontsize=14)
     ax.set_ylabel('Flux[$\mathrm{e^{-}\,s^{-1}}$]',fontsize=14)
-    ax.scatter(time,flux,s=1.5,c='blue')
-    fig.tight_layout()
+    if decimate:
+        fig.tight_layout()
+        plot_envelope(ax,time,flux)
+    else:
+        ax.scatter(time,flux,s=1.5,c='blue')
+        fig.tight_layout()
     plt.grid(color='white',linestyle='--',linewidth=1,alpha=.2)
     fig, ax = set_plotcolors(fig,ax)
     plt.close()
@@ -61,137 +269,359 @@ def set_plotcolors(fig,ax,bg_color='#323431',axis_color='#FFFFFF'):
     ax.tick_params(colors=axis_color,which='both')
     return fig,ax
 
-def get_lc(tic,TESS_sector,SAP=False):
+def get_lc(tic,TESS_sector,SAP=False,decimate=False,savefig=True):
     print('Downloading and plotting light curve')
-    lc_file = lk.search_lightcurvefile('TIC {0}'.format(tic),mission = 'TESS',sector = TESS_sector).download()
-    if SAP:
-        lc = lc_file.SAP_FLUX.remove_nans()
+    data_type = 'SAP' if SAP else 'PDCSAP'
+    if is_stitched(TESS_sector):
+        lc = load_stitched_lc(tic,data_type)
     else:
-        lc = lc_file.PDCSAP_FLUX.remove_nans()
+        lc = load_lc(tic,TESS_sector,data_type)
+    if lc is None:
+        raise ValueError('Light curve for TIC {0} sector {1} not found'.format(tic,TESS_sector))
+    if savefig:
+        with profiling.stage('plot_lc'):
+            lc_figure(lc,decimate).savefig('TIC_{0}_S_{1}_lc.png'.format(tic,TESS_sector))
+    return lc
+
+def lc_figure(lc,decimate=False):
+    # Light curve figure of the summary report
     flux = lc.flux.value
     time = lc.time.value
     w, h = figaspect(1/2)
     fig = plt.figure(figsize=(w,h))
     ax = fig.add_subplot(111)
     ax.set_xlabel('BJD-2457000',fontsize=14)
-    ax.set_ylabel('Flux[$\mathrm{e^{-}\,s^{-1}}$]',fontsize=14)
-    ax.scatter(time,flux,s=1.5,c='blue')
-    plt.savefig('TIC_{0}_S_{1}_lc.png'.format(tic,TESS_sector))
-    plt.close()
-    return lc
+    if lc.meta.get('NORMALIZED'):
+        ax.set_ylabel('Normalized flux',fontsize=14)
+    else:
+        ax.set_ylabel('Flux[$\mathrm{e^{-}\,s^{-1}}$]',fontsize=14)
+    if decimate:
+        plot_envelope(ax,time,flux)
+    else:
+        ax.scatter(time,flux,s=1.5,c='blue')
+    plt.close(fig)
+    return fig
 
-def get_periodogram(lc,sigma=None,Pbeg=None,Pend=None):
+@profiling.stage('periodogram')
+def get_periodogram(lc,sigma=None,Pbeg=None,Pend=None,engine='gls',**engine_kwargs):
     # Get periodogram
+    # engine: 'gls' uses M. Zechmeister's Gls, 'numpy' the vectorised fastgls.Gls, which
+    # accepts max_memory (MB), single (float32 sums), threads and search='adaptive'
+    # (coarse scan refined around the highest peaks) as engine_kwargs. 'fft' is fastgls.Gls
+    # with the extirpolation/FFT sums, for long (stitched) light curves
     print('Creating GLS periodogram')
     if sigma is not None:
         lc_period = lc.remove_outliers(sigma=sigma)
     else:
         lc_period = lc
-    time = list(lc_period.time.value)
-    flux = list(lc_period.flux.value)
-    error = list(lc_period.flux_err.value)
+    time = np.asarray(lc_period.time.value,dtype=float)
+    flux = np.asarray(lc_period.flux.value,dtype=float)
+    error = np.asarray(lc_period.flux_err.value,dtype=float)
     if Pbeg == None:
         Pbeg = 2*(time[1]-time[0])
     if Pend == None:
         Pend = (max(time)-min(time))/2
-    periodogram = Gls((time,flux,error),Pbeg=Pbeg,Pend=Pend)
+    if engine == 'numpy':
+        import fastgls
+        periodogram = fastgls.Gls((time,flux,error),Pbeg=Pbeg,Pend=Pend,**engine_kwargs)
+        if periodogram.nf_eval < periodogram.nf_full:
+            print('Evaluated {0} of {1} frequencies'.format(periodogram.nf_eval,periodogram.nf_full))
+    elif engine == 'fft':
+        import fastgls
+        periodogram = fastgls.Gls((time,flux,error),Pbeg=Pbeg,Pend=Pend,method='fft',**engine_kwargs)
+    elif engine == 'gls':
+        from gls import Gls
+        periodogram = Gls((list(time),list(flux),list(error)),Pbeg=Pbeg,Pend=Pend)
+    else:
+        raise ValueError('Unknown periodogram engine: {0}'.format(engine))
     return periodogram, Pbeg, Pend
 
-def periodogram_peaks(periodogram,offset=0.1,N_peaks=3,relative_height=10):
+@profiling.stage('bootstrap')
+def bootstrap_fap(periodogram,nmax=10000,workers=None,**kwargs):
+    # Empirical FAP of the highest peak from permutations of the fluxes of the periodogram,
+    # evaluated on its frequency grid with the FFT sums, whatever its engine (see bootstrap.py).
+    # After --search adaptive, on the whole fine grid rather than the frequencies evaluated
+    import bootstrap
+    print('Bootstrapping the FAP')
+    result = bootstrap.bootstrap_fap(periodogram.t,periodogram.y,getattr(periodogram,'e_y',None),
+                                     bootstrap.uniform_grid(periodogram.freq,getattr(periodogram,'nf_full',None)),
+                                     pmax=periodogram.power.max(),nmax=nmax,workers=workers,**kwargs)
+    print('FAP = {0:.4g} from {1} realizations'.format(result.FAP(),result.n))
+    return result
+
+TESS_ORBIT = 13.7      # days
+
+@profiling.stage('peaks')
+def peak_catalog(periodogram,N_peaks=None,offset=0.1,harmonics=(2,),aliases=(),relative_height=10,
+                 exclude=False,fap_model=None):
+    """
+    Peaks of a periodogram higher than max(power)/relative_height, highest first.
+
+    Parameters
+    ----------
+    N_peaks : int, optional
+        Keep only the N_peaks highest (after exclude).
+    offset : float
+        Distance in days within which a peak is taken to be at a given period.
+    harmonics : sequence of int
+        Orders n flagged as harmonics of the best period P: P/n and n*P (P itself always is).
+    aliases : sequence of float
+        Periods of the window function (e.g. TESS_ORBIT). Peaks at these periods
+        and at the aliases of P, 1/(1/P +- 1/period), are flagged as aliases.
+    exclude : bool
+        Drop the harmonics and aliases.
+    fap_model : object, optional
+        Provides FAP(power), e.g. a bootstrap_fap result. Defaults to the periodogram.
+
+    Returns
+    -------
+    Structured array with the fields period, power, harmonic, alias (flags) and
+    fap (FAP of the power of the peak).
+    """
     from scipy.signal import find_peaks
-    x = 1/periodogram.freq
     y = periodogram.power
     P = periodogram.best['P']
-    #Find peaks
-    max_power = y.max()
-    peaks = find_peaks(y,height=max_power/relative_height)
-    #print(peaks)
-    peak_pos = peaks[0]
-    peak_pos=peak_pos[(x[peak_pos] < P-offset) | (x[peak_pos] > P+offset)]
-    peak_pos=peak_pos[(x[peak_pos] < P/2-offset) | (x[peak_pos] > P/2+offset)]
-    peak_pos=peak_pos[(x[peak_pos] < 2*P-offset) | (x[peak_pos] > 2*P+offset)]
-    while len(peak_pos)>N_peaks:
-        peak_pos = np.delete(peak_pos,peak_pos.argmin())
-    periods = x[peak_pos]
-    heights = y[peak_pos]
-    return periods, heights#, peak_pos
+    pos = find_peaks(y,height=y.max()/relative_height)[0]
+    periods = 1/periodogram.freq[pos]
+    # Harmonics and aliases of P, each peak compared to all of them at once
+    orders = np.asarray(harmonics,dtype=float)
+    harmonic_periods = np.r_[P,P/orders,P*orders]
+    window = 1/np.asarray(aliases,dtype=float)
+    alias_freqs = np.r_[window,1/P+window,np.abs(1/P-window)]
+    alias_periods = 1/alias_freqs[alias_freqs > 0]
+    harmonic = (np.abs(periods[:,None]-harmonic_periods[None,:]) <= offset).any(axis=1)
+    alias = (np.abs(periods[:,None]-alias_periods[None,:]) <= offset).any(axis=1)
+    if exclude:
+        keep = ~(harmonic | alias)
+        pos, periods, harmonic, alias = pos[keep], periods[keep], harmonic[keep], alias[keep]
+    power = y[pos]
+    order = np.arange(len(pos))
+    if N_peaks is not None and N_peaks < len(pos):
+        order = np.argpartition(-power,N_peaks)[:N_peaks]
+    order = order[np.argsort(-power[order],kind='stable')]
+    if fap_model is None:
+        fap_model = periodogram
+    catalog = np.zeros(len(order),dtype=[('period','f8'),('power','f8'),('harmonic','?'),('alias','?'),('fap','f8')])
+    catalog['period'] = periods[order]
+    catalog['power'] = power[order]
+    catalog['harmonic'] = harmonic[order]
+    catalog['alias'] = alias[order]
+    catalog['fap'] = [fap_model.FAP(p) for p in catalog['power']]
+    return catalog
+
+def periodogram_peaks(periodogram,offset=0.1,N_peaks=3,relative_height=10,harmonics=(2,),aliases=()):
+    # Periods and powers of the N_peaks highest peaks that are not at P, P/2, 2P
+    # (or the other harmonics and aliases given, see peak_catalog), highest first
+    catalog = peak_catalog(periodogram,N_peaks=N_peaks,offset=offset,harmonics=harmonics,aliases=aliases,
+                           relative_height=relative_height,exclude=True)
+    return catalog['period'], catalog['power']
       
-def plot_periodogram(periodogram,tic,TESS_sector,Pbeg=None,Pend=None,off=0.1,N=3,savefig=False):
+@profiling.stage('plot_periodogram')
+def plot_periodogram(periodogram,tic,TESS_sector,Pbeg=None,Pend=None,off=0.1,N=3,savefig=False,fig=None,
+                     fap_model=None):
+    # fig: figure made before by plot_periodogram, updated in place
+    # fap_model: provides FAP() and powerLevel(), e.g. the bootstrap_fap of the periodogram.
+    # Defaults to the analytic ones of the periodogram
     print('Plotting periodogram')
+    if fap_model is None:
+        fap_model = periodogram
     color = plt.cm.tab20c(np.linspace(0, 1, 8))
     best_period = periodogram.best['P']
     period_error = periodogram.best['e_P']
-    fap = periodogram.FAP()
+    fap = fap_model.FAP()
     FAP_levels = [0.1,0.01,0.001]
     linestyles = [':','dotted','solid']
-    w, h = figaspect(1/1.5)
-    fig = plt.figure(figsize=(w,h),dpi=75)
-    ax = fig.add_subplot(111)
-    ax.set_ylabel('Power (ZK)',fontsize=14)
-    ax.set_xlabel('P [ d ]',fontsize=14)
-    ax.set_xlim(Pbeg,Pend)
     period = 1/periodogram.freq
     power = periodogram.power
     max_power = power.max()
-    power_levels = [[periodogram.powerLevel(i)]*len(period) for i in FAP_levels]
+    power_levels = [fap_model.powerLevel(i) for i in FAP_levels]
     peaks, heights = periodogram_peaks(periodogram, offset=off,N_peaks=N)
-    ax.plot(period,power,'b-',linewidth=.8)
-    ax.axvline(x=best_period*2,color='orange',linewidth=2,alpha=.5)
-    ax.axvline(x=best_period/2,color='orange',linewidth=2,alpha=.5)
-    for i in range(len(FAP_levels)):
-        plt.plot(period,power_levels[i],linestyle=linestyles[i],linewidth=.8,c='red')
-    plt.scatter(best_period,max_power,c='r',s=20,label='P={0} d'.format(round(best_period,4)))
+    new = fig is None
+    if new:
+        w, h = figaspect(1/1.5)
+        fig = plt.figure(figsize=(w,h),dpi=75)
+        ax = fig.add_subplot(111)
+        ax.set_ylabel('Power (ZK)',fontsize=14)
+        ax.set_xlabel('P [ d ]',fontsize=14)
+        ax.set_xlim(Pbeg,Pend)
+        ax.plot(period,power,'b-',linewidth=.8,gid='power')
+        ax.axvline(x=best_period*2,color='orange',linewidth=2,alpha=.5,gid='2P')
+        ax.axvline(x=best_period/2,color='orange',linewidth=2,alpha=.5,gid='P/2')
+        for i in range(len(FAP_levels)):
+            ax.axhline(power_levels[i],linestyle=linestyles[i],linewidth=.8,c='red',gid='FAP{0}'.format(i))
+    else:
+        ax = fig.axes[0]
+        artists = {a.get_gid():a for a in ax.get_children() if a.get_gid()}
+        artists['power'].set_data(period,power)
+        artists['2P'].set_xdata([best_period*2]*2)
+        artists['P/2'].set_xdata([best_period/2]*2)
+        for i in range(len(FAP_levels)):
+            artists['FAP{0}'.format(i)].set_ydata([power_levels[i]]*2)
+        for a in list(ax.collections):
+            if a.get_gid() == 'peak':
+                a.remove()
+        ax.relim()
+        ax.autoscale_view()
+        ax.set_xlim(Pbeg,Pend)
+    ax.scatter(best_period,max_power,c='r',s=20,label='P={0} d'.format(round(best_period,4)),gid='peak')
     for i,c in zip(range(len(peaks)),color):
-        plt.scatter(peaks[i],heights[i],c=c,s=20,label=r'P$_{0}$={1} d'.format(i+2,round(peaks[i],4)))
-    plt.legend(loc='best')
-    ax.minorticks_on()
+        ax.scatter(peaks[i],heights[i],c=c,s=20,label=r'P$_{0}$={1} d'.format(i+2,round(peaks[i],4)),gid='peak')
+    ax.legend(loc='best').set_gid('legend')
+    if new:
+        ax.minorticks_on()
     if savefig:
-        plt.savefig('TIC_{0}_S_{1}_periodogram.png'.format(tic,TESS_sector))
-    fig.tight_layout()
-    fig, ax = set_plotcolors(fig,ax)
-    plt.close()
+        fig.savefig('TIC_{0}_S_{1}_periodogram.png'.format(tic,TESS_sector))
+    if new:
+        fig.tight_layout()
+        fig, ax = set_plotcolors(fig,ax)
+        plt.close()
     return fig,best_period,period_error,fap
   
-def fold_lc(lc,best_period,tic=None,TESS_sector=None,sig=None,savefig=False):
-    print('Plotting phased LC')
-    # Fold lightcurve  
-    lc_clean = lc.remove_outliers(sigma=10)
-    lc_folded = lc_clean.fold(period=best_period,normalize_phase=True)#.remove_outliers(sigma = 10)
-    flux = lc_folded.flux.value
-    phase = lc_folded.phase.value#/(max(lc_folded.phase.value)-min(lc_folded.phase.value))
-    lc_5sig = lc.remove_outliers(sigma=5)
-    folded_5sig = lc_5sig.fold(period=best_period,normalize_phase=True)
-    sig5_lim = (max(folded_5sig.flux.value),min(folded_5sig.flux.value))
+def clip_mask(flux,sigma):
+    # Points kept by lc.remove_outliers(sigma=sigma) (astropy sigma_clip with its defaults)
+    from astropy.stats import sigma_clip
+    return ~np.ma.getmaskarray(sigma_clip(np.asarray(flux,dtype=float),sigma=sigma))
+
+def fold_phase(time,period,epoch=None):
+    # Phase in [-0.5,0.5) of every time, as lc.fold(period,normalize_phase=True),
+    # the epoch defaulting to the first time of the light curve
+    time = np.asarray(time,dtype=float)
+    if epoch is None:
+        epoch = time[0]
+    return ((time-epoch)/period+0.5) % 1 - 0.5
+
+def fold_arrays(time,flux,period,epoch=None):
+    # Folded (phase, flux) sorted by phase
+    phase = fold_phase(time,period,epoch)
+    order = np.argsort(phase,kind='stable')
+    return phase[order], np.asarray(flux)[order]
+
+def bin_folded(phase,flux,nbins=200):
+    """
+    Median and scatter (standard deviation) of the flux in nbins phase bins.
+    phase must be sorted. Empty bins are dropped.
+    """
+    edges = np.linspace(-0.5,0.5,nbins+1)
+    idx = np.clip(np.searchsorted(edges,phase,side='right')-1,0,nbins-1)
+    starts = np.flatnonzero(np.r_[True,idx[1:]!=idx[:-1]])
+    counts = np.diff(np.r_[starts,len(idx)])
+    centres = 0.5*(edges[idx[starts]]+edges[idx[starts]+1])
+    # Median: sort the flux within each bin and take the middle element(s)
+    sorted_flux = np.asarray(flux,dtype=float)[np.lexsort((flux,idx))]
+    lo = starts+(counts-1)//2
+    hi = starts+counts//2
+    median = 0.5*(sorted_flux[lo]+sorted_flux[hi])
+    sums = np.add.reduceat(sorted_flux,starts)
+    sums2 = np.add.reduceat(sorted_flux**2,starts)
+    mean = sums/counts
+    scatter = np.sqrt(np.maximum(sums2/counts-mean**2,0))
+    return centres, median, scatter
+
+def fold_phases(time,periods,epoch=None):
+    # Phases of every time for several periods at once, array of shape (len(periods),len(time))
+    time = np.asarray(time,dtype=float)
+    if epoch is None:
+        epoch = time[0]
+    periods = np.asarray(periods,dtype=float)
+    return ((time-epoch)[np.newaxis,:]/periods[:,np.newaxis]+0.5) % 1 - 0.5
+
+def fold_inputs(lc):
+    # Time and flux of the LC without 10 sigma outliers, and the 5 sigma flux limits
+    time = lc.time.value
+    flux = lc.flux.value
+    keep = clip_mask(flux,10)
+    keep5 = clip_mask(flux,5)
+    sig5_lim = (np.max(flux[keep5]),np.min(flux[keep5]))
+    return time[keep], flux[keep], sig5_lim
+
+def update_fold_figure(fig,phase,flux,sig5_lim):
+    # Put a new fold in a (not binned) figure made by fold_figure. False if fig is not one
+    artists = {a.get_gid():a for a in fig.axes[0].get_children() if a.get_gid()} if fig is not None else {}
+    if 'fold' not in artists:
+        return False
+    shift = phase[-1]-phase[0]
+    split = np.searchsorted(phase,0,side='right')
+    artists['fold'].set_offsets(np.column_stack([phase,flux]))
+    artists['fold_left'].set_offsets(np.column_stack([phase[split:]-shift,flux[split:]]))
+    artists['fold_right'].set_offsets(np.column_stack([phase[:split]+shift,flux[:split]]))
+    xmin = phase[split]-shift if split<len(phase) else phase[0]
+    xmax = phase[split-1]+shift if split>0 else phase[-1]
+    artists['sig5_copies'].set_segments([[[xmin,y],[xmax,y]] for y in sig5_lim])
+    artists['sig5'].set_segments([[[phase[0],y],[phase[-1],y]] for y in sig5_lim])
+    fig.axes[0].set_ylim(bottom=flux.min(),top=flux.max())
+    return True
+
+def fold_figure(phase,flux,sig5_lim,binned=False,nbins=200,savefile=None,fig=None):
+    # Folded LC figure from phases sorted in increasing order. Built on a bare Figure
+    # (not pyplot) so that no figure is left open in pyplot.
+    # fig: figure made before by fold_figure, updated in place if it is not binned
+    if not binned and savefile is None and update_fold_figure(fig,phase,flux,sig5_lim):
+        return fig
+    from matplotlib.figure import Figure
     w, h = figaspect(1/2)
-    fig = plt.figure(figsize=(w,h),dpi=75)
+    fig = Figure(figsize=(w,h),dpi=75)
     ax = fig.add_subplot(111)
     ax.set_xlabel('Phase',fontsize=14)
     ax.set_ylabel('Flux [$\mathrm{e^{-}\,s^{-1}}$]',fontsize=14)
     #ax.set_ylabel('Normalized Flux',fontsize=14)
-    plt.scatter(phase,flux,s=2,c='red')
     ax.set_xlim(-1,1)
-    ax.set_ylim(bottom=min(flux),top=max(flux))
-    len_phase = len(phase)
-    lim = int(len_phase/2)
-    phase1 = [p for p in phase if p<=0]
-    phase1_shift = [p-phase[0]+phase[-1] for p in phase1]
-    flux1 = [flux[i] for i in range(len(flux)) if phase[i]<=0]
-    phase2 = [p for p in phase if p>0]
-    phase2_shift = [p+phase[0]-phase[-1] for p in phase2]
-    flux2 = [flux[i] for i in range(len(flux)) if phase[i]>0]
-    plt.scatter(phase2_shift,flux2,s=2,c='lightgrey')
-    plt.scatter(phase1_shift,flux1,s=2,c='lightgrey')
-    plt.grid(color='white',linestyle='--',linewidth=1,alpha=.2)
-    phase_shift = phase2_shift+phase1_shift
-    for i in range(2):
-        plt.plot(phase_shift,[sig5_lim[i]]*len(phase_shift),linewidth=.85,linestyle='dashed',color = 'lightgrey')
-        plt.plot(phase,[sig5_lim[i]]*len(phase),linewidth=.85,linestyle='dashed',color='darkblue')
-    if savefig:
-        plt.savefig('TIC_{0}_S_{1}_lcfolded.png'.format(tic,TESS_sector))
+    ax.set_ylim(bottom=flux.min(),top=flux.max())
+    # Copies of the fold shifted by one cycle on each side
+    # (phase is sorted, so the points with phase<=0 are the first ones)
+    shift = phase[-1]-phase[0]
+    split = np.searchsorted(phase,0,side='right')
+    if binned:
+        centres, median, scatter = bin_folded(phase,flux,nbins)
+        ax.errorbar(centres,median,yerr=scatter,fmt='o',ms=3,color='red',ecolor='red',elinewidth=.6)
+        first_bins = centres<=0
+        for c, m, s in ((centres[first_bins]+shift,median[first_bins],scatter[first_bins]),
+                        (centres[~first_bins]-shift,median[~first_bins],scatter[~first_bins])):
+            ax.errorbar(c,m,yerr=s,fmt='o',ms=3,color='lightgrey',ecolor='lightgrey',elinewidth=.6)
+    else:
+        ax.scatter(phase,flux,s=2,c='red',gid='fold')
+        ax.scatter(phase[split:]-shift,flux[split:],s=2,c='lightgrey',gid='fold_left')
+        ax.scatter(phase[:split]+shift,flux[:split],s=2,c='lightgrey',gid='fold_right')
+    ax.grid(color='white',linestyle='--',linewidth=1,alpha=.2)
+    # 5 sigma limits over the shifted copies and over the fold
+    xmin = phase[split]-shift if split<len(phase) else phase[0]
+    xmax = phase[split-1]+shift if split>0 else phase[-1]
+    ax.hlines(sig5_lim,xmin,xmax,linewidth=.85,linestyle='dashed',color='lightgrey',gid='sig5_copies')
+    ax.hlines(sig5_lim,phase[0],phase[-1],linewidth=.85,linestyle='dashed',color='darkblue',gid='sig5')
+    if savefile is not None:
+        fig.savefig(savefile)
     fig.tight_layout()
     fig, ax = set_plotcolors(fig,ax)
-    plt.close()
     return fig
+
+@profiling.stage('fold_lc')
+def fold_lc(lc,best_period,tic=None,TESS_sector=None,sig=None,savefig=False,binned=False,nbins=200,fig=None):
+    print('Plotting phased LC')
+    # Fold lightcurve  
+    time, flux, sig5_lim = fold_inputs(lc)
+    phase, flux = fold_arrays(time,flux,best_period)
+    savefile = 'TIC_{0}_S_{1}_lcfolded.png'.format(tic,TESS_sector) if savefig else None
+    return fold_figure(phase,flux,sig5_lim,binned=binned,nbins=nbins,savefile=savefile,fig=fig)
+
+@profiling.stage('fold_lc')
+def fold_many(lc,periods,binned=False,nbins=200,figs=None):
+    """
+    Folded LC figures (as fold_lc) of several periods. The outliers are clipped
+    once and the phases of all periods are computed and sorted together.
+    figs: figures made before by fold_many/fold_lc (None where there is none),
+    updated in place.
+    """
+    if len(periods) == 0:
+        return []
+    print('Plotting phased LCs')
+    time, flux, sig5_lim = fold_inputs(lc)
+    phases = fold_phases(time,periods)
+    order = np.argsort(phases,axis=1,kind='stable')
+    phases = np.take_along_axis(phases,order,axis=1)
+    fluxes = flux[order]
+    # matplotlib text layout is not thread safe, so the figures are built one after another
+    figs = list(figs) if figs is not None else []
+    figs += [None]*(len(periods)-len(figs))
+    return [fold_figure(phases[i],fluxes[i],sig5_lim,binned,nbins,fig=figs[i]) for i in range(len(periods))]
   
 def get_poll(data_table):
 #    import pandas as pd
@@ -207,51 +637,32 @@ def get_poll(data_table):
     flux_fraction = 1/(sum(flux)+1)
     return flux_fraction,Gmag_principal,data_table['GaiaID'][0],Nin
 
-def draw_figure(canvas, figure):
-    if canvas.children:
-        for child in canvas.winfo_children():
-            child.destroy()
-    figure_canvas_agg = FigureCanvasTkAgg(figure, master=canvas)
-    figure_canvas_agg.draw()
-    figure_canvas_agg.get_tk_widget().pack(side='top', fill='both', expand=1)
-    return figure_canvas_agg
+def summary_files(tic,TESS_sector):
+    # Files written for a target by the terminal version
+    names = ['lc.png','periodogram.png','lcfolded.png','tpf.png','summary.pdf']
+    return ['TIC_{0}_S_{1}_{2}'.format(tic,TESS_sector,name) for name in names]
 
+def summary_title(tic,TESS_sector,best_period,period_error,fap,Gflux=None):
+    # Header line of the summary of a target
+    Gflux_frac = ' FG_ratio = {0}'.format(Gflux) if Gflux else ''
+    if round(fap,4) == 0.0:
+        return 'TIC {0} sector {1} P_rot = ({2}'.format(tic,
+             TESS_sector,round(best_period,4))+u'\u00b1'+'{0})d with FAP < 0.0001 {1}'.format(round(period_error,4),
+             Gflux_frac)
+    return 'TIC {0} sector {1} P_rot = ({2}'.format(tic,
+         TESS_sector,round(best_period,4))+u'\u00b1'+'{0})d with FAP = {1}'.format(round(period_error,4),
+         round(fap,4))+Gflux_frac
+
+@profiling.stage('summary_pdf')
 def summary_pdf(tic,TESS_sector,best_period,period_error,fap,Gflux=None):
     from fpdf import FPDF
     pdf = FPDF('L','mm','A4')
     pdf.set_font('Arial','B',16)
     pdf.set_text_color(125,125,125)
     pdf.add_page()
-    Gflux_frac = ' FG_ratio = {0}'.format(Gflux) if Gflux else ''
-    if round(fap,4) == 0.0:
-        pdf.cell(w=300,txt='TIC {0} sector {1} P_rot = ({2}'.format(tic,
-             TESS_sector,round(best_period,4))+u'\u00b1'+'{0})d with FAP < 0.0001 {1}'.format(round(period_error,4),
-             Gflux_frac))
-    else:                                                                                   
-        pdf.cell(w=300,txt='TIC {0} sector {1} P_rot = ({2}'.format(tic,
-             TESS_sector,round(best_period,4))+u'\u00b1'+'{0})d with FAP = {1}'.format(round(period_error,4),
-             round(fap,4))+Gflux_frac)
+    pdf.cell(w=300,txt=summary_title(tic,TESS_sector,best_period,period_error,fap,Gflux))
     pdf.image('TIC_{0}_S_{1}_tpf.png'.format(tic,TESS_sector),w=100,h=85,x=20,y=20)
     pdf.image('TIC_{0}_S_{1}_lc.png'.format(tic,TESS_sector),w=165,h=85,x=120,y=20)
     pdf.image('TIC_{0}_S_{1}_periodogram.png'.format(tic,TESS_sector),w=110,h=85,x=20,y=110)
     pdf.image('TIC_{0}_S_{1}_lcfolded.png'.format(tic,TESS_sector),w=165,h=85,x=120,y=110)
     pdf.output('TIC_{0}_S_{1}_summary.pdf'.format(tic,TESS_sector))
-
-
-def draw_figure_w_toolbar(canvas, fig, canvas_toolbar):
-    if canvas.children:
-        for child in canvas.winfo_children():
-            child.destroy()
-    if canvas_toolbar.children:
-        for child in canvas_toolbar.winfo_children():
-            child.destroy()
-    figure_canvas_agg = FigureCanvasTkAgg(fig, master=canvas)
-    figure_canvas_agg.draw()
-    toolbar = Toolbar(figure_canvas_agg, canvas_toolbar)
-    toolbar.update()
-    figure_canvas_agg.get_tk_widget().pack(side='right', fill='both', expand=2)
-
-# ??? 
-class Toolbar(NavigationToolbar2Tk):
-    def __init__(self, *args, **kwargs):
-        super(Toolbar, self).__init__(*args, **kwargs)
@@ -0,0 +1,159 @@
+"""
+Local Gaia DR2 catalog for the tpfplotter cone searches.
+
+The catalog is split in declination bands. Each band is stored as a columnar
+.npz file with the Vizier I/345/gaia2 column names (RA_ICRS, DE_ICRS, Source,
+Plx, pmRA, pmDE, Gmag). A band is loaded the first time it is needed, and
+a KD-tree of the unit vectors of its sources is built and kept in memory, so
+a cone search only visits the bands crossing the cone and answers from the
+trees.
+
+Positions are those of the catalog (epoch J2015.5), as returned by Vizier; the
+proper motion propagation is left to the caller (add_gaia_figure_elements).
+
+Build a store from a catalog dump (csv files from the Gaia archive or Vizier):
+    python gaiacat.py store_dir dump1.csv [dump2.csv ...]
+and select it with set_store(store_dir) or the TESSDIAG_GAIA environment variable.
+"""
+
+import os
+import sys
+import json
+import glob
+
+import numpy as np
+
+COLUMNS = ['RA_ICRS', 'DE_ICRS', 'Source', 'Plx', 'pmRA', 'pmDE', 'Gmag']
+# Gaia archive column names of a dump and their Vizier equivalents
+ARCHIVE_NAMES = {'ra': 'RA_ICRS', 'dec': 'DE_ICRS', 'source_id': 'Source', 'parallax': 'Plx',
+                 'pmra': 'pmRA', 'pmdec': 'pmDE', 'phot_g_mean_mag': 'Gmag'}
+
+_store = None
+_store_checked = False
+
+
+def get_store():
+    # Local catalog in use, None if there is none (tpfplotter then queries Vizier)
+    global _store, _store_checked
+    if _store is None and not _store_checked:
+        _store_checked = True
+        path = os.environ.get('TESSDIAG_GAIA')
+        if path:
+            _store = GaiaStore(path)
+    return _store
+
+
+def set_store(path):
+    global _store
+    _store = GaiaStore(path) if path is not None else None
+    return _store
+
+
+def _unit_vectors(ra, dec):
+    ra, dec = np.deg2rad(ra), np.deg2rad(dec)
+    cosdec = np.cos(dec)
+    return np.column_stack([cosdec * np.cos(ra), cosdec * np.sin(ra), np.sin(dec)])
+
+
+class GaiaStore:
+    """
+    Parameters
+    ----------
+    path : str
+        Directory written by build_store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.band_width = meta['band_width']
+        self.nbands = int(round(180 / self.band_width))
+        self._bands = {}
+
+    def _band(self, i):
+        # Columns and KD-tree of band i, loaded on first use
+        if i not in self._bands:
+            from scipy.spatial import cKDTree
+            filename = os.path.join(self.path, 'band_{0:04d}.npz'.format(i))
+            if os.path.exists(filename):
+                with np.load(filename) as data:
+                    columns = {name: data[name] for name in COLUMNS}
+            else:
+                columns = {name: np.zeros(0) for name in COLUMNS}
+            tree = cKDTree(_unit_vectors(columns['RA_ICRS'], columns['DE_ICRS']))
+            self._bands[i] = (columns, tree)
+        return self._bands[i]
+
+    def query_arrays(self, ra, dec, radius):
+        """
+        Sources within radius (deg) of (ra, dec) (deg), as a dict of column arrays.
+        """
+        lo = max(int(np.floor((dec - radius + 90) / self.band_width)), 0)
+        hi = min(int(np.floor((dec + radius + 90) / self.band_width)), self.nbands - 1)
+        centre = _unit_vectors(np.atleast_1d(ra), np.atleast_1d(dec))[0]
+        chord = 2 * np.sin(np.deg2rad(radius) / 2)
+        parts = []
+        for i in range(lo, hi + 1):
+            columns, tree = self._band(i)
+            idx = tree.query_ball_point(centre, chord)
+            if len(idx):
+                parts.append({name: columns[name][idx] for name in COLUMNS})
+        if not parts:
+            return {name: np.zeros(0) for name in COLUMNS}
+        if len(parts) == 1:
+            return parts[0]
+        return {name: np.concatenate([p[name] for p in parts]) for name in COLUMNS}
+
+    def query(self, ra, dec, radius):
+        # Same as query_arrays, as a pandas DataFrame like Vizier's result.to_pandas()
+        import pandas as pd
+        return pd.DataFrame(self.query_arrays(ra, dec, radius), columns=COLUMNS)
+
+
+def build_store(dump_files, path, band_width=1.0, chunksize=10**6):
+    """
+    Write a store from csv dumps of the catalog. Columns may use the Vizier
+    or the Gaia archive names; rows without position or G magnitude are skipped.
+    """
+    import pandas as pd
+    os.makedirs(path, exist_ok=True)
+    nbands = int(round(180 / band_width))
+    npart = 0
+    # Pass 1: split every chunk of the dumps into per band parts
+    for dump in dump_files:
+        for chunk in pd.read_csv(dump, chunksize=chunksize):
+            chunk = chunk.rename(columns=ARCHIVE_NAMES)
+            missing = [name for name in COLUMNS if name not in chunk.columns]
+            if missing:
+                raise ValueError('{0} lacks the columns {1}'.format(dump, missing))
+            chunk = chunk[COLUMNS].dropna(subset=['RA_ICRS', 'DE_ICRS', 'Gmag'])
+            band = np.clip(((chunk['DE_ICRS'].values + 90) // band_width).astype(int), 0, nbands - 1)
+            for i in np.unique(band):
+                part = chunk[band == i]
+                np.savez(os.path.join(path, 'band_{0:04d}.part{1:06d}.npz'.format(i, npart)),
+                         **{name: part[name].values for name in COLUMNS})
+            npart += 1
+    # Pass 2: merge the parts of each band
+    for i in range(nbands):
+        parts = sorted(glob.glob(os.path.join(path, 'band_{0:04d}.part*.npz'.format(i))))
+        if not parts:
+            continue
+        columns = {name: [] for name in COLUMNS}
+        for part in parts:
+            with np.load(part) as data:
+                for name in COLUMNS:
+                    columns[name].append(data[name])
+        np.savez(os.path.join(path, 'band_{0:04d}.npz'.format(i)),
+                 **{name: np.concatenate(columns[name]) for name in COLUMNS})
+        for part in parts:
+            os.remove(part)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'band_width': band_width, 'columns': COLUMNS}, f)
+    return GaiaStore(path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.exit('usage: python gaiacat.py store_dir dump.csv [dump.csv ...]')
+    build_store(sys.argv[2:], sys.argv[1])
@@ -0,0 +1,257 @@
+"""
+On-disk cache of cleaned light curve arrays.
+
+Each entry holds the time, flux and flux_err arrays of one (TIC, sector,
+SAP|PDCSAP) light curve after remove_nans(), stored as .npy files so they can
+be opened memory mapped. Next to the arrays, meta.json records the FITS file
+they were extracted from and its checksum, and the fingerprint of the data
+source (datasource.DataSource.fingerprint) it came from: an entry whose
+source file has changed is discarded and, once the file is gone (e.g. the
+lightkurve download cache was cleared), so is an entry whose data source
+fingerprint changed. An entry with neither is never used. index.json keeps the size of every entry so the least
+recently used entries can be evicted when the cache exceeds its size limit.
+
+The cache directory defaults to ~/.tessdiagnosis-cache/lc and can be set with
+the TESSDIAG_CACHE environment variable (size limit in MB: TESSDIAG_CACHE_SIZE).
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:     # Windows: no locking of the index
+    fcntl = None
+
+CACHE_DIR = os.environ.get('TESSDIAG_CACHE', os.path.join(os.path.expanduser('~'), '.tessdiagnosis-cache', 'lc'))
+MAX_SIZE = float(os.environ.get('TESSDIAG_CACHE_SIZE', 2048))
+
+_cache = None
+
+
+def get_cache():
+    # Cache shared by the whole process
+    global _cache
+    if _cache is None:
+        _cache = LCCache()
+    return _cache
+
+
+def set_cache(cache_dir=CACHE_DIR, max_size=MAX_SIZE):
+    global _cache
+    _cache = LCCache(cache_dir, max_size)
+    return _cache
+
+
+def file_checksum(path, blocksize=2**20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _json(value):
+    # value as it is read back from meta.json (tuples become lists...)
+    return None if value is None else json.loads(json.dumps(value))
+
+
+class _EntryCache:
+    """
+    Directory of entries (one subdirectory each) with an index of their sizes,
+    evicting the least recently used entries beyond max_size. The caches built
+    on it define their own keys and what an entry holds.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cache.
+    max_size : float
+        Size limit in MB. 0 disables the cache.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.enabled = max_size > 0
+        if self.enabled:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.index_file = os.path.join(cache_dir, 'index.json')
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _touch(self, key):
+        # The modification time of the entry is its last access for the LRU eviction.
+        # False if another process evicted it meanwhile
+        try:
+            os.utime(self._entry(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _commit(self, key, write):
+        # Store the entry of key, whose files write(directory) writes. They are written
+        # into a temporary directory first so readers never see half an entry
+        tmp = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp_')
+        try:
+            write(tmp)
+            size = sum(os.path.getsize(os.path.join(tmp, f)) for f in os.listdir(tmp))
+            entry = self._entry(key)
+            if os.path.exists(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            os.replace(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+        with self._locked_index() as index:
+            index[key] = size
+            self._evict(index)
+        return True
+
+    def remove(self, key):
+        shutil.rmtree(self._entry(key), ignore_errors=True)
+        with self._locked_index() as index:
+            index.pop(key, None)
+
+    def clear(self):
+        with self._locked_index() as index:
+            for key in list(index):
+                shutil.rmtree(self._entry(key), ignore_errors=True)
+            index.clear()
+
+    def size(self):
+        with self._locked_index() as index:
+            return sum(index.values()) / 2**20
+
+    def _evict(self, index):
+        # Remove least recently used entries until the cache fits in max_size
+        total = sum(index.values())
+        limit = self.max_size * 2**20
+        if total <= limit:
+            return
+        def last_access(key):
+            try:
+                return os.path.getmtime(self._entry(key))
+            except OSError:
+                return 0
+        for key in sorted(index, key=last_access):
+            if total <= limit:
+                break
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total -= index.pop(key)
+
+    def _locked_index(self):
+        return _LockedIndex(self.index_file)
+
+
+class LCCache(_EntryCache):
+    """
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cache.
+    max_size : float
+        Size limit in MB. 0 disables the cache.
+    """
+    arrays = ('time', 'flux', 'flux_err')
+
+    def __init__(self, cache_dir=CACHE_DIR, max_size=MAX_SIZE):
+        _EntryCache.__init__(self, cache_dir, max_size)
+
+    @staticmethod
+    def key(tic, sector, flux_type):
+        return 'TIC{0}_S{1}_{2}'.format(int(tic), int(sector), flux_type)
+
+    def get(self, tic, sector, flux_type, mmap=True, fingerprint=None):
+        """
+        Cached (time, flux, flux_err) arrays of a light curve, or None.
+        With mmap the arrays are opened read-only and memory mapped.
+        fingerprint is that of the data source in use, checked when the
+        source file of the entry no longer exists.
+        """
+        if not self.enabled:
+            return None
+        key = self.key(tic, sector, flux_type)
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not self._valid(meta, fingerprint):
+            self.remove(key)
+            return None
+        mode = 'r' if mmap else None
+        try:
+            data = tuple(np.load(os.path.join(entry, name + '.npy'), mmap_mode=mode) for name in self.arrays)
+        except (OSError, ValueError):
+            self.remove(key)
+            return None
+        # (arrays already opened stay readable if the entry is evicted meanwhile)
+        self._touch(key)
+        return data
+
+    def _valid(self, meta, fingerprint=None):
+        # Entries are checked against the file they came from while it exists (the
+        # checksum is only recomputed if the file size or time changed), otherwise
+        # against the fingerprint of the data source
+        source = meta.get('source')
+        if source is None or meta.get('checksum') is None or not os.path.exists(source):
+            return meta.get('fingerprint') is not None and meta['fingerprint'] == _json(fingerprint)
+        stat = os.stat(source)
+        if stat.st_size == meta['source_size'] and stat.st_mtime == meta['source_mtime']:
+            return True
+        return file_checksum(source) == meta['checksum']
+
+    def put(self, tic, sector, flux_type, time, flux, flux_err, source=None, fingerprint=None):
+        # Store the arrays of a light curve, source being the FITS file they come from
+        # and fingerprint that of the data source
+        if not self.enabled:
+            return
+        key = self.key(tic, sector, flux_type)
+        meta = {'tic': int(tic), 'sector': int(sector), 'flux_type': flux_type, 'source': None,
+                'fingerprint': _json(fingerprint)}
+        if source is not None and os.path.exists(source):
+            stat = os.stat(source)
+            meta.update({'source': os.path.abspath(source), 'checksum': file_checksum(source),
+                         'source_size': stat.st_size, 'source_mtime': stat.st_mtime})
+        def write(directory):
+            for name, array in zip(self.arrays, (time, flux, flux_err)):
+                np.save(os.path.join(directory, name + '.npy'), np.asarray(array, dtype=float))
+            with open(os.path.join(directory, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+        self._commit(key, write)
+
+
+class _LockedIndex:
+    # index.json read and written under an exclusive lock, so that several
+    # processes (batch mode) can share the cache
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.lock = open(self.path + '.lock', 'w')
+        if fcntl is not None:
+            fcntl.flock(self.lock, fcntl.LOCK_EX)
+        try:
+            with open(self.path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+        return self.index
+
+    def __exit__(self, *exc):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.path)
+        if fcntl is not None:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.lock.close()
+        return False
@@ -0,0 +1,195 @@
+"""
+Background prefetch of the data of the next targets to inspect in the GUI.
+
+As soon as a TIC and sector are known, Prefetcher starts loading their light
+curves (functions.load_lcs, or every sector stitched for sector 'all') and
+their TPF with the Gaia sources around it
+(tpfplotter.fetch_tpf) in worker threads, so that the "Download LC" and "Get
+TPF" buttons only have to plot what is already in memory. Finished results are
+kept within a memory budget: the least recently used targets are dropped first.
+
+The workers are daemon threads: closing the GUI does not wait for a slow
+download, whose result is simply never used.
+"""
+
+import threading
+import collections
+from queue import Queue
+
+import numpy as np
+
+import profiling
+
+KINDS = ('lc', 'tpf')
+
+
+def target_key(tic, sector):
+    # (TIC, sector) as ints, sector None if it was not given ('all': every sector, stitched)
+    if sector in (None, '', 'None'):
+        sector = None
+    elif str(sector).lower() == 'all':
+        sector = 'all'
+    else:
+        sector = int(sector)
+    return int(tic), sector
+
+
+def fetch(kind, tic, sector):
+    # What the GUI needs of a target: light curves or TPF and Gaia sources
+    with profiling.target(job='prefetch ' + kind, tic=tic, sector=sector):
+        if kind == 'lc':
+            import functions as fn
+            if sector == 'all':
+                import datasource
+                sectors = datasource.get_source().sectors(tic)
+                # Both fluxes of each sector from one read of its file, then stitched from the cache
+                for s in sectors:
+                    fn.load_lcs(tic, s)
+                lcs = {data_type: fn.load_stitched_lc(tic, data_type, sectors) for data_type in ('PDCSAP', 'SAP')}
+                return None if None in lcs.values() else lcs
+            return fn.load_lcs(tic, sector)
+        import tpfplotter
+        # Stitched sectors: the TPF of the first sector, as in the terminal version
+        return tpfplotter.fetch_tpf(str(tic), sector=None if sector in (None, 'all') else str(sector))
+
+
+def result_size(value):
+    # Approximate memory used by a result, in bytes
+    if value is None:
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(result_size(v) for v in value.values())
+    if hasattr(value, 'memory_usage'):      # pandas DataFrame
+        return int(value.memory_usage(deep=True).sum())
+    if hasattr(value, 'colnames'):          # lightkurve LightCurve (astropy table)
+        return sum(np.asarray(value[name]).nbytes for name in value.colnames)
+    if hasattr(value, 'hdu'):               # lightkurve TPF
+        return sum(hdu.data.nbytes for hdu in value.hdu if getattr(hdu, 'data', None) is not None)
+    return 0
+
+
+class Task:
+    # One fetch of one target. The result is available once done is set.
+    def __init__(self, kind, key):
+        self.kind = kind
+        self.key = key
+        self.done = threading.Event()
+        self.cancelled = False
+        self.result = None
+        self.error = None
+        self.size = 0
+        self.waiting = 0        # callers of Prefetcher.get waiting for it
+
+    def get(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise TimeoutError('{0} of TIC {1} sector {2} not ready'.format(self.kind, *self.key))
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Prefetcher:
+    """
+    Parameters
+    ----------
+    max_memory : float
+        Memory budget for the finished results, in MB.
+    workers : int
+        Number of worker threads (fetches running at the same time).
+    fetch : callable, optional
+        fetch(kind, tic, sector) -> result. Defaults to the module function fetch.
+    """
+
+    def __init__(self, max_memory=512, workers=3, fetch=fetch):
+        self.max_memory = max_memory
+        self.fetch = fetch
+        self.tasks = collections.OrderedDict()      # (kind, key) -> Task, least recently used first
+        self.lock = threading.Lock()
+        self.queue = Queue()
+        for i in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            if task.cancelled:
+                task.done.set()
+                continue
+            try:
+                task.result = self.fetch(task.kind, *task.key)
+            except (Exception, SystemExit) as e:
+                task.error = e
+            task.size = result_size(task.result)
+            task.done.set()
+            with self.lock:
+                self._evict()
+
+    def _evict(self):
+        # Drop the least recently used finished results beyond the memory budget
+        total = sum(task.size for task in self.tasks.values())
+        limit = self.max_memory * 2**20
+        for name in list(self.tasks):
+            if total <= limit:
+                break
+            task = self.tasks[name]
+            if task.done.is_set():
+                total -= task.size
+                del self.tasks[name]
+
+    def _task(self, kind, key):
+        # Task of a target, submitted if there is none (or it failed or was cancelled)
+        task = self.tasks.get((kind, key))
+        if task is None or task.cancelled or (task.done.is_set() and task.error is not None):
+            task = Task(kind, key)
+            self.tasks[(kind, key)] = task
+            self.queue.put(task)
+        self.tasks.move_to_end((kind, key))
+        return task
+
+    def prefetch(self, tic, sector, kinds=KINDS):
+        """Start fetching the data of a target in the background."""
+        key = target_key(tic, sector)
+        with self.lock:
+            for kind in kinds:
+                self._task(kind, key)
+
+    def get(self, kind, tic, sector, timeout=None):
+        """
+        Result of a fetch, waiting for it if it is still running and starting it
+        if it was never requested. Raises the exception of a failed fetch.
+        """
+        key = target_key(tic, sector)
+        with self.lock:
+            task = self._task(kind, key)
+            task.waiting += 1
+        try:
+            return task.get(timeout)
+        finally:
+            with self.lock:
+                task.waiting -= 1
+
+    def ready(self, kind, tic, sector):
+        task = self.tasks.get((kind, target_key(tic, sector)))
+        return task is not None and task.done.is_set() and task.error is None
+
+    def cancel(self, keep=(), waiting=False):
+        """
+        Cancel the fetches of every target but those in keep (list of (tic, sector)).
+        Queued fetches are skipped, the results of running ones are discarded.
+        Fetches someone is waiting for in get() are only cancelled if waiting is
+        True (get may then return None).
+        """
+        keep = set(target_key(tic, sector) for tic, sector in keep)
+        with self.lock:
+            for name, task in list(self.tasks.items()):
+                if task.key in keep or task.done.is_set() or (task.waiting and not waiting):
+                    continue
+                task.cancelled = True
+                del self.tasks[name]
+
+    def memory(self):
+        # Memory used by the finished results, in MB
+        with self.lock:
+            return sum(task.size for task in self.tasks.values()) / 2**20
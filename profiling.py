@@ -0,0 +1,338 @@
+"""
+Time spent in each stage of the pipeline.
+
+The stages of functions.py, tpfplotter.py, datasource.py and of the drivers
+are marked with stage(), as a decorator or as a context manager:
+
+    @profiling.stage('periodogram')
+    def get_periodogram(...):
+
+    with profiling.stage('render'):
+        ...
+
+Profiling is off unless enable() is called (--profile in the terminal
+version, the TESSDIAG_PROFILE environment variable in the GUI), and a stage
+then only costs the test of a flag. Once enabled, each stage records how
+many times it ran, its wall and CPU time, and the remote calls made and bytes
+received meanwhile. These are counted in http.client, through which
+lightkurve, astroquery and astropy do all their downloads, so nothing is
+patched while profiling is off.
+
+The stages run within a target() block make the record of that target, which
+also holds the peak RSS of the process and is appended as one JSON line to
+the profile file (several processes can write to the same file). Stages run
+outside of any target are written by close() in a record of their own.
+summary() aggregates the records of a file in a table.
+
+Times are inclusive: a stage run within another one (e.g. the MAST search
+within the light curve download) counts in both. The CPU time is that of the
+whole process.
+
+One stage can also be run under cProfile (enable(cprofile_stage=...)). The
+statistics of each process go to <profile file>.<stage>.<pid>.prof and are
+merged by cprofile_summary().
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import functools
+import threading
+
+try:
+    import fcntl
+except ImportError:     # Windows: no locking of the profile file
+    fcntl = None
+
+try:
+    import resource
+except ImportError:     # Windows: no peak RSS
+    resource = None
+
+FIELDS = ('count', 'wall', 'cpu', 'calls', 'bytes')
+
+_enabled = False
+_path = None
+_cprofile_stage = None
+_profiler = None
+_profiling = 0          # cprofiled stages running (they may be nested or in several threads)
+_lock = threading.Lock()
+_local = threading.local()
+_net = [0, 0]           # remote calls, bytes received
+_outside = {}           # stages run outside of any target
+
+
+def enabled():
+    return _enabled
+
+
+def enable(path=None, cprofile_stage=None):
+    """
+    Start recording the stages.
+
+    Parameters
+    ----------
+    path : str, optional
+        JSON lines file the records are appended to (None: they are only kept
+        for the caller of target()).
+    cprofile_stage : str, optional
+        Name of a stage to run under cProfile (requires path).
+    """
+    global _enabled, _path, _cprofile_stage
+    _count_network()
+    _path = path
+    _cprofile_stage = cprofile_stage
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def peak_rss():
+    # Peak resident memory of this process in MB, None where it is not available
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+class _CountingFile:
+    # Socket file of an HTTP response counting the bytes read from it
+    def __init__(self, fp):
+        self._fp = fp
+
+    def _count(self, n):
+        with _lock:
+            _net[1] += n
+        return n
+
+    def read(self, *args):
+        data = self._fp.read(*args)
+        self._count(len(data))
+        return data
+
+    def read1(self, *args):
+        data = self._fp.read1(*args)
+        self._count(len(data))
+        return data
+
+    def readline(self, *args):
+        data = self._fp.readline(*args)
+        self._count(len(data))
+        return data
+
+    def readinto(self, b):
+        n = self._fp.readinto(b)
+        self._count(n or 0)
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+
+def _count_network():
+    # Wrap http.client (once) to count the requests and the bytes of the responses
+    import http.client
+    if getattr(http.client, '_tessdiag_counted', False):
+        return
+    putrequest = http.client.HTTPConnection.putrequest
+    response_init = http.client.HTTPResponse.__init__
+
+    def counted_putrequest(self, *args, **kwargs):
+        with _lock:
+            _net[0] += 1
+        return putrequest(self, *args, **kwargs)
+
+    def counted_init(self, *args, **kwargs):
+        response_init(self, *args, **kwargs)
+        self.fp = _CountingFile(self.fp)
+
+    http.client.HTTPConnection.putrequest = counted_putrequest
+    http.client.HTTPResponse.__init__ = counted_init
+    http.client._tessdiag_counted = True
+
+
+def _add(stages, name, values):
+    totals = stages.setdefault(name, dict.fromkeys(FIELDS, 0))
+    for field, value in zip(FIELDS, values):
+        totals[field] += value
+
+
+class stage:
+    """
+    Mark a stage of the pipeline, as a decorator or a context manager. Does
+    nothing while profiling is off.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.profiled = False
+
+    def __call__(self, func):
+        name = self.name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        if _enabled:
+            if self.name == _cprofile_stage:
+                self.profiled = _start_cprofile()
+            self.start = (time.perf_counter(), time.process_time(), _net[0], _net[1])
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is None:
+            return False
+        values = (1, time.perf_counter() - self.start[0], time.process_time() - self.start[1],
+                  _net[0] - self.start[2], _net[1] - self.start[3])
+        if self.profiled:
+            _stop_cprofile()
+        record = getattr(_local, 'record', None)
+        if record is not None:
+            _add(record['stages'], self.name, values)
+        else:
+            with _lock:
+                _add(_outside, self.name, values)
+        return False
+
+
+def _start_cprofile():
+    global _profiler, _profiling
+    import cProfile
+    with _lock:
+        if _profiling == 0:
+            if _profiler is None:
+                _profiler = cProfile.Profile()
+            try:
+                _profiler.enable()
+            except ValueError:      # another profiler is active
+                return False
+        _profiling += 1
+    return True
+
+
+def _stop_cprofile():
+    global _profiling
+    with _lock:
+        _profiling -= 1
+        if _profiling == 0:
+            _profiler.disable()
+
+
+def _dump_cprofile():
+    if _profiler is not None and _path is not None:
+        with _lock:
+            _profiler.dump_stats('{0}.{1}.{2}.prof'.format(_path, _cprofile_stage, os.getpid()))
+
+
+def _write(record):
+    if _path is None:
+        return
+    with open(_path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(record, default=str) + '\n')
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class target:
+    """
+    Context manager gathering the stages run within it (in this thread) in the
+    record of a target, written to the profile file when it ends. The keyword
+    arguments label the record, e.g. target(tic=..., sector=...). The record is
+    also available as the record attribute (None while profiling is off).
+    """
+
+    def __init__(self, **labels):
+        self.labels = labels
+        self.record = None
+
+    def __enter__(self):
+        if _enabled:
+            self.outer = getattr(_local, 'record', None)
+            self.record = dict(self.labels, pid=os.getpid(), stages={})
+            self.start = (time.perf_counter(), time.process_time(), _net[0], _net[1])
+            _local.record = self.record
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.record is None:
+            return False
+        _local.record = self.outer
+        record = self.record
+        record.update(wall=time.perf_counter() - self.start[0], cpu=time.process_time() - self.start[1],
+                      calls=_net[0] - self.start[2], bytes=_net[1] - self.start[3],
+                      peak_rss_mb=peak_rss(), failed=exc_type is not None)
+        _write(record)
+        if _cprofile_stage is not None:
+            _dump_cprofile()
+        return False
+
+
+def close(**labels):
+    """Write the record of the stages run outside of any target (labelled with labels)."""
+    if not _enabled:
+        return
+    with _lock:
+        stages = dict(_outside)
+        _outside.clear()
+    if stages:
+        _write(dict(labels, pid=os.getpid(), stages=stages, peak_rss_mb=peak_rss()))
+    if _cprofile_stage is not None:
+        _dump_cprofile()
+
+
+def read(path):
+    # Records of a profile file
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summary(records):
+    """Table of the totals of each stage over the records, slowest stage first."""
+    stages = {}
+    for record in records:
+        for name, values in record['stages'].items():
+            _add(stages, name, [values[field] for field in FIELDS])
+    targets = [r for r in records if 'wall' in r]
+    lines = ['{0:<20s} {1:>7s} {2:>10s} {3:>9s} {4:>10s} {5:>7s} {6:>9s}'.format(
+        'stage', 'count', 'wall [s]', 'mean [s]', 'CPU [s]', 'calls', 'MB')]
+    for name, s in sorted(stages.items(), key=lambda item: -item[1]['wall']):
+        lines.append('{0:<20s} {1:7d} {2:10.2f} {3:9.3f} {4:10.2f} {5:7d} {6:9.2f}'.format(
+            name, s['count'], s['wall'], s['wall'] / s['count'], s['cpu'], s['calls'], s['bytes'] / 2**20))
+    rss = [r['peak_rss_mb'] for r in records if r.get('peak_rss_mb') is not None]
+    lines.append('{0} targets ({1} failed) in {2:.2f} s, {3} remote calls, {4:.2f} MB received{5}'.format(
+        len(targets), sum(bool(r.get('failed')) for r in targets), sum(r['wall'] for r in targets),
+        sum(r['calls'] for r in targets), sum(r['bytes'] for r in targets) / 2**20,
+        ', peak RSS {0:.0f} MB'.format(max(rss)) if rss else ''))
+    return '\n'.join(lines)
+
+
+def cprofile_files(path, stage_name):
+    return sorted(glob.glob('{0}.{1}.*.prof'.format(glob.escape(path), glob.escape(stage_name))))
+
+
+def cprofile_summary(path, stage_name, top=25):
+    """Merged cProfile statistics of a stage over all processes, by cumulative time."""
+    import io
+    import pstats
+    files = cprofile_files(path, stage_name)
+    if not files:
+        return 'No cProfile statistics of stage {0}'.format(stage_name)
+    out = io.StringIO()
+    stats = pstats.Stats(*files, stream=out)
+    stats.sort_stats('cumulative').print_stats(top)
+    return out.getvalue()
@@ -0,0 +1,285 @@
+"""
+Summary report of many targets in a single file.
+
+functions.summary_pdf reads the four PNG files that the plot functions save in
+the working directory and writes one PDF per target. A report instead takes
+the figures in memory and adds one page (PDFReport) or one row of thumbnails
+(HTMLReport) per target to a single report as the targets finish.
+
+Both are written in parts as they fill up (path, then path_2, path_3...),
+so the memory used does not grow with the number of targets and the parts
+already written are kept if the run is interrupted.
+
+The figures are rendered to RGBA arrays by the caller, e.g. in the worker
+process that diagnosed the target, since matplotlib is not thread safe. The
+compression of the images and the writing of the report are done by a writer
+thread, so the caller does not wait for them.
+
+    with report.open_report('summary.pdf') as rep:
+        rep.add(tic, sector, title, {'tpf': fig_tpf, 'lc': fig_lc, ...})
+"""
+
+import io
+import os
+import html
+import base64
+import shutil
+import tempfile
+import threading
+from queue import Queue
+
+import numpy as np
+
+# Place of each figure on the A4 landscape PDF page, as in functions.summary_pdf: x, y, w, h (mm)
+LAYOUT = {'tpf': (20, 20, 100, 85), 'lc': (120, 20, 165, 85),
+          'periodogram': (20, 110, 110, 85), 'lcfolded': (120, 110, 165, 85)}
+
+
+def open_report(path, **kwargs):
+    # PDFReport or HTMLReport depending on the extension of path
+    if path.lower().endswith(('.html', '.htm')):
+        return HTMLReport(path, **kwargs)
+    return PDFReport(path, **kwargs)
+
+
+def render(fig, dpi=100):
+    """Figure rendered with Agg, as an RGBA uint8 array of shape (height, width, 4)."""
+    buf = io.BytesIO()
+    fig.savefig(buf, format='rgba', dpi=dpi)
+    w, h = fig.get_size_inches() * dpi
+    return np.frombuffer(buf.getbuffer(), dtype=np.uint8).reshape(int(h), int(w), 4)
+
+
+def as_rgba(image, dpi=100):
+    # Figure, PNG bytes or RGBA/RGB array -> RGBA array
+    if hasattr(image, 'savefig'):
+        return render(image, dpi)
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        from PIL import Image
+        return np.asarray(Image.open(io.BytesIO(image)).convert('RGBA'))
+    image = np.asarray(image)
+    if image.shape[2] == 3:
+        image = np.dstack([image, np.full(image.shape[:2], 255, dtype=np.uint8)])
+    return image
+
+
+def flatten(rgba):
+    # RGB array of an RGBA image over a white background
+    alpha = rgba[:, :, 3:].astype(np.uint16)
+    if (alpha == 255).all():
+        return np.ascontiguousarray(rgba[:, :, :3])
+    rgb = (rgba[:, :, :3] * alpha + 255 * (255 - alpha)) // 255
+    return rgb.astype(np.uint8)
+
+
+def _png(rgb, width=None):
+    # PNG bytes of an RGB array, shrunk to width pixels if wider
+    from PIL import Image
+    image = Image.fromarray(rgb)
+    if width is not None and image.width > width:
+        image.thumbnail((width, image.height * width // image.width))
+    buf = io.BytesIO()
+    image.save(buf, format='PNG')
+    return buf.getvalue()
+
+
+class Report:
+    """
+    Base of the reports: add() queues the pages, which the writer thread passes
+    to write_page(). close() waits for the queued pages and finishes the file.
+
+    Parameters
+    ----------
+    path : str
+        Report file.
+    dpi : float
+        Resolution at which the figures given to add() are rendered.
+    queue_size : int
+        Pages waiting to be written before add() blocks, to bound the memory used.
+    """
+
+    def __init__(self, path, dpi=100, queue_size=16):
+        self.path = path
+        self.dpi = dpi
+        self.npages = 0
+        self.files = []
+        self.error = None
+        self.queue = Queue(queue_size)
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def _work(self):
+        while True:
+            page = self.queue.get()
+            if page is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.write_page(*page)
+                self.npages += 1
+            except Exception as e:
+                self.error = e
+
+    def add(self, tic, sector, title, images):
+        """
+        Add the page of a target. images maps the name of each figure (tpf, lc,
+        periodogram, lcfolded) to a matplotlib figure, its RGBA array (see
+        render) or PNG bytes.
+        """
+        if self.error is not None:
+            raise self.error
+        images = {name: as_rgba(image, self.dpi) for name, image in images.items()}
+        self.queue.put((tic, sector, title, images))
+
+    def close(self):
+        # Write the pages still queued and finish the report
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+            if self.error is None:
+                self.finish()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def part_file(self, part):
+        # path for the first part, path_2, path_3... for the next ones
+        root, ext = os.path.splitext(self.path)
+        return self.path if part == 1 else '{0}_{1}{2}'.format(root, part, ext)
+
+    def write_page(self, tic, sector, title, images):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+
+class PDFReport(Report):
+    """
+    One A4 page per target, laid out as functions.summary_pdf. fpdf keeps the
+    whole document in memory until it is written, so every per_part pages
+    the document is written as a part (path, path_2.pdf, path_3.pdf...) and
+    the next one is started.
+
+    Parameters
+    ----------
+    per_part : int
+        Pages (targets) per part.
+    """
+
+    def __init__(self, path, per_part=200, **kwargs):
+        import fpdf
+        self.fpdf = fpdf
+        self.per_part = per_part
+        self.part = 1
+        self.pdf = fpdf.FPDF('L', 'mm', 'A4')
+        # fpdf 1.x only reads images from files: each image is written to a temporary
+        # PNG, which pdf.image() reads at once. fpdf2 takes the PNG in memory
+        self.image_files = fpdf.__version__.startswith('1.')
+        self.tmpdir = tempfile.mkdtemp(prefix='tessdiag_report_') if self.image_files else None
+        self.nimages = 0
+        super(PDFReport, self).__init__(path, **kwargs)
+
+    def _write(self):
+        self.pdf.output(self.part_file(self.part))
+        self.files.append(self.part_file(self.part))
+
+    def write_page(self, tic, sector, title, images):
+        if self.npages > 0 and self.npages % self.per_part == 0:
+            self._write()
+            self.part += 1
+            self.pdf = self.fpdf.FPDF('L', 'mm', 'A4')
+        pdf = self.pdf
+        pdf.add_page()
+        pdf.set_font('Arial', 'B', 16)
+        pdf.set_text_color(125, 125, 125)
+        pdf.cell(w=300, txt=title)
+        for name, rgba in images.items():
+            x, y, w, h = LAYOUT.get(name, LAYOUT['lcfolded'])
+            png = _png(flatten(rgba))
+            self.nimages += 1
+            if self.image_files:
+                # The name must be unique: fpdf keeps the images by file name
+                image = os.path.join(self.tmpdir, 'image{0}.png'.format(self.nimages))
+                with open(image, 'wb') as f:
+                    f.write(png)
+                pdf.image(image, x=x, y=y, w=w, h=h)
+                os.remove(image)
+            else:
+                pdf.image(io.BytesIO(png), x=x, y=y, w=w, h=h)
+
+    def finish(self):
+        self._write()
+
+    def close(self):
+        try:
+            super(PDFReport, self).close()
+        finally:
+            if self.tmpdir is not None:
+                shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+class HTMLReport(Report):
+    """
+    Paged HTML index: path is the first page, the next ones are path_2.html,
+    path_3.html... Each target is a row with its title and the thumbnails of
+    its figures; the full size figures are shown by expanding the row. The
+    images are embedded in the pages, so no image files are written.
+
+    Parameters
+    ----------
+    per_page : int
+        Targets per page.
+    thumb_width : int
+        Width of the thumbnails in pixels.
+    """
+
+    def __init__(self, path, per_page=50, thumb_width=240, **kwargs):
+        self.per_page = per_page
+        self.thumb_width = thumb_width
+        self.rows = []
+        self.page = 1
+        super(HTMLReport, self).__init__(path, **kwargs)
+
+    @staticmethod
+    def _png(rgb, width=None):
+        return 'data:image/png;base64,' + base64.b64encode(_png(rgb, width)).decode('ascii')
+
+    def write_page(self, tic, sector, title, images):
+        # The page is written once it is full and the next target arrives (so
+        # that it can link to the next page), the last one by finish()
+        if len(self.rows) == self.per_page:
+            self._write(last=False)
+            self.rows = []
+            self.page += 1
+        thumbs, full = [], []
+        for name, rgba in images.items():
+            rgb = flatten(rgba)
+            thumbs.append('<img src="{0}" alt="{1}" title="{1}">'.format(self._png(rgb, self.thumb_width), name))
+            full.append('<img src="{0}" alt="{1}">'.format(self._png(rgb), name))
+        self.rows.append('<tr><td>TIC {0}<br>sector {1}</td><td>{2}<details><summary>{3}</summary>{4}</details></td></tr>'
+                         .format(tic, sector, html.escape(title), ''.join(thumbs), ''.join(full)))
+
+    def _write(self, last):
+        links = []
+        if self.page > 1:
+            links.append('<a href="{0}">previous</a>'.format(os.path.basename(self.part_file(self.page - 1))))
+        links.append('page {0}'.format(self.page))
+        if not last:
+            links.append('<a href="{0}">next</a>'.format(os.path.basename(self.part_file(self.page + 1))))
+        nav = '<p>{0}</p>'.format(' | '.join(links))
+        with open(self.part_file(self.page), 'w') as f:
+            f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>TESS diagnosis</title>'
+                    '<style>td {{vertical-align: top; padding: 4px}} img {{margin: 2px}}</style></head>\n'
+                    '<body>{0}<table>\n{1}\n</table>{0}</body></html>\n'.format(nav, '\n'.join(self.rows)))
+        self.files.append(self.part_file(self.page))
+
+    def finish(self):
+        self._write(last=True)
@@ -0,0 +1,79 @@
+"""
+Results of the terminal version in an SQLite database, one row per target.
+
+Each target is committed as soon as it finishes, so an interrupted batch run
+keeps everything done so far. Along with the period, its error, the FAP and
+the Gaia flux ratio, a row records the key of the run (a hash of the
+parameters and of the input files, see run_key) and the files it produced.
+When the run is started again, targets whose key did not change and whose
+files are still there are skipped.
+
+SQLite locks the database while writing, so several processes (e.g. runs on
+different target lists) can share the same file.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+RESULTS_FILE = 'TESSdiagnosis_results.sqlite'
+COLUMNS = ['TIC', 'TESS_sector', 'Period', 'error', 'FAP', 'FG_ratio']
+
+
+def run_key(params, inputs):
+    # Hash of the parameters of a target and of the fingerprint of its input files
+    text = json.dumps({'params': params, 'inputs': inputs}, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class ResultsStore:
+    """
+    Parameters
+    ----------
+    path : str
+        SQLite database, created if it does not exist.
+    timeout : float
+        Seconds to wait for another process holding the database lock.
+    """
+
+    def __init__(self, path=RESULTS_FILE, timeout=60):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        # Readers do not block the writer (and the other way round)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS results ('
+                              'tic INTEGER, sector TEXT, period REAL, error REAL, fap REAL, fg_ratio REAL, '
+                              'key TEXT, artifacts TEXT, finished REAL, PRIMARY KEY (tic, sector))')
+
+    def put(self, data, key, artifacts=()):
+        """Commit the row of a target (dict with the COLUMNS) with its run key and files."""
+        row = (int(data['TIC']), str(data['TESS_sector']), data['Period'], data['error'], data['FAP'],
+               data.get('FG_ratio'), key, json.dumps([os.path.abspath(f) for f in artifacts]), time.time())
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?,?,?,?)', row)
+
+    def done(self, tic, sector, key):
+        # The target was finished with the same key and its files are still there
+        found = self.conn.execute('SELECT key, artifacts FROM results WHERE tic=? AND sector=?',
+                                  (int(tic), str(sector))).fetchone()
+        if found is None or found[0] != key:
+            return False
+        return all(os.path.exists(f) for f in json.loads(found[1]))
+
+    def rows(self, targets=None):
+        """Rows (dicts with the COLUMNS) of the given (tic, sector) targets, or of all of them."""
+        query = 'SELECT tic, sector, period, error, fap, fg_ratio FROM results'
+        rows = [dict(zip(COLUMNS, r)) for r in self.conn.execute(query + ' ORDER BY finished')]
+        for r in rows:
+            r['TESS_sector'] = int(r['TESS_sector']) if r['TESS_sector'].isdigit() else r['TESS_sector']
+        if targets is not None:
+            order = {(int(tic), str(sector)): i for i, (tic, sector) in enumerate(targets)}
+            rows = sorted([r for r in rows if (r['TIC'], str(r['TESS_sector'])) in order],
+                          key=lambda r: order[(r['TIC'], str(r['TESS_sector']))])
+        return rows
+
+    def close(self):
+        self.conn.close()
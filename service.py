@@ -0,0 +1,361 @@
+"""
+Local HTTP service running the diagnosis of targets as jobs.
+
+Notebooks and dashboards can get the period, FAP and Gaia flux ratio of a
+target, and its figures, without the GUI or files in the working directory:
+
+    python service.py --archive /path/to/mirror --workers 4
+
+    POST /jobs                      {"tic": 267802440, "sector": 17, "engine": "numpy"}
+    GET  /jobs/<id>[?wait=30]       status, and the results once done
+    GET  /jobs/<id>/figures/<name>  PNG of tpf, lc, periodogram or lcfolded
+    GET  /jobs                      every job kept
+    GET  /health                    workers and jobs queued or running
+
+The targets are diagnosed by TESSdiagnosis.run_target (as with --report, the
+figures are rendered in memory) on a pool of worker processes, so the number
+of targets running at once is bounded, and at most max_queue jobs can be
+waiting or running (503 beyond that). The id of a job is the results.run_key
+of its target, parameters and input files: a request for a target already
+queued, running or done with the same options and inputs gets the same job
+back instead of starting another computation. Failed jobs are run again when
+submitted again. The last keep finished jobs are kept in memory.
+
+The workers read their data with the data source, Gaia store and TIC table of
+the service (--archive and the TESSDIAG_* environment variables, see the
+README), so the service runs without internet access when these are local.
+It listens on 127.0.0.1 by default and has no authentication.
+"""
+
+import io
+import json
+import time
+import signal
+import argparse
+import threading
+import multiprocessing
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import datasource
+import results
+import TESSdiagnosis
+
+FIGURES = ('tpf', 'lc', 'periodogram', 'lcfolded')
+ENGINES = ('gls', 'numpy', 'fft')
+OPTIONS = ('tic', 'sector', 'SAP', 'FGratio', 'engine', 'search', 'bootstrap', 'fold_bins', 'decimate')
+MAX_WAIT = 300.
+
+
+class Busy(Exception):
+    pass
+
+
+def _png(rgba):
+    # PNG bytes of an RGBA array (report.render)
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.fromarray(rgba).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def _number(value):
+    # JSON value of a result: NaN and inf are not valid JSON
+    if value is None or not np.isfinite(value):
+        return None
+    return float(value)
+
+
+def _integer(request, name, minimum=None):
+    value = request.get(name)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, str)) or not str(value).strip().isdigit():
+        raise ValueError('{0} must be an integer'.format(name))
+    if minimum is not None and int(value) < minimum:
+        raise ValueError('{0} must be at least {1}'.format(name, minimum))
+    return int(value)
+
+
+def _flag(request, name):
+    value = request.get(name, False)
+    if not isinstance(value, bool):
+        raise ValueError('{0} must be true or false'.format(name))
+    return value
+
+
+def job_params(request):
+    """
+    (tic, sector, params) of a job request, checked as the command line
+    options; params are those of the run key of the terminal version.
+    ValueError if the request is not valid.
+    """
+    if not isinstance(request, dict):
+        raise ValueError('the request must be a JSON object')
+    unknown = sorted(set(request) - set(OPTIONS))
+    if unknown:
+        raise ValueError('unknown options: {0}'.format(', '.join(unknown)))
+    if request.get('tic') is None or request.get('sector') is None:
+        raise ValueError('tic and sector are required')
+    tic = _integer(request, 'tic')
+    sector = str(request['sector']).strip().lower()
+    if sector != 'all':
+        sector = _integer(request, 'sector', minimum=1)
+    engine = request.get('engine')
+    if engine is not None and engine not in ENGINES:
+        raise ValueError('engine must be one of {0}'.format(', '.join(ENGINES)))
+    search = request.get('search', 'full')
+    if search not in ('full', 'adaptive'):
+        raise ValueError('search must be full or adaptive')
+    if search == 'adaptive' and engine not in ('numpy', 'fft'):
+        raise ValueError('search adaptive requires engine numpy or fft')
+    engine_kwargs = {'search': search} if engine in ('numpy', 'fft') else {}
+    params = {'SAP': _flag(request, 'SAP'), 'FGratio': _flag(request, 'FGratio'), 'engine': engine,
+              'engine_kwargs': engine_kwargs, 'fold_bins': _integer(request, 'fold_bins', minimum=1),
+              'decimate': _flag(request, 'decimate'), 'bootstrap': _integer(request, 'bootstrap', minimum=1)}
+    return tic, sector, params
+
+
+def run_job(tic, sector, params):
+    """
+    Worker entry point: (result, figures, error) of a target, with the result
+    as the row of the results store and the figures as PNG bytes.
+    """
+    engine_kwargs = dict(params['engine_kwargs'])
+    # The pool already uses the cores: the numpy periodogram runs single threaded
+    if params['engine'] in ('numpy', 'fft'):
+        engine_kwargs['threads'] = 1
+    data, error = TESSdiagnosis.run_target(tic, sector, SAP=params['SAP'], FGratio=params['FGratio'],
+                                           engine=params['engine'], engine_kwargs=engine_kwargs,
+                                           fold_bins=params['fold_bins'], decimate=params['decimate'],
+                                           summary=True, bootstrap=params['bootstrap'])
+    if error is not None:
+        return None, {}, error
+    page = data.pop('summary')
+    figures = {name: _png(rgba) for name, rgba in page['images'].items()}
+    data['title'] = page['title']
+    return data, figures, None
+
+
+class Job:
+    def __init__(self, key, tic, sector, params):
+        self.id = key
+        self.tic = tic
+        self.sector = sector
+        self.params = params
+        self.submitted = time.time()
+        self.finished = None
+        self.future = None
+        self.result = None
+        self.figures = {}
+        self.error = None
+        self.done = threading.Event()
+
+    @property
+    def status(self):
+        if self.finished is not None:
+            return 'failed' if self.error is not None else 'done'
+        # Running: handed over to the pool's workers (which also take the next one
+        # of the queue in advance)
+        return 'running' if self.future.running() or self.future.done() else 'queued'
+
+    def describe(self):
+        desc = {'id': self.id, 'tic': self.tic, 'sector': self.sector, 'status': self.status,
+                'params': self.params, 'submitted': self.submitted, 'finished': self.finished}
+        if self.result is not None:
+            desc['result'] = {'Period': _number(self.result['Period']), 'error': _number(self.result['error']),
+                              'FAP': _number(self.result['FAP']), 'FG_ratio': _number(self.result.get('FG_ratio')),
+                              'title': self.result.get('title')}
+            desc['figures'] = {name: '/jobs/{0}/figures/{1}'.format(self.id, name) for name in self.figures}
+        if self.error is not None:
+            desc['error'] = self.error
+        return desc
+
+
+class JobService:
+    """
+    Jobs of the service and their pool of worker processes.
+
+    Parameters
+    ----------
+    workers : int
+        Worker processes (targets diagnosed at once).
+    max_queue : int
+        Jobs queued or running before submit() raises Busy.
+    keep : int
+        Finished jobs kept in memory, the oldest are dropped first.
+    archive : str
+        Local mirror the workers read light curves and TPFs from (see
+        TESSdiagnosis.init_worker), as --archive.
+    """
+
+    def __init__(self, workers=2, max_queue=64, keep=256, archive=None):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.keep = keep
+        TESSdiagnosis.init_worker(archive)
+        # The HTTP server is multithreaded: the workers are spawned, not forked
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=TESSdiagnosis.init_worker, initargs=(archive,))
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, tic, sector, params):
+        # Same key as the results store of the terminal version
+        fingerprint = datasource.get_source().fingerprint(tic, sector)
+        return results.run_key(dict(params, tic=tic, sector=sector), fingerprint)
+
+    def submit(self, tic, sector, params):
+        """(job, new): the job of the target, new if it was not queued, running or done already"""
+        key = self.key(tic, sector, params)
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is not None and job.status != 'failed':
+                return job, False
+            pending = sum(1 for other in self.jobs.values() if other.finished is None)
+            if pending >= self.max_queue:
+                raise Busy('{0} jobs are queued or running'.format(pending))
+            job = Job(key, tic, sector, params)
+            job.future = self.pool.submit(run_job, tic, sector, params)
+            self.jobs.pop(key, None)
+            self.jobs[key] = job
+        job.future.add_done_callback(lambda future: self._finish(job, future))
+        return job, True
+
+    def _finish(self, job, future):
+        try:
+            job.result, job.figures, job.error = future.result()
+        except Exception as e:      # e.g. a worker killed
+            job.error = '{0}: {1}'.format(type(e).__name__, e)
+        job.finished = time.time()
+        job.done.set()
+        with self.lock:
+            finished = [key for key, other in self.jobs.items() if other.finished is not None]
+            for key in finished[:max(len(finished) - self.keep, 0)]:
+                del self.jobs[key]
+
+    def get(self, key, wait_time=0):
+        # Job of key (None if unknown), waiting up to wait_time seconds for it to finish
+        with self.lock:
+            job = self.jobs.get(key)
+        if job is not None and wait_time > 0:
+            job.done.wait(min(wait_time, MAX_WAIT))
+        return job
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def health(self):
+        jobs = self.list()
+        status = [job.status for job in jobs]
+        return {'workers': self.workers, 'max_queue': self.max_queue, 'queued': status.count('queued'),
+                'running': status.count('running'), 'jobs': len(jobs)}
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Requests to the JobService of the server
+    server_version = 'TESSdiagnosis'
+
+    def _send(self, code, body, content_type='application/json', headers=()):
+        if content_type == 'application/json':
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, code, message, headers=()):
+        self._send(code, {'error': message}, headers=headers)
+
+    def do_GET(self):
+        service = self.server.service
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        if parts == ['health']:
+            return self._send(200, service.health())
+        if parts == ['jobs']:
+            return self._send(200, [job.describe() for job in service.list()])
+        if len(parts) not in (2, 4) or parts[0] != 'jobs' or (len(parts) == 4 and parts[2] != 'figures'):
+            return self._error(404, 'not found')
+        try:
+            wait_time = float(parse_qs(url.query).get('wait', [0])[0])
+        except ValueError:
+            return self._error(400, 'wait must be a number of seconds')
+        job = service.get(parts[1], wait_time if len(parts) == 2 else 0)
+        if job is None:
+            return self._error(404, 'unknown job {0}'.format(parts[1]))
+        if len(parts) == 2:
+            return self._send(200, job.describe())
+        name = parts[3][:-4] if parts[3].endswith('.png') else parts[3]
+        if job.status != 'done':
+            return self._error(409, 'job {0} is {1}'.format(job.id, job.status))
+        if name not in job.figures:
+            return self._error(404, 'no figure {0}, figures: {1}'.format(name, ', '.join(FIGURES)))
+        self._send(200, job.figures[name], content_type='image/png')
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip('/') != '/jobs':
+            return self._error(404, 'not found')
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            tic, sector, params = job_params(json.loads(self.rfile.read(length) or b'{}'))
+        except ValueError as e:
+            return self._error(400, str(e))
+        try:
+            job, new = self.server.service.submit(tic, sector, params)
+        except Busy as e:
+            return self._error(503, str(e), headers=[('Retry-After', '30')])
+        self._send(202 if new else 200, job.describe(), headers=[('Location', '/jobs/{0}'.format(job.id))])
+
+
+def make_server(service, host='127.0.0.1', port=8750):
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def _stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local HTTP service running TESS diagnosis jobs')
+    parser.add_argument('--host', help='Address to listen on', default='127.0.0.1')
+    parser.add_argument('--port', help='Port to listen on', type=int, default=8750)
+    parser.add_argument('--workers', help='Number of worker processes', type=int, default=2)
+    parser.add_argument('--max-queue', help='Jobs queued or running before new ones are refused', type=int,
+                        default=64, dest='max_queue')
+    parser.add_argument('--keep', help='Finished jobs kept in memory', type=int, default=256)
+    parser.add_argument('--archive', help='Read light curves and TPFs from this local mirror instead of MAST',
+                        default=None)
+    args = parser.parse_args()
+    if args.workers < 1 or args.max_queue < 1 or args.keep < 0:
+        parser.error('--workers and --max-queue must be at least 1, --keep at least 0')
+    service = JobService(args.workers, args.max_queue, args.keep, args.archive)
+    server = make_server(service, args.host, args.port)
+    print('Serving on http://{0}:{1}'.format(*server.server_address[:2]))
+    # Stopped with Ctrl-C or, as a background service, with SIGTERM
+    signal.signal(signal.SIGTERM, _stop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Cut outs served by cutoutcache from a larger cached cut out, compared with
+the cut out of the requested size cut directly from the FFI cube by the
+TESScut stand-in of the benchmarks (benchmarks/synthetic.py).
+
+    python -m pytest tests
+"""
+
+import mmap
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, 'benchmarks')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+lk = pytest.importorskip('lightkurve')
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+import cutoutcache
+import synthetic
+
+SECTOR = 1
+CADENCES = 100
+
+
+@pytest.fixture(scope='module')
+def field(tmp_path_factory):
+    # FFI cube with a star at each of the targets of the benchmarks, and a
+    # 40x40 cut out around the first one in the cache
+    path = tmp_path_factory.mktemp('cutouts')
+    wcs = synthetic.ffi_wcs(300., 30.)
+    ra, dec = WCS(fits.Header(wcs)).all_pix2world([c for r, c in synthetic.FFI_TARGETS],
+                                                  [r for r, c in synthetic.FFI_TARGETS], 0)
+    time, quality = synthetic.sector_times(SECTOR, synthetic.FFI_CADENCE)
+    cube = str(path / 'cube.fits')
+    synthetic.write_ffi_cube(cube, SECTOR, time[:CADENCES], quality[:CADENCES], wcs,
+                             {'RA_ICRS': ra, 'DE_ICRS': dec, 'Gmag': np.linspace(10, 12, len(ra))}, {})
+    cache = cutoutcache.CutoutCache(str(path / 'cache'), max_size=100)
+    synthetic.cut_cube(cube, ra[0], dec[0], 40, str(path / 'large.fits'))
+    assert cache.put(str(path / 'large.fits')) == SECTOR
+    return path, cube, cache, list(zip(ra, dec))
+
+
+@pytest.mark.parametrize('target', [0, 1, 2])
+@pytest.mark.parametrize('size', [(12, 12), (9, 14)])
+def test_same_pixels_as_direct_cut(field, target, size):
+    path, cube, cache, targets = field
+    ra, dec = targets[target]
+    tpf = cache.get(ra, dec, SECTOR, size)
+    assert tpf is not None
+    direct = str(path / 'direct.fits')
+    synthetic.cut_cube(cube, ra, dec, size, direct)
+    with fits.open(direct) as hdul:
+        for name in ('TIME', 'CADENCENO', 'FLUX', 'FLUX_ERR', 'QUALITY'):
+            np.testing.assert_array_equal(tpf.hdu[1].data[name], hdul[1].data[name])
+        np.testing.assert_array_equal(tpf.hdu[2].data, hdul[2].data)
+        assert (tpf.row, tpf.column) == (hdul[1].header['2CRV5P'], hdul[1].header['1CRV5P'])
+        np.testing.assert_allclose(tpf.wcs.all_pix2world(np.arange(size[1]), np.arange(size[1]), 0),
+                                   WCS(hdul[2].header).all_pix2world(np.arange(size[1]), np.arange(size[1]), 0))
+    assert tpf.flux.shape == (CADENCES,) + size
+
+
+def test_read_only_view(field):
+    # The pixels are those of the memory-mapped file, not a copy
+    path, cube, cache, targets = field
+    tpf = cache.get(targets[1][0], targets[1][1], SECTOR, 12)
+    for data in (tpf.hdu[1].data['FLUX'], tpf.hdu[1].data['FLUX_ERR'], tpf.hdu[2].data):
+        assert not data.flags.writeable
+        base = data
+        while base is not None and not isinstance(base, mmap.mmap):
+            base = base.base
+        assert isinstance(base, mmap.mmap)
+    with pytest.raises(ValueError):
+        tpf.hdu[1].data['FLUX'][0, 0, 0] = 0
@@ -0,0 +1,87 @@
+"""
+Numerical equivalence of fastgls.Gls with the reference GLS (gls.Gls by
+M. Zechmeister, https://github.com/mzechmeister/GLS) on a synthetic light
+curve. Skipped when the reference is not installed.
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import fastgls
+
+gls = pytest.importorskip('gls')
+
+RTOL = 1e-6
+
+
+@pytest.fixture(scope='module')
+def series():
+    # Rotator observed for 10 days at 10 min cadence with a gap, with a signal
+    # weak enough for the FAP of its peak to be resolvable
+    rng = np.random.default_rng(42)
+    t = np.arange(0, 10, 10 / 60 / 24)
+    t = t[(t < 4.5) | (t > 5.5)]
+    e_y = rng.uniform(0.8, 1.2, len(t)) * 0.002
+    y = 1 + 0.0003 * np.sin(2 * np.pi * t / 3.1) + rng.normal(0, e_y)
+    return t, y, e_y, {'Pbeg': 2 * (t[1] - t[0]), 'Pend': (t.max() - t.min()) / 2}
+
+
+@pytest.fixture(scope='module')
+def periodograms(series):
+    t, y, e_y, kwargs = series
+    ref = gls.Gls((list(t), list(y), list(e_y)), **kwargs)
+    return ref, fastgls.Gls((t, y, e_y), **kwargs)
+
+
+def test_power(periodograms):
+    ref, new = periodograms
+    np.testing.assert_allclose(new.freq, ref.freq, rtol=1e-12)
+    np.testing.assert_allclose(new.power, ref.power, rtol=0, atol=RTOL * ref.power.max())
+
+
+def test_best_period(periodograms):
+    ref, new = periodograms
+    assert new.best['P'] == pytest.approx(ref.best['P'], rel=RTOL)
+    assert new.best['e_P'] == pytest.approx(ref.best['e_P'], rel=RTOL)
+
+
+def test_fap(periodograms):
+    ref, new = periodograms
+    assert 1e-12 < ref.FAP() < 1
+    assert new.FAP() == pytest.approx(ref.FAP(), rel=RTOL)
+    for power in (0.5 * ref.power.max(), np.median(ref.power)):
+        assert new.FAP(power) == pytest.approx(ref.FAP(power), rel=RTOL)
+
+
+@pytest.mark.parametrize('level', [0.1, 0.01, 0.001])
+def test_power_level(periodograms, level):
+    ref, new = periodograms
+    assert new.powerLevel(level) == pytest.approx(ref.powerLevel(level), rel=RTOL)
+
+
+def test_adaptive_search(series, periodograms):
+    # Only part of the grid is evaluated, but the peak is that of the full grid
+    ref = periodograms[0]
+    t, y, e_y, kwargs = series
+    new = fastgls.Gls((t, y, e_y), search='adaptive', **kwargs)
+    assert new.nf_eval < new.nf_full
+    assert new.best['P'] == pytest.approx(ref.best['P'], rel=RTOL)
+    assert new.pmax == pytest.approx(ref.power.max(), rel=RTOL)
+
+
+def test_fft(series, periodograms):
+    # Extirpolation and FFT: approximate power, same peak
+    ref = periodograms[0]
+    t, y, e_y, kwargs = series
+    new = fastgls.Gls((t, y, e_y), method='fft', **kwargs)
+    np.testing.assert_allclose(new.power, ref.power, rtol=0, atol=5e-3 * ref.power.max())
+    assert new.best['P'] == pytest.approx(ref.best['P'], rel=1e-4)
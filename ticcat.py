@@ -0,0 +1,151 @@
+"""
+TIC metadata (ra, dec, Gaia DR2 id and G magnitude) of the targets.
+
+TICResolver answers from an in-memory table that is also saved to a local
+csv file (~/.tessdiagnosis-cache/tic.csv, or TESSDIAG_TIC_CACHE), so a target
+is only looked up once. Missing targets are fetched from a backend in one
+request per batch: MASTTICBackend queries the TIC at MAST, TableTICBackend
+reads a local csv or parquet table with the same columns (selected with the
+TESSDIAG_TIC_TABLE environment variable), e.g. for offline runs.
+"""
+
+import os
+
+import numpy as np
+
+import profiling
+
+try:
+    import fcntl
+except ImportError:     # Windows: no locking of the cache file
+    fcntl = None
+
+FIELDS = ['ID', 'ra', 'dec', 'GAIA', 'GAIAmag']
+CACHE_FILE = os.environ.get('TESSDIAG_TIC_CACHE',
+                            os.path.join(os.path.expanduser('~'), '.tessdiagnosis-cache', 'tic.csv'))
+
+_resolver = None
+
+
+def get_resolver():
+    global _resolver
+    if _resolver is None:
+        table = os.environ.get('TESSDIAG_TIC_TABLE')
+        backend = TableTICBackend(table) if table else MASTTICBackend()
+        _resolver = TICResolver(backend)
+    return _resolver
+
+
+def set_resolver(resolver):
+    global _resolver
+    _resolver = resolver
+    return resolver
+
+
+def _record(row):
+    # TIC row -> dict with the FIELDS, the Gaia id as a string (nan if there is none)
+    gaia = row['GAIA']
+    if np.ma.is_masked(gaia) or gaia is None or (isinstance(gaia, float) and np.isnan(gaia)) or gaia == '':
+        gaia = np.nan
+    else:
+        gaia = str(int(float(gaia))) if not isinstance(gaia, str) else gaia
+    gaiamag = row['GAIAmag']
+    gaiamag = np.nan if gaiamag is None or np.ma.is_masked(gaiamag) else float(gaiamag)
+    return {'ID': str(int(row['ID'])), 'ra': float(row['ra']), 'dec': float(row['dec']),
+            'GAIA': gaia, 'GAIAmag': gaiamag}
+
+
+class MASTTICBackend:
+    # Bulk queries of the TIC at MAST
+    batch = 500
+
+    @profiling.stage('tic_query')
+    def query(self, tics):
+        from astroquery.mast import Catalogs
+        records = []
+        for i in range(0, len(tics), self.batch):
+            result = Catalogs.query_criteria(catalog='Tic', ID=[int(t) for t in tics[i:i+self.batch]])
+            records += [_record(row) for row in result]
+        return records
+
+
+class TableTICBackend:
+    """
+    Parameters
+    ----------
+    path : str
+        csv or parquet table with the columns ID, ra, dec, GAIA and GAIAmag.
+    """
+
+    def __init__(self, path):
+        import pandas as pd
+        if path.endswith('.parquet'):
+            table = pd.read_parquet(path)
+        else:
+            table = pd.read_csv(path, dtype={'GAIA': str})
+        table['ID'] = table['ID'].astype('int64').astype(str)
+        self.table = table.set_index('ID', drop=False)
+
+    def query(self, tics):
+        found = self.table.index.intersection([str(int(t)) for t in tics])
+        return [_record(row) for _, row in self.table.loc[found].iterrows()]
+
+
+class TICResolver:
+    """
+    Parameters
+    ----------
+    backend : object
+        Provides query(tics) -> list of records.
+    cache_file : str, optional
+        Local csv table of the records already resolved. None keeps them in memory only.
+    """
+
+    def __init__(self, backend, cache_file=CACHE_FILE):
+        self.backend = backend
+        self.cache_file = cache_file
+        self.records = {}
+        self._load()
+
+    def _load(self):
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return
+        import pandas as pd
+        table = pd.read_csv(self.cache_file, dtype={'ID': str, 'GAIA': str})
+        for row in table.to_dict('records'):
+            self.records[row['ID']] = _record(row)
+
+    def _save(self, records):
+        # Append the new records; several processes may do so at the same time
+        if self.cache_file is None or not records:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+        with open(self.cache_file, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            if f.tell() == 0:
+                f.write(','.join(FIELDS) + '\n')
+            for r in records:
+                gaia = '' if isinstance(r['GAIA'], float) else r['GAIA']
+                f.write('{0},{1!r},{2!r},{3},{4!r}\n'.format(r['ID'], r['ra'], r['dec'], gaia, r['GAIAmag']))
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def resolve_many(self, tics):
+        """Records of the given TICs (dict by TIC string), fetching the missing ones in bulk."""
+        tics = [str(int(t)) for t in tics]
+        missing = set(t for t in tics if t not in self.records)
+        if missing:
+            new = [r for r in self.backend.query(sorted(missing)) if r['ID'] in missing]
+            for r in new:
+                self.records[r['ID']] = r
+            self._save(new)
+        return {t: self.records[t] for t in tics if t in self.records}
+
+    def resolve(self, tic):
+        """Record (ID, ra, dec, GAIA, GAIAmag) of one TIC. Raises KeyError if it is not in the TIC."""
+        tic = str(int(tic))
+        record = self.resolve_many([tic]).get(tic)
+        if record is None:
+            raise KeyError('TIC {0} not found'.format(tic))
+        return record
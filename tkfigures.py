@@ -0,0 +1,127 @@
+"""
+Tk figure panels of the GUI.
+
+Only TESSdiagnosis_GUI.py imports this module, so the terminal version does
+not depend on Tk and can run on machines without a display.
+"""
+
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+
+
+def draw_figure(canvas, figure):
+    # Show figure in the panel of canvas (the Tk widgets are reused, see FigurePanel)
+    panel = panel_for(canvas)
+    panel.show(figure)
+    return panel.figure_canvas
+
+def draw_figure_w_toolbar(canvas, fig, canvas_toolbar):
+    panel_for(canvas, canvas_toolbar, side='right').show(fig)
+
+_panels = {}
+
+def panel_for(canvas, canvas_toolbar=None, side='top'):
+    # FigurePanel of a Tk canvas, created the first time it is used
+    # (a panel looked up before its first show, e.g. for its figure, gets the
+    # toolbar of the later call)
+    key = str(canvas)
+    if key not in _panels:
+        _panels[key] = FigurePanel(canvas, canvas_toolbar, side)
+    elif canvas_toolbar is not None and _panels[key].figure_canvas is None:
+        _panels[key].canvas_toolbar = canvas_toolbar
+        _panels[key].side = side
+    return _panels[key]
+
+class FigurePanel:
+    """
+    One FigureCanvasTkAgg (and navigation toolbar) per GUI panel, kept for the
+    whole session: show() puts a figure in it without rebuilding the widgets.
+    A figure already shown whose artists were updated in place (plot functions
+    called with fig=) is redrawn by blitting the artists with a gid over a cached
+    background when the axes limits did not change, and fully otherwise.
+    """
+
+    def __init__(self, canvas, canvas_toolbar=None, side='top'):
+        self.canvas = canvas
+        self.canvas_toolbar = canvas_toolbar
+        self.side = side
+        self.fig = None
+        self.figure_canvas = None
+        self.toolbar = None
+        self.background = None
+        self.limits = None
+        self._capturing = False
+
+    def show(self, fig):
+        if fig is self.fig:
+            self.refresh()
+            return
+        if self.figure_canvas is None:
+            self.figure_canvas = FigureCanvasTkAgg(fig, master=self.canvas)
+            self.figure_canvas.get_tk_widget().pack(side=self.side, fill='both', expand=1)
+            self.figure_canvas.mpl_connect('draw_event', self._drawn)
+            if self.canvas_toolbar is not None:
+                self.toolbar = Toolbar(self.figure_canvas, self.canvas_toolbar)
+        else:
+            self.figure_canvas.figure = fig
+            fig.set_canvas(self.figure_canvas)
+            w, h = fig.bbox.size
+            self.figure_canvas.get_tk_widget().configure(width=int(w), height=int(h))
+        self.fig = fig
+        self._draw()
+        if self.toolbar is not None:
+            # Forget the zoom/pan history of the previous figure
+            self.toolbar.update()
+
+    def _limits(self):
+        return [(ax.get_xlim(), ax.get_ylim()) for ax in self.fig.axes]
+
+    def _draw(self):
+        self.figure_canvas.draw()
+        self.limits = self._limits()
+
+    def _drawn(self, event):
+        # Any full redraw (zoom, pan, resize) invalidates the background
+        if not self._capturing:
+            self.background = None
+            self.limits = self._limits()
+
+    def _dynamic(self):
+        # Artists to redraw: those with a gid and, to keep the drawing order,
+        # everything drawn above them in their axes
+        dynamic = []
+        for ax in self.fig.axes:
+            children = ax.get_children()
+            zorders = [a.get_zorder() for a in children if a.get_gid()]
+            if zorders:
+                dynamic += sorted([a for a in children if a.get_zorder() >= min(zorders) and a is not ax.patch],
+                                  key=lambda a: a.get_zorder())
+        return dynamic
+
+    def refresh(self):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        dynamic = self._dynamic()
+        if not dynamic or self._limits() != self.limits:
+            self._draw()
+            return
+        if self.background is None:
+            # Background: the figure without the artists that change
+            visible = [a.get_visible() for a in dynamic]
+            for a in dynamic:
+                a.set_visible(False)
+            self._capturing = True
+            FigureCanvasAgg.draw(self.figure_canvas)
+            self._capturing = False
+            self.background = self.figure_canvas.copy_from_bbox(self.fig.bbox)
+            for a, v in zip(dynamic, visible):
+                a.set_visible(v)
+        else:
+            self.figure_canvas.restore_region(self.background)
+        for a in dynamic:
+            if a.get_visible():
+                a.axes.draw_artist(a)
+        self.figure_canvas.blit(self.fig.bbox)
+
+# ??? 
+class Toolbar(NavigationToolbar2Tk):
+    def __init__(self, *args, **kwargs):
+        super(Toolbar, self).__init__(*args, **kwargs)
@@ -31,30 +31,24 @@ import os
 import sys
 import time
 import warnings
+import weakref
+import threading
 
 import numpy as np
 import argparse
 
-from lightkurve import search_targetpixelfile
-from lightkurve import search_tesscut
 import matplotlib
 import matplotlib.pyplot as plt
-from matplotlib.colors import LogNorm
 from matplotlib.colorbar import Colorbar
-from matplotlib import patches
+from matplotlib.collections import PolyCollection
 import matplotlib.gridspec as gridspec
-from bokeh.io import export_png
-from bokeh.io.export import get_screenshot_as_png
-
-from astropy.stats import sigma_clip
-from astropy.coordinates import SkyCoord, Angle
-import astropy.units as u
-from astropy.visualization import SqrtStretch,LinearStretch
-import astropy.visualization as stretching
-from astropy.visualization.mpl_normalize import ImageNormalize
-from astropy.table import Table, Column, MaskedColumn
-from astropy.io import ascii
-from astroquery.mast import Catalogs
+
+# astropy coordinates, units, tables and visualization are imported by the
+# functions that use them, so that importing this module is fast
+import datasource
+import gaiacat
+import ticcat
+import profiling
 
 def cli():
     """command line inputs
@@ -77,8 +71,31 @@ def cli():
     args = parser.parse_args()
     return args
 
-def add_gaia_figure_elements(tpf, magnitude_limit=18,targ_mag=10.):
-    """Make the Gaia Figure Elements"""
+@profiling.stage('gaia_query')
+def query_gaia(c1, radius):
+    """
+    Gaia DR2 sources within radius of c1
+    Returns
+    -------
+    pandas DataFrame with the Vizier I/345/gaia2 columns, None if Vizier is unavailable
+    """
+    import astropy.units as u
+    store = gaiacat.get_store()
+    if store is not None:
+        return store.query(c1.ra.deg, c1.dec.deg, radius.to(u.deg).value)
+    from astroquery.vizier import Vizier
+    Vizier.ROW_LIMIT = -1
+    result = Vizier.query_region(c1, catalog=["I/345/gaia2"], radius=radius)
+    if result is None:
+        return None
+    if len(result) == 0:
+        from astropy.table import Table
+        return Table(names=gaiacat.COLUMNS).to_pandas()
+    return result["I/345/gaia2"].to_pandas()
+
+def query_tpf_field(tpf):
+    """Gaia sources around the TPF (see query_gaia)"""
+    from astropy.coordinates import SkyCoord, Angle
     # Get the positions of the Gaia sources
     c1 = SkyCoord(tpf.ra, tpf.dec, frame='icrs', unit='deg')
     # Use pixel scale for query size
@@ -86,10 +103,15 @@ def add_gaia_figure_elements(tpf, magnitude_limit=18,targ_mag=10.):
     if tpf.mission == 'TESS':
         pix_scale = 21.0
     # We are querying with a diameter as the radius, overfilling by 2x.
-    from astroquery.vizier import Vizier
-    Vizier.ROW_LIMIT = -1
-    result = Vizier.query_region(c1, catalog=["I/345/gaia2"],
-                                 radius=Angle(np.max(tpf.shape[1:]) * pix_scale, "arcsec"))
+    return query_gaia(c1, Angle(np.max(flux_cube(tpf).shape[1:]) * pix_scale, "arcsec"))
+
+def add_gaia_figure_elements(tpf, magnitude_limit=18,targ_mag=10.,result=False):
+    """Make the Gaia Figure Elements"""
+    import astropy.units as u
+    # result: sources already returned by query_tpf_field (None if Vizier was
+    # unavailable), queried here if not given
+    if result is False:
+        result = query_tpf_field(tpf)
     no_targets_found_message = ValueError('Either no sources were found in the query region '
                                           'or Vizier is unavailable')
     too_few_found_message = ValueError('No sources found brighter than {:0.1f}'.format(magnitude_limit))
@@ -97,8 +119,8 @@ def add_gaia_figure_elements(tpf, magnitude_limit=18,targ_mag=10.):
         raise no_targets_found_message
     elif len(result) == 0:
         raise too_few_found_message
-    result = result["I/345/gaia2"].to_pandas()
-    result = result[result.Gmag < magnitude_limit]
+    # Copy: the query result may be reused for other magnitude limits
+    result = result[result.Gmag < magnitude_limit].copy()
     if len(result) == 0:
         raise no_targets_found_message
     year = ((tpf.time[0].jd - 2457206.375) * u.day).to(u.year)
@@ -124,13 +146,12 @@ def plot_orientation(tpf):
     -------
     tpf read from lightkurve
 	"""
-	mean_tpf = np.mean(tpf.flux,axis=0)
-	nx,ny = np.shape(mean_tpf)
+	nx,ny = np.shape(reduce_tpf(tpf)['mean'])
 	x0,y0 = tpf.column+int(0.2*nx),tpf.row+int(0.2*ny)
 	# East
-	tmp =  tpf.get_coordinates()
-	ra00, dec00 = tmp[0][0][0][0], tmp[1][0][0][0]
-	ra10,dec10 = tmp[0][0][0][-1], tmp[1][0][0][-1]
+	ra, dec = first_row_coordinates(tpf, ny)
+	ra00, dec00 = ra[0], dec[0]
+	ra10,dec10 = ra[-1], dec[-1]
     # Each degree of RA is not a full degree on the sky if not
     # at equator; need cos(dec) factor to compensate
 	cosdec = np.cos(np.deg2rad(0.5*(dec10+dec00)))
@@ -161,34 +182,22 @@ def get_gaia_data(ra, dec):
     -------
     RA, DEC
     """
+    from astropy.coordinates import SkyCoord, Angle
     # Get the positions of the Gaia sources
     c1 = SkyCoord(ra, dec, frame='icrs', unit='deg')
     # We are querying with a diameter as the radius, overfilling by 2x.
-    from astroquery.vizier import Vizier
-    Vizier.ROW_LIMIT = -1
-    result = Vizier.query_region(c1, catalog=["I/345/gaia2"],
-                                 radius=Angle(10., "arcsec"))
-    try:
-    	result = result["I/345/gaia2"]
-    except:
+    result = query_gaia(c1, Angle(10., "arcsec"))
+    if result is None or len(result) == 0:
     	print('Not in Gaia DR2. If you know the Gaia ID and Gmag, try the options --gid and --gmag.')
     	print('Exiting without finishing...')
     	sys.exit()
 
-    no_targets_found_message = ValueError('Either no sources were found in the query region '
-                                          'or Vizier is unavailable')
-    too_few_found_message = ValueError('No sources found closer than 1 arcsec to TPF coordinates')
-    if result is None:
-        raise no_targets_found_message
-    elif len(result) == 0:
-        raise too_few_found_message
-
     if len(result)>1:
-        dist = np.sqrt((result['RA_ICRS']-ra)**2 + (result['DE_ICRS']-dec)**2)
-        idx = np.where(dist == np.min(dist))[0][0]
-        return result[idx]['Source'], result[idx]['Gmag']
+        dist = np.sqrt((result['RA_ICRS']-c1.ra.deg)**2 + (result['DE_ICRS']-c1.dec.deg)**2)
+        idx = np.argmin(np.asarray(dist))
+        return result['Source'].iloc[idx], result['Gmag'].iloc[idx]
     else:
-        return result[0]['Source'], result[0]['Gmag']
+        return result['Source'].iloc[0], result['Gmag'].iloc[0]
 
 def get_gaia_data_from_tic(tic):
     '''
@@ -197,19 +206,9 @@ def get_gaia_data_from_tic(tic):
     -----------------------
     GaiaID, Gaia_mag
     '''
-    # Get the Gaia sources
-    result = Catalogs.query_object('TIC'+tic, radius=.005, catalog="TIC")
-    IDs = result['ID'].data.data
-    k = np.where(IDs == tic)[0][0]
-    GAIAs = result['GAIA'].data.data
-    Gaiamags = result['GAIAmag'].data.data
-
-    GAIA_k = GAIAs[k]
-    Gaiamag_k = Gaiamags[k]
-
-    if GAIA_k == '':
-        GAIA_k = np.nan
-    return GAIA_k, Gaiamag_k
+    # Same TIC record as get_coord, so no further query is needed
+    record = ticcat.get_resolver().resolve(tic)
+    return record['GAIA'], record['GAIAmag']
 
 
 def get_coord(tic):
@@ -220,10 +219,8 @@ def get_coord(tic):
 	TIC number
 	"""
 	try:
-		catalog_data = Catalogs.query_object(objectname="TIC"+tic, catalog="TIC")
-		ra = catalog_data[0]["ra"]
-		dec = catalog_data[0]["dec"]
-		return ra, dec
+		record = ticcat.get_resolver().resolve(tic)
+		return record["ra"], record["dec"]
 	except:
 		print("ERROR: No gaia ID found for this TIC")
 
@@ -238,197 +235,319 @@ def set_plotcolors(ax,bordercolor='white'):
 # 	        MAIN
 # ======================================
 
-def tpfplotter(tic,LIST=False,COORD=False,SAVEGAIA=False,name=False,maglim=5,sector=None,gid=None,gmag=None,legend='best',savefig=False,fontcolor='white'):
+# Reduction of the flux cube -------------------------------------------------------
+# tpf.flux (and tpf.shape, get_coordinates, create_threshold_mask, which use
+# it) copies the good cadences of the whole cube each time it is accessed. The
+# FLUX column is memory-mapped by astropy, so reduce_tpf goes over it by chunks
+# of cadences instead, and the images are kept for all the plots of the TPF.
+CHUNK_MB = 32       # Memory for the cadences of a chunk
+CHUNK_BYTES = 24    # Bytes per pixel and cadence of a chunk (float64 copy, mask, median)
+
+_reduced = weakref.WeakKeyDictionary()
+_reduced_lock = threading.Lock()
+
+def flux_cube(tpf):
+    """FLUX column of the TPF (all cadences, memory-mapped if the file is)"""
+    return tpf.hdu[1].data['FLUX']
+
+@profiling.stage('tpf_reduce')
+def reduce_tpf(tpf, chunk_mb=CHUNK_MB):
+    """
+    Mean, median and standard deviation images of the good-quality cadences
+    of the TPF (NaNs ignored, as np.nanmean...). The mean and standard
+    deviation are accumulated in one pass over chunks of cadences, so that the
+    memory used does not depend on the number of cadences. The median needs
+    all the cadences of a pixel: it is computed in the same pass if they fit
+    in one chunk, and otherwise by a second pass over blocks of image rows.
+    The result is cached while the TPF object is alive.
+    Returns
+    -------
+    dict with mean, median, std and count (finite cadences) images
+    """
+    with _reduced_lock:
+        if tpf in _reduced:
+            return _reduced[tpf]
+    cube = flux_cube(tpf)
+    good = np.asarray(tpf.quality_mask, dtype=bool)
+    shape = cube.shape[1:]
+    budget = chunk_mb * 2**20 / CHUNK_BYTES
+    step = max(1, int(budget / max(1, np.prod(shape))))
+    count = np.zeros(shape)
+    total, squares = np.zeros(shape), np.zeros(shape)
+    shift, median = None, None
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)     # All-NaN pixels
+        for start in range(0, len(cube), step):
+            block = cube[start:start+step][good[start:start+step]]
+            if len(block) == 0:
+                continue
+            if step >= len(cube):
+                median = np.nanmedian(block, axis=0).astype(float)
+            block = block.astype(float)
+            # Sums around the mean of the first chunk, to keep the variance accurate
+            if shift is None:
+                shift = np.nan_to_num(np.nanmean(block, axis=0))
+            missing = ~np.isfinite(block)
+            block -= shift
+            block[missing] = 0.
+            count += len(block) - missing.sum(axis=0)
+            total += block.sum(axis=0)
+            squares += np.square(block, out=block).sum(axis=0)
+            del block, missing
+        if median is None:
+            median = np.full(shape, np.nan)
+            rows = max(1, int(budget / max(1, good.sum() * shape[1])))
+            for start in range(0, shape[0], rows):
+                median[start:start+rows] = np.nanmedian(cube[:, start:start+rows][good], axis=0)
+        n = np.where(count > 0, count, np.nan)
+        mean = total / n
+        images = {'mean': mean + (0. if shift is None else shift),
+                  'std': np.sqrt(np.maximum(squares / n - mean**2, 0.)),
+                  'median': median, 'count': count.astype(int)}
+    with _reduced_lock:
+        _reduced[tpf] = images
+    return images
+
+def threshold_mask(median_image, threshold=3, reference_pixel='center'):
+    """
+    Aperture of the pixels brighter than threshold times the (MAD) standard
+    deviation above the median, as tpf.create_threshold_mask, from the median
+    image returned by reduce_tpf
+    """
+    from scipy.ndimage import label
+    from astropy.stats import median_absolute_deviation
+    if reference_pixel == 'center':
+        reference_pixel = (median_image.shape[1] / 2, median_image.shape[0] / 2)
+    vals = median_image[np.isfinite(median_image)].flatten()
+    mad_cut = (1.4826 * median_absolute_deviation(vals) * threshold) + np.nanmedian(median_image)
+    mask = np.nan_to_num(median_image) >= mad_cut
+    if (reference_pixel is None) or (not mask.any()):
+        return mask
+    # Only the contiguous region closest to the reference pixel
+    labels = label(mask)[0]
+    pixels = np.argwhere(labels > 0)
+    closest = pixels[np.argmin(np.hypot(pixels[:, 0] - reference_pixel[1], pixels[:, 1] - reference_pixel[0]))]
+    return labels == labels[closest[0], closest[1]]
+
+def first_row_coordinates(tpf, ncols):
+    """
+    RA and Dec of the pixels of the first row in the first good-quality
+    cadence, as tpf.get_coordinates() (which computes them for every cadence)
+    """
+    pos_corr = [np.array(tpf.hdu[1].data[c], dtype=float) for c in ('POS_CORR1', 'POS_CORR2')]
+    # POS_CORR is not used when NaN or meaningless (>50 px)
+    bad = ~np.isfinite(pos_corr[0]) | ~np.isfinite(pos_corr[1])
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for p in pos_corr:
+            bad |= np.abs(p - np.nanmedian(p)) > 50
+    i = np.flatnonzero(tpf.quality_mask)[0]
+    dx, dy = (0., 0.) if bad[i] else (pos_corr[0][i], pos_corr[1][i])
+    return tpf.wcs.wcs_pix2world(np.arange(ncols) + dx, np.zeros(ncols) + dy, 0)
+
+
+@profiling.stage('tpf_fetch')
+def fetch_tpf(tic,COORD=False,sector=None,gid=None,gmag=None):
+    """
+    Everything tpfplotter needs from remote services: the target coordinates and
+    Gaia data, the TPF (or FFI cut out) and the Gaia sources around it. Does not
+    plot, so it can run outside the main (GUI) thread.
+    Returns
+    -------
+    dict with tic, COORD, tpf, pipeline, gaia_id, mag and gaia (sources of the field).
+    The images of the TPF (reduce_tpf) are computed here as well.
+    """
     # tic: str
     # sector: str
-    data = None
-    if COORD:
-        coords = COORD
-        ras, decs = np.array([coords.split(',')[0]]), np.array([coords.split(',')[1]])
-        tics = np.array([tic])
+    if COORD is not False:
+        ra, dec = COORD.split(',')[0], COORD.split(',')[1]
+        print('Working on '+tic+' (ra = '+ra+', '+'dec = '+dec+') ...')
     else:
-        tics = np.array([tic])
-    for tt,tic in enumerate(tics):
-        if COORD is not False:
-            ra,dec = ras[tt], decs[tt]
-            print('Working on '+tic+' (ra = '+ra+', '+'dec = '+dec+') ...')
-        else:
-            ra,dec = get_coord(tic)
-            print('Working on TIC'+tic+' (ra = '+str(ra)+', '+'dec = '+str(dec)+') ...')
+        ra,dec = get_coord(tic)
+        print('Working on TIC'+tic+' (ra = '+str(ra)+', '+'dec = '+str(dec)+') ...')
 
-        if gid != None:
-            gaia_id, mag = gid, float(gmag)
+    if gid != None:
+        gaia_id, mag = gid, float(gmag)
+    else:
+        if COORD  is not False:
+            gaia_id, mag = get_gaia_data(ra, dec)
         else:
-            if COORD  is not False:
+            gaia_id, mag = get_gaia_data_from_tic(tic)
+            if np.isnan(mag):
                 gaia_id, mag = get_gaia_data(ra, dec)
-            else:
-                gaia_id, mag = get_gaia_data_from_tic(tic)
-                if np.isnan(mag):
-                    gaia_id, mag = get_gaia_data(ra, dec)
-
 
-        # By coordinates -----------------------------------------------------------------
-        if COORD  is not False:
-	                                                                           
-            if sector != None:
-                tpf = search_tesscut(ra+" "+dec, sector=int(sector)).download(cutout_size=(12,12))     #
 
-            else:
-                tpf = search_tesscut(ra+" "+dec).download(cutout_size=(12,12))                             #
+    # By coordinates -----------------------------------------------------------------
+    if COORD  is not False:
+	                                                                       
+        tpf = datasource.get_source().tesscut(ra+" "+dec, sector=sector, cutout_size=(12,12))
+        pipeline = "False"
+        print('    --> Using TESScut to get the TPF')
+        # By TIC name --------------------------------------------------------------------
+    else:
+        # If the target is in the CTL (short-cadance targets)...
+        try:
+            tpf = datasource.get_source().target_pixel_file(tic, sector=sector)
+            flux_cube(tpf)      # To check it has the flux array
+            pipeline = "True"
+
+            print("    --> Target found in the CTL!")
+
+        # ... otherwise if it still has a TIC number:
+        except:
+            tpf = datasource.get_source().tesscut("TIC "+tic, sector=sector, cutout_size=(12,12))
+            if tpf is None:
+                raise ValueError('No TPF or FFI cut out found for TIC '+tic)
+            print("    -->  Target not in CTL. The FFI cut out was succesfully downloaded")
             pipeline = "False"
-            print('    --> Using TESScut to get the TPF')
-            # By TIC name --------------------------------------------------------------------
-        else:
-            # If the target is in the CTL (short-cadance targets)...
-            try:
-                if sector != None:
-                    tpf = search_targetpixelfile("TIC "+tic, sector=int(sector), mission='TESS').download()
-                    a = tpf.flux        # To check it has the flux array
-                    pipeline = "True"
-                else:
-                    tpf = search_targetpixelfile("TIC "+tic, mission='TESS').download()
-                    a = tpf.flux        # To check it has the flux array
-                    pipeline = "True"
-
-                print("    --> Target found in the CTL!")
-
-            # ... otherwise if it still has a TIC number:
-            except:
-                if sector != None:
-                    tpf = search_tesscut("TIC "+tic, sector=int(sector)).download(cutout_size=(12,12))
-                else:
-                    tpf = search_tesscut("TIC "+tic).download(cutout_size=(12,12))
-                print("    -->  Target not in CTL. The FFI cut out was succesfully downloaded")
-                pipeline = "False"
-
-        fig = plt.figure(figsize=(6, 4.76))
-        gs = gridspec.GridSpec(1,3, height_ratios=[1], width_ratios=[1,0.05,0.01])
-        gs.update(left=0.05, right=0.95, bottom=0.12, top=0.95, wspace=0.01, hspace=0.03)
-        ax1 = plt.subplot(gs[0,0])
-        ax1 = set_plotcolors(ax1,fontcolor)
-
-
-        # TPF plot
-        mean_tpf = np.mean(tpf.flux,axis=0)
-        nx,ny = np.shape(mean_tpf)
-        norm = ImageNormalize(stretch=stretching.LogStretch())
-        division = int(np.log10(np.nanmax(np.nanmean(tpf.flux * u.s/u.electron,axis=0))))
-        image = np.nanmean(tpf.flux,axis=0)/10**division
-        splot = plt.imshow(image,norm=norm, \
+
+    reduce_tpf(tpf)
+    return {'tic':tic, 'COORD':COORD, 'tpf':tpf, 'pipeline':pipeline, 'gaia_id':gaia_id, 'mag':mag,
+            'gaia':query_tpf_field(tpf)}
+
+@profiling.stage('plot_tpf')
+def plot_tpf(fetched,SAVEGAIA=False,name=False,maglim=5,legend='best',savefig=False,fontcolor='white'):
+    """
+    TPF figure (and table of Gaia sources if SAVEGAIA) from the output of fetch_tpf.
+    Uses pyplot, so in the GUI it must run in the main thread.
+    """
+    import astropy.visualization as stretching
+    from astropy.visualization.mpl_normalize import ImageNormalize
+    from astropy.table import Table
+    data = None
+    tic, COORD, tpf, pipeline = fetched['tic'], fetched['COORD'], fetched['tpf'], fetched['pipeline']
+    gaia_id, mag = fetched['gaia_id'], fetched['mag']
+    fig = plt.figure(figsize=(6, 4.76))
+    gs = gridspec.GridSpec(1,3, height_ratios=[1], width_ratios=[1,0.05,0.01])
+    gs.update(left=0.05, right=0.95, bottom=0.12, top=0.95, wspace=0.01, hspace=0.03)
+    ax1 = plt.subplot(gs[0,0])
+    ax1 = set_plotcolors(ax1,fontcolor)
+
+
+    # TPF plot
+    images = reduce_tpf(tpf)
+    nx,ny = np.shape(images['mean'])
+    norm = ImageNormalize(stretch=stretching.LogStretch())
+    division = int(np.log10(np.nanmax(images['mean'])))
+    image = images['mean']/10**division
+    splot = plt.imshow(image,norm=norm, \
 				extent=[tpf.column,tpf.column+ny,tpf.row,tpf.row+nx],origin='lower', zorder=0)
 
-        # Pipeline aperture
-        if pipeline == "True":                                           #
-            aperture_mask = tpf.pipeline_mask
-            aperture = tpf._parse_aperture_mask(aperture_mask)
-            maskcolor = 'tomato'
-            print("    --> Using pipeline aperture...")
-        else:
-            aperture_mask = tpf.create_threshold_mask(threshold=10,reference_pixel='center')
-            aperture = tpf._parse_aperture_mask(aperture_mask)
-            maskcolor = 'lightgray'
-            print("    --> Using threshold aperture...")
-
-
-        for i in range(aperture.shape[0]):
-            for j in range(aperture.shape[1]):
-                if aperture_mask[i, j]:
-                    ax1.add_patch(patches.Rectangle((j+tpf.column, i+tpf.row),
-										   1, 1, color=maskcolor, fill=True,alpha=0.4))
-                    ax1.add_patch(patches.Rectangle((j+tpf.column, i+tpf.row),
-										   1, 1, color=maskcolor, fill=False,alpha=1,lw=2))
-
-        # Gaia sources
-        r, res = add_gaia_figure_elements(tpf,magnitude_limit=mag+float(maglim),targ_mag=mag)
-        x,y,gaiamags = r
-        x, y, gaiamags=np.array(x)+0.5, np.array(y)+0.5, np.array(gaiamags)
-        size = 128.0 / 2**((gaiamags-mag))
-        plt.scatter(x,y,s=size,c='red',alpha=0.6, edgecolor=None,zorder = 10)
-
-        # Gaia source for the target
-        this = np.where(np.array(res['Source']) == int(gaia_id))[0]
-        plt.scatter(x[this],y[this],marker='x',c='white',s=32,zorder = 11)
-
-        # Legend
-        add = 0
-        if int(maglim) % 2 != 0:
-            add = 1
-        maxmag = int(maglim) + add
-        legend_mags = np.linspace(-2,maxmag,int((maxmag+2)/2+1))
-        fake_sizes = mag + legend_mags #np.array([mag-2,mag,mag+2,mag+5, mag+8])
-        for f in fake_sizes:
-            size = 128.0 / 2**((f-mag))
-            plt.scatter(0,0,s=size,c='red',alpha=0.6, edgecolor=None,zorder = 10,label = r'$\Delta m=$ '+str(int(f-mag)))
-
-        ax1.legend(fancybox=True, framealpha=0.7, loc=legend)
-
-        # Source labels
+    # Pipeline aperture
+    if pipeline == "True":                                           #
+        aperture = np.asarray(tpf.pipeline_mask, dtype=bool)
+        maskcolor = 'tomato'
+        print("    --> Using pipeline aperture...")
+    else:
+        aperture = threshold_mask(images['median'],threshold=10,reference_pixel='center')
+        maskcolor = 'lightgray'
+        print("    --> Using threshold aperture...")
+
+
+    # One collection for the filled pixels and one for their edges
+    rows, cols = np.nonzero(aperture)
+    x0, y0 = cols+tpf.column, rows+tpf.row
+    squares = np.stack([np.column_stack([x0, y0]), np.column_stack([x0+1, y0]),
+                        np.column_stack([x0+1, y0+1]), np.column_stack([x0, y0+1])], axis=1)
+    ax1.add_collection(PolyCollection(squares, facecolor=maskcolor, edgecolor=maskcolor, alpha=0.4))
+    ax1.add_collection(PolyCollection(squares, facecolor='none', edgecolor=maskcolor, alpha=1, lw=2))
+
+    # Gaia sources
+    r, res = add_gaia_figure_elements(tpf,magnitude_limit=mag+float(maglim),targ_mag=mag,
+                                      result=fetched['gaia'])
+    x,y,gaiamags = r
+    x, y, gaiamags=np.array(x)+0.5, np.array(y)+0.5, np.array(gaiamags)
+    size = 128.0 / 2**((gaiamags-mag))
+    plt.scatter(x,y,s=size,c='red',alpha=0.6, edgecolor=None,zorder = 10)
+
+    # Gaia source for the target
+    this = np.where(np.array(res['Source']) == int(gaia_id))[0]
+    plt.scatter(x[this],y[this],marker='x',c='white',s=32,zorder = 11)
+
+    # Legend
+    add = 0
+    if int(maglim) % 2 != 0:
+        add = 1
+    maxmag = int(maglim) + add
+    legend_mags = np.linspace(-2,maxmag,int((maxmag+2)/2+1))
+    fake_sizes = mag + legend_mags #np.array([mag-2,mag,mag+2,mag+5, mag+8])
+    for f in fake_sizes:
+        size = 128.0 / 2**((f-mag))
+        plt.scatter(0,0,s=size,c='red',alpha=0.6, edgecolor=None,zorder = 10,label = r'$\Delta m=$ '+str(int(f-mag)))
+
+    ax1.legend(fancybox=True, framealpha=0.7, loc=legend)
+
+    # Source labels
+    dist = np.sqrt((x-x[this])**2+(y-y[this])**2)
+    dsort = np.argsort(dist)
+    for d,elem in enumerate(dsort):
+        if dist[elem] < 6:
+            plt.text(x[elem]+0.1,y[elem]+0.1,str(d+1),color='white', zorder=100)
+
+    # Orientation arrows
+    plot_orientation(tpf)
+
+    # Labels and titles
+    # Reverse x limits so that image plots as seen on the sky:
+    plt.xlim(tpf.column+ny,tpf.column)
+    plt.ylim(tpf.row,tpf.row+nx)
+    plt.xlabel('Pixel Column Number', fontsize=16, zorder=200,color=fontcolor)
+    plt.ylabel('Pixel Row Number', fontsize=16, zorder=200,color=fontcolor)
+    if COORD is not False:                                                                                          #
+        plt.title('Coordinates '+tic+' - Sector '+str(tpf.sector), fontsize=16, zorder=200,color=fontcolor)# + ' - Camera '+str(tpf.camera))  #
+    elif name is not False:
+        plt.title(name +' - Sector '+str(tpf.sector), fontsize=15, zorder=200,color=fontcolor)
+    else:   												#
+        plt.title('TIC '+tic+' - Sector '+str(tpf.sector), fontsize=15, zorder=200,color='white')# + ' - Camera '+str(tpf.camera))
+
+    # Colorbar
+    cbax = plt.subplot(gs[0,1]) # Place it where it should be.
+    pos1 = cbax.get_position() # get the original position
+    pos2 = [pos1.x0 - 0.05, pos1.y0 ,  pos1.width, pos1.height]
+    cbax.set_position(pos2) # set a new position
+    
+    cbar_ticks = np.linspace(np.min(image), np.max(image), 8, endpoint=True)
+    cbax = set_plotcolors(cbax,fontcolor)
+    
+    cb = Colorbar(ax = cbax, mappable = splot, orientation = 'vertical',
+                  ticklocation = 'right')
+    cb.outline.set_edgecolor(fontcolor)
+    plt.xticks(fontsize=14)
+    #cbax.set_yticklabels(["{:4.2f}".format(i) for i in cbar_ticks])
+    exponent = r'$\times 10^'+str(division)+'$'
+    cb.set_label(r'Flux '+exponent+r' (e$^-$)', labelpad=10, fontsize=16,color=fontcolor)
+    
+    if savefig:
+        plt.savefig('TIC_'+tic+'_S_'+str(tpf.sector)+'_tpf.png')
+    fig.tight_layout()
+    fig.set_facecolor('#323431')
+    fig.set_dpi(75)
+    plt.close()
+    # Save Gaia sources info
+    if SAVEGAIA:
         dist = np.sqrt((x-x[this])**2+(y-y[this])**2)
-        dsort = np.argsort(dist)
-        for d,elem in enumerate(dsort):
-            if dist[elem] < 6:
-                plt.text(x[elem]+0.1,y[elem]+0.1,str(d+1),color='white', zorder=100)
-
-        # Orientation arrows
-        plot_orientation(tpf)
-
-        # Labels and titles
-        # Reverse x limits so that image plots as seen on the sky:
-        plt.xlim(tpf.column+ny,tpf.column)
-        plt.ylim(tpf.row,tpf.row+nx)
-        plt.xlabel('Pixel Column Number', fontsize=16, zorder=200,color=fontcolor)
-        plt.ylabel('Pixel Row Number', fontsize=16, zorder=200,color=fontcolor)
-        if COORD is not False:                                                                                          #
-            plt.title('Coordinates '+tic+' - Sector '+str(tpf.sector), fontsize=16, zorder=200,color=fontcolor)# + ' - Camera '+str(tpf.camera))  #
-        elif name is not False:
-            plt.title(name +' - Sector '+str(tpf.sector), fontsize=15, zorder=200,color=fontcolor)
-        else:   												#
-            plt.title('TIC '+tic+' - Sector '+str(tpf.sector), fontsize=15, zorder=200,color='white')# + ' - Camera '+str(tpf.camera))
-
-        # Colorbar
-        cbax = plt.subplot(gs[0,1]) # Place it where it should be.
-        pos1 = cbax.get_position() # get the original position
-        pos2 = [pos1.x0 - 0.05, pos1.y0 ,  pos1.width, pos1.height]
-        cbax.set_position(pos2) # set a new position
-        
-        cbar_ticks = np.linspace(np.min(image), np.max(image), 8, endpoint=True)
-        cbax = set_plotcolors(cbax,fontcolor)
-        
-        cb = Colorbar(ax = cbax, mappable = splot, orientation = 'vertical',
-                      ticklocation = 'right')
-        cb.outline.set_edgecolor(fontcolor)
-        plt.xticks(fontsize=14)
-        #cbax.set_yticklabels(["{:4.2f}".format(i) for i in cbar_ticks])
-        exponent = r'$\times 10^'+str(division)+'$'
-        cb.set_label(r'Flux '+exponent+r' (e$^-$)', labelpad=10, fontsize=16,color=fontcolor)
-        
-        if savefig:
-            plt.savefig('TIC_'+tic+'_S_'+str(tpf.sector)+'_tpf.png')
-        fig.tight_layout()
-        fig.set_facecolor('#323431')
-        fig.set_dpi(75)
-        plt.close()
-        # Save Gaia sources info
-        if SAVEGAIA:
-            dist = np.sqrt((x-x[this])**2+(y-y[this])**2)
-            GaiaID = np.array(res['Source'])
-            srt = np.argsort(dist)
-            x, y, gaiamags, dist, GaiaID = x[srt], y[srt], gaiamags[srt], dist[srt], GaiaID[srt]
-
-            IDs = np.arange(len(x))+1
-            inside = np.zeros(len(x))
-
-            for i in range(aperture.shape[0]):
-                for j in range(aperture.shape[1]):
-                    if aperture_mask[i, j]:
-                        xtpf, ytpf = j+tpf.column, i+tpf.row
-                        _inside = np.where((x > xtpf) & (x < xtpf+1) &
-                                           (y > ytpf) & (y < ytpf+1))[0]
-                        inside[_inside] = 1
-
-
-
-            data = Table([IDs, GaiaID, x, y, dist, dist*21., gaiamags, inside.astype('int')],
-                         names=['# ID','GaiaID','x', 'y','Dist_pix','Dist_arcsec','Gmag', 'InAper'])
-            #ascii.write(data, 'Gaia_TIC'+tic+'_S'+str(tpf.sector)+'.dat',overwrite=True)
+        GaiaID = np.array(res['Source'])
+        srt = np.argsort(dist)
+        x, y, gaiamags, dist, GaiaID = x[srt], y[srt], gaiamags[srt], dist[srt], GaiaID[srt]
+
+        IDs = np.arange(len(x))+1
+        inside = np.zeros(len(x))
+
+        # Pixel of each source looked up in the aperture mask
+        col = np.floor(x-tpf.column)
+        row = np.floor(y-tpf.row)
+        onchip = (np.isfinite(col) & np.isfinite(row) & (row >= 0) & (row < aperture.shape[0]) &
+                  (col >= 0) & (col < aperture.shape[1]))
+        inside[onchip] = aperture[row[onchip].astype(int), col[onchip].astype(int)]
+
+
+        data = Table([IDs, GaiaID, x, y, dist, dist*21., gaiamags, inside.astype('int')],
+                     names=['# ID','GaiaID','x', 'y','Dist_pix','Dist_arcsec','Gmag', 'InAper'])
+        #ascii.write(data, 'Gaia_TIC'+tic+'_S'+str(tpf.sector)+'.dat',overwrite=True)
     return fig,data
+
+def tpfplotter(tic,LIST=False,COORD=False,SAVEGAIA=False,name=False,maglim=5,sector=None,gid=None,gmag=None,legend='best',savefig=False,fontcolor='white'):
+    # tic: str
+    # sector: str
+    fetched = fetch_tpf(tic,COORD=COORD,sector=sector,gid=gid,gmag=gmag)
+    return plot_tpf(fetched,SAVEGAIA=SAVEGAIA,name=name,maglim=maglim,legend=legend,savefig=savefig,fontcolor=fontcolor)